@@ -0,0 +1,162 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+"""
+Bulk execution of instance actions (delete, reboot, snapshot, stop,
+start).
+
+Actions are issued on a bounded thread pool and throttled by a token
+bucket per compute host and per cell, so a large drain neither floods
+nova nor serialises behind a single host. Workflows tell that an action
+has taken effect from the host listings they take on every run.
+"""
+
+from oslo.config import cfg
+
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+
+from poncho.common.utils import TokenBucket
+from poncho.nova.inventory import server_host
+
+opts = [
+    cfg.IntOpt('action_concurrency', default=8,
+        help='Maximum number of instance actions issued to nova at once.'),
+    cfg.FloatOpt('action_host_rate', default=1.0,
+        help='Instance actions per second allowed on a single compute '
+             'host; zero for no limit.'),
+    cfg.FloatOpt('action_cell_rate', default=10.0,
+        help='Instance actions per second allowed in a single cell; zero '
+             'for no limit.'),
+    cfg.DictOpt('host_cells', default={},
+        help='Cell of each compute host, as host:cell pairs. Hosts not '
+             'listed share one default cell.'),
+    cfg.IntOpt('action_max_wait', default=60,
+        help='Seconds a workflow tick waits on the rate limits before '
+             'leaving the remaining actions for its next run.'),
+]
+CONF = cfg.CONF
+CONF.register_opts(opts)
+
+def host_cell(hostname):
+    return CONF.host_cells.get(hostname, '')
+
+
+class Action(object):
+    """An instance action: fn(server) issues it."""
+    def __init__(self, name, fn):
+        self.name = name
+        self.fn = fn
+
+
+ACTIONS = {
+    'delete': Action('delete', lambda server: server.delete()),
+    'reboot': Action('reboot', lambda server: server.reboot()),
+    'snapshot': Action('snapshot', lambda server: server.create_image(
+        "%s-poncho-snapshot" % (server.name))),
+    'stop': Action('stop', lambda server: server.stop()),
+    'start': Action('start', lambda server: server.start()),
+}
+
+
+class ActionResults(dict):
+    """Mapping of uuid to server for every action issued. Actions that
+    raised are in failures, mapped to the exception; actions that could
+    not be issued within max_wait are listed in deferred."""
+    def __init__(self):
+        super(ActionResults, self).__init__()
+        self.failures = {}
+        self.deferred = []
+
+
+class BulkExecutor(object):
+    """Issues actions on many servers, throttled per host and per cell.
+    The rate limits are shared by every run() on the same executor."""
+    def __init__(self, concurrency=None, host_rate=None, cell_rate=None,
+                 clock=time.time, sleep=time.sleep):
+        self.concurrency = concurrency or CONF.action_concurrency
+        self.host_rate = host_rate if host_rate is not None \
+            else CONF.action_host_rate
+        self.cell_rate = cell_rate if cell_rate is not None \
+            else CONF.action_cell_rate
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._host_buckets = {}
+        self._cell_buckets = {}
+
+    def _bucket(self, buckets, key, rate):
+        with self._lock:
+            if key not in buckets:
+                buckets[key] = TokenBucket(rate, clock=self._clock,
+                                           sleep=self._sleep)
+            return buckets[key]
+
+    def _acquire(self, host, deadline):
+        """Take a host and a cell token, sleeping as needed. Returns False
+        if that would run past deadline; no token is then taken."""
+        buckets = [self._bucket(self._cell_buckets, host_cell(host),
+                                self.cell_rate),
+                   self._bucket(self._host_buckets, host, self.host_rate)]
+        taken = []
+        while len(taken) < len(buckets):
+            bucket = buckets[len(taken)]
+            wait = bucket.try_consume()
+            if wait == 0:
+                taken.append(bucket)
+                continue
+            if deadline is not None and self._clock() + wait > deadline:
+                # Hand back what we took so other hosts are not starved
+                for bucket in taken:
+                    bucket.refund()
+                return False
+            self._sleep(wait)
+        return True
+
+    def run(self, action, servers, max_wait=None):
+        """Issue action on every server. Blocks until all are issued, or
+        for at most max_wait seconds. Returns an ActionResults."""
+        if isinstance(action, basestring):
+            action = ACTIONS[action]
+        results = ActionResults()
+        if not servers:
+            return results
+        deadline = None
+        if max_wait is not None:
+            deadline = self._clock() + max_wait
+
+        def issue(server):
+            if not self._acquire(server_host(server), deadline):
+                return (server, None, False)
+            try:
+                action.fn(server)
+            except Exception, e:
+                return (server, e, True)
+            return (server, None, True)
+        pool = ThreadPool(max(min(self.concurrency, len(servers)), 1))
+        try:
+            for (server, error, issued) in pool.imap_unordered(issue,
+                                                               servers):
+                if not issued:
+                    results.deferred.append(server.id)
+                elif error is not None:
+                    results.failures[server.id] = error
+                else:
+                    results[server.id] = server
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def get_executor():
+    """The executor shared by every workflow in the process, so the rate
+    limits hold across events draining the same hosts or cells."""
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = BulkExecutor()
+    return _EXECUTOR
@@ -0,0 +1,70 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+"""
+Mirror nova instance metadata annotations into the poncho database.
+"""
+
+from oslo.config import cfg
+
+from datetime import datetime, timedelta
+
+from poncho import annotations
+from poncho.db import api as db
+from poncho.nova.client import Client
+
+opts = [
+    cfg.IntOpt('annotation_sync_overlap', default=60,
+        help='Seconds of overlap between changes-since queries, to allow '
+             'for clock skew between poncho and nova.'),
+]
+CONF = cfg.CONF
+CONF.register_opts(opts)
+
+
+class AnnotationSync(object):
+    """Keeps the instance_annotations table in sync with nova.
+
+    The first poll() lists every server; later polls only ask nova for
+    servers changed since the previous poll.
+    """
+    def __init__(self, client=None, grammar=annotations.default):
+        self._client = client
+        self.grammar = grammar
+        self.last_sync = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = Client()
+        return self._client
+
+    def poll(self):
+        started = datetime.utcnow()
+        full = self.last_sync is None
+        servers = self.client.get_changed_servers(since=self.last_sync)
+        self.apply(servers, full=full)
+        overlap = timedelta(seconds=CONF.annotation_sync_overlap)
+        self.last_sync = started - overlap
+        return len(servers)
+
+    def apply(self, servers, full=False):
+        """Store the valid annotations of a list of nova servers. If full
+        is set, servers is a complete listing and annotations of any other
+        instance are dropped."""
+        errors = self.grammar.validate_many(servers)
+        keys = self.grammar.list_keys()
+        changes = {}
+        for server in servers:
+            if getattr(server, 'status', None) == 'DELETED':
+                changes[server.id] = None
+                continue
+            invalid = errors.get(server.id, {})
+            values = dict((key, server.metadata[key]) for key in keys
+                          if key in server.metadata and key not in invalid)
+            changes[server.id] = (getattr(server, 'tenant_id', None), values)
+        # Runs on the inventory thread; its session is released after
+        # each batch.
+        with db.session_scope() as session:
+            if changes:
+                db.sync_annotations(changes, session=session)
+            if full:
+                db.prune_annotations(changes.keys(), session=session)
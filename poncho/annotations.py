@@ -1,8 +1,10 @@
 """ Grammar rules for validating instance annotations """
 # poncho.annotations - Definition of grammar and constraints for
 # instance annotations.
+import collections
 import datetime
 import re
+import threading
 import time
 import urlparse
 
@@ -36,9 +38,39 @@ class Grammar(object):
     def validate_server(self, server):
         for tag in self.tags.keys():
             if tag in server.metadata:
-                self.validate(tag, self.metadata[tag])
+                self.validate(tag, server.metadata[tag])
         return True
 
+    def validate_many(self, servers):
+        """Validate the annotations on a list of servers in one pass.
+
+        Returns a dict mapping server id to a dict of {key: error} for
+        every server with invalid annotations; valid servers are omitted.
+        Identical (key, value) pairs are only validated once.
+        """
+        memo = {}
+        report = {}
+        for server in servers:
+            errors = {}
+            metadata = server.metadata
+            for key in self.tags:
+                if key not in metadata:
+                    continue
+                pair = (key, metadata[key])
+                if pair not in memo:
+                    try:
+                        self.validate(*pair)
+                        memo[pair] = None
+                    except AnnotationSyntaxError as e:
+                        memo[pair] = e
+                    except Exception as e:
+                        memo[pair] = AnnotationSyntaxError(key, pair[1], e)
+                if memo[pair] is not None:
+                    errors[key] = memo[pair]
+            if errors:
+                report[server.id] = errors
+        return report
+
     def validate(self, key, value):
         if key not in self.tags:
             raise AnnotationSyntaxError(
@@ -63,14 +95,15 @@ class Constraint(object):
 
     def _parse_time(self, string):
         # Parse string of the form (%d[dhms]+) e.g. 510m3s and return a
-        # datetime.duration object.
+        # datetime.timedelta object.
         t = {'d': 0, 'h': 0, 'm': 0, 's': 0}
         regex = re.compile("(\d+)([dhms])")
         for m in regex.finditer(string):
             (ammount, kind) = m.groups()
             t[kind] += int(ammount)
         timedelta = datetime.timedelta(t['d'], t['s'], 0, 0, t['m'], t['h'])
-        return self._validate_timedelta(timedelta)
+        self._validate_timedelta(timedelta)
+        return timedelta
 
     def _validate_timedelta(self, timedelta):
         zero = datetime.timedelta()
@@ -79,6 +112,20 @@ class Constraint(object):
                 self.__class__, "Time interval must be greater than zero!")
         return True
 
+    def _key(self):
+        # Parsed arguments identifying the constraint, used for hashing.
+        raise NotImplementedError()
+
+    def __eq__(self, other):
+        return (self.__class__ is other.__class__ and
+                self._key() == other._key())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.__class__.__name__, self._key()))
+
 
 class MinRuntimeConstraint(Constraint):
     """ 'MinRuntime(2h12s)' where valid durations are like 0d1h2m3s
@@ -86,7 +133,17 @@ class MinRuntimeConstraint(Constraint):
     for more than the supplied duraiton.
 """
     def __init__(self, arg_string):
-        timedelta = self._parse_time(arg_string)
+        self.duration = self._parse_time(arg_string)
+
+    def _key(self):
+        return self.duration
+
+    def is_valid(self, context):
+        launched_at = context.get('launched_at')
+        if launched_at is None:
+            return False
+        now = context.get('now') or datetime.datetime.utcnow()
+        return now - launched_at >= self.duration
 
 
 class NotifiedConstraint(Constraint):
@@ -97,7 +154,17 @@ class NotifiedConstraint(Constraint):
     duration.
 """
     def __init__(self, arg_string):
-        timedelta = self._parse_time(arg_string)
+        self.duration = self._parse_time(arg_string)
+
+    def _key(self):
+        return self.duration
+
+    def is_valid(self, context):
+        notified_at = context.get('notified_at')
+        if notified_at is None:
+            return False
+        now = context.get('now') or datetime.datetime.utcnow()
+        return now - notified_at >= self.duration
 
 
 # TimeOfDay helper functions
@@ -153,8 +220,20 @@ class TimeOfDayConstraint(Constraint):
         self.stop = stop
         self.tz = tz
 
+    def _key(self):
+        return (self.start, self.stop, self.tz)
+
+    def window_seconds(self):
+        """Returns (start, stop, tz) as seconds, start and stop since
+        midnight and tz as the UTC offset."""
+        def seconds(t):
+            return t.hour * 3600 + t.minute * 60 + t.second
+        tz = self.tz.days * 86400 + self.tz.seconds
+        return (seconds(self.start), seconds(self.stop), tz)
+
     def is_valid(self, context):
-        now = datetime.datetime.utcnow() + self.tz
+        now = context.get('now') or datetime.datetime.utcnow()
+        now = (now + self.tz).time()
         wraps = True if self.start > self.stop else False
         # Account for case where start and stop wrap around midnight
         if not wraps and self.start < now and now < self.stop:
@@ -175,7 +254,7 @@ def is_url(string):
 
 
 def is_bool(string):
-    if type(string) is not str:
+    if not isinstance(string, basestring):
         return False
     if string.isdigit() and string in ['1', '0']:
         return True
@@ -206,6 +285,33 @@ class KeyValidator(Validator):
         return self.desc
 
 
+class ConstraintProgram(collections.namedtuple('ConstraintProgram',
+                                                ['source', 'constraints'])):
+    """Compiled, immutable form of a constraint string.
+
+    'constraints' is a tuple of Constraint objects. Two programs compare
+    equal when their constraints do, regardless of the whitespace or
+    aliases used in the source string.
+    """
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return (isinstance(other, ConstraintProgram) and
+                self.constraints == other.constraints)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.constraints)
+
+    def __iter__(self):
+        return iter(self.constraints)
+
+    def __len__(self):
+        return len(self.constraints)
+
+
 class ConstraintSet(Validator):
     """A string consisting of semicolon delimited list of constraints of
     the following form:
@@ -213,20 +319,30 @@ class ConstraintSet(Validator):
     """
     constraint_regex = re.compile("(\w+)\(([^;\)]*)\)")
     constraint_delimiter = ";"
+    cache_size = 1024
 
-    def __init__(self, constraints=[]):
+    def __init__(self, constraints=[], cache_size=None):
         self.constraints = {}
         self.deprecated = {}
-        for constraint in constraints:
-            self.add_constraint(constraint)
+        if cache_size is not None:
+            self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        for (key, constraint) in constraints:
+            self.add_constraint(key, constraint)
 
     def add_constraint(self, key, constraint, deprecated=False):
         self.constraints[key] = constraint
         self.deprecated[key] = deprecated
+        self.clear_cache()
 
     def make_constraint(self, string):
-        m = self.constraint_regex.search(string)
-        if m is None or len(m.groups()) != 2:
+        # The whole string must be one constraint; anything around it is
+        # most likely a mistyped delimiter.
+        m = self.constraint_regex.match(string.strip())
+        if m is None or m.end() != len(string.strip()):
             raise ConstraintSyntaxError(
                 string, "Invalid constraint syntax")
 
@@ -238,13 +354,46 @@ class ConstraintSet(Validator):
         return constraint_class(arg_string)
 
     def make_constraints(self, string):
+        return list(self.compile(string).constraints)
+
+    def _compile(self, string):
         parts = string.split(self.constraint_delimiter)
         if len(parts) == 1 and parts[0] == "":
-            return []
-        return [self.make_constraint(p) for p in parts]
+            return ConstraintProgram(string, ())
+        return ConstraintProgram(
+            string, tuple(self.make_constraint(p) for p in parts))
+
+    def compile(self, string):
+        """Return the ConstraintProgram for string, parsing it only if it
+        is not already in the LRU cache. Syntax errors are never cached."""
+        with self._cache_lock:
+            program = self._cache.pop(string, None)
+            if program is not None:
+                self._cache[string] = program
+                self.cache_hits += 1
+                return program
+            self.cache_misses += 1
+        program = self._compile(string)
+        with self._cache_lock:
+            self._cache[string] = program
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return program
+
+    def clear_cache(self):
+        with self._cache_lock:
+            self._cache.clear()
+            self.cache_hits = 0
+            self.cache_misses = 0
+
+    def cache_info(self):
+        """Return a dict of cache statistics."""
+        with self._cache_lock:
+            return {'hits': self.cache_hits, 'misses': self.cache_misses,
+                    'size': len(self._cache), 'max_size': self.cache_size}
 
     def validate(self, string):
-        self.make_constraints(string)
+        self.compile(string)
         return True
 
     def description(self):
@@ -266,8 +415,10 @@ default = Grammar({
     'terminate_when': _constraints,
     'ha_group_id': KeyValidator(
         lambda x: True if len(x) else False, "Any unique string"),
-    'ha_group_min': KeyValidator(str.isdigit, "A positive integer"),
-    'priority': KeyValidator(str.isdigit, "A positive integer"),
+    'ha_group_min': KeyValidator(
+        lambda x: x.isdigit(), "A positive integer"),
+    'priority': KeyValidator(
+        lambda x: x.isdigit(), "A positive integer"),
     'snapshot_on_terminate': KeyValidator(is_bool, "'True' or 'False'"),
     'notify_url': KeyValidator(is_url, "A valid URL"),
 })
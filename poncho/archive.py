@@ -0,0 +1,106 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+"""
+Archival of completed service events.
+
+Events completed longer ago than archive_retention_days are written,
+with their hosts and per-instance progress rows, to a gzipped JSON-lines
+file and then deleted from the database, one batch per transaction. A
+batch is written and flushed to disk before it is deleted, so a crash
+can at worst archive the same event twice, never lose it.
+"""
+
+from oslo.config import cfg
+
+from datetime import datetime, timedelta
+import gzip
+import json
+import os
+
+from poncho.db import api as db
+
+opts = [
+    cfg.IntOpt('archive_retention_days', default=90,
+        help='Days completed service events are kept in the database '
+             'before poncho-service archive moves them out.'),
+    cfg.IntOpt('archive_batch_size', default=100,
+        help='Service events archived per transaction.'),
+    cfg.StrOpt('archive_dir', default='/var/lib/poncho/archive',
+        help='Directory poncho-service archive writes its files to.'),
+]
+CONF = cfg.CONF
+CONF.register_opts(opts)
+
+
+def _value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _columns(row):
+    return dict((column.name, _value(getattr(row, column.name)))
+                for column in row.__table__.columns)
+
+
+def event_record(event, instances):
+    """JSON-ready dict of an event, its host names and instance rows."""
+    record = _columns(event)
+    record['hosts'] = sorted(host.name for host in event.hosts)
+    record['instances'] = [_columns(instance) for instance in instances]
+    return record
+
+
+def archive_path(now=None):
+    now = now or datetime.now()
+    return os.path.join(CONF.archive_dir, "service-events-%s.jsonl.gz" % (
+        now.strftime('%Y%m%dT%H%M%S')))
+
+
+def archive_events(path, completed_before=None, batch_size=None,
+                   dry_run=False):
+    """Move events completed before completed_before (default: the
+    retention window) into the file at path. Returns the number of
+    events archived, or that would be with dry_run."""
+    if completed_before is None:
+        completed_before = datetime.now() - timedelta(
+            days=CONF.archive_retention_days)
+    batch_size = batch_size or CONF.archive_batch_size
+    if dry_run:
+        with db.session_scope() as session:
+            return db.count_archivable_events(completed_before,
+                                              session=session)
+    archived = 0
+    out = None
+    try:
+        while True:
+            with db.session_scope() as session:
+                events = db.get_archivable_events(
+                    completed_before, batch_size, session=session)
+                if not events:
+                    return archived
+                ids = [event.id for event in events]
+                instances = db.get_instances_for_events(ids,
+                                                        session=session)
+                if out is None:
+                    out = gzip.open(path, 'ab')
+                for event in events:
+                    out.write(json.dumps(event_record(
+                        event, instances.get(event.id, [])),
+                        sort_keys=True) + "\n")
+                out.flush()
+                os.fsync(out.fileobj.fileno())
+                archived += db.delete_events(ids, session=session)
+    finally:
+        if out is not None:
+            out.close()
+
+
+def read_archive(path):
+    """Yield the event records of an archive file."""
+    archive = gzip.open(path, 'rb')
+    try:
+        for line in archive:
+            if line.strip():
+                yield json.loads(line)
+    finally:
+        archive.close()
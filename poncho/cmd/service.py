@@ -9,8 +9,11 @@ import sys
 import string
 import tempfile
 
+import poncho.archive
+import poncho.db.migration
 import poncho.workflows
 import poncho.manager
+import poncho.simulator
 from poncho.common import cli
 from poncho.common.utils import readable_datetime
 from poncho.db import api as db
@@ -55,7 +58,7 @@ class ServiceShell(cli.Shell):
         help='Include completed service events')
     def do_list(self, args):
         """Return a list of service events."""
-        events = db.get_events()
+        events = db.get_events(include_completed=args.completed)
         fmts = { 'Hosts' : lambda e: ", ".join([ h.name for h in e.hosts]) }
         cli.print_table(events, ['ID', 'Workflow', 'State', 'Hosts'], fmts)
 
@@ -83,6 +86,9 @@ class ServiceShell(cli.Shell):
         help='Dry-run mode; this will report the expected service behavior.')
     @cli.arg('--workflow', '-w', required=True,
         help='Specify the workflow to use.')
+    @cli.arg('--force', action='store_true',
+        help='Create the event even if its hosts are in other service '
+             'events with overlapping drain windows.')
     def do_create(self, args):
         """Create a new service event."""
         if not args.description:
@@ -90,8 +96,48 @@ class ServiceShell(cli.Shell):
             args.description = cli.get_text_from_editor("# fill this in")
         if not args.notes:
             args.notes = ""
-        event = self.manager.create_event(args)
+        try:
+            event = self.manager.create_event(args)
+        except db.HostConflict, e:
+            print >>sys.stderr, "%s\nUse --force to create it anyway." % (e)
+            sys.exit(1)
         self._show_event(event)
+        if args.dry:
+            self._show_simulation(*self.manager.simulate_event(event))
+
+    def _show_simulation(self, simulation, failures):
+        offset = poncho.simulator.utc_offset()
+        def local(dt):
+            return dt - offset if dt else None
+        for (host, e) in failures.iteritems():
+            print >>sys.stderr, "Could not list instances on %s: %s" % (
+                host, e)
+        print "\nExpected behavior (%d instances, action: %s)" % (
+            len(simulation.instances), simulation.action)
+        if simulation.instances:
+            formatters = {
+                'Wave': lambda i: "held" if i.wave is None else i.wave,
+                'Notified': lambda i: local(i.notified_at),
+                'Action At': lambda i: local(i.action_at),
+                'Done At': lambda i: local(i.done_at),
+                'Allowed At': lambda i: local(i.allowed_at) or "never",
+            }
+            cli.print_table(simulation.instances,
+                ['Wave', 'Host', 'Name', 'UUID', 'Notified', 'Action At',
+                 'Done At', 'Allowed At'], formatters)
+        print "Finishes: %s" % (readable_datetime(
+            local(simulation.finished_at)))
+        print "Duration: %s" % (simulation.duration)
+        early = simulation.early()
+        if early:
+            print "Warning: %d instances would be acted on before their " \
+                "constraints allow it; consider a longer --notify." % (
+                    len(early))
+        held = simulation.held()
+        if held:
+            print "Warning: %d instances would be held back to keep their " \
+                "HA groups at ha_group_min; the event cannot finish " \
+                "until replacements let the groups spare them." % (len(held))
 
     @cli.arg('service_id', help='The id of the service to show')
     def do_complete(self, args):
@@ -118,6 +164,47 @@ class ServiceShell(cli.Shell):
         desc = workflow.__doc__ or 'No description provided. :('
         print ("Workflow: %s\n%s\nDescription:\n%s%s\n" %
             (workflow.name, ('=' * 79), desc, ('=' * 79)))
+        print "Transitions:"
+        for state in sorted(workflow.transitions):
+            targets = workflow.transitions[state]
+            print "  %s -> %s" % (state, ", ".join(targets) or "(final)")
+
+    @cli.arg('--days', type=int,
+        help='Archive events completed more than this many days ago; '
+             'defaults to archive_retention_days.')
+    @cli.arg('--output', '-o',
+        help='Archive file to append to; defaults to a new file in '
+             'archive_dir.')
+    @cli.arg('--dry', action='store_true',
+        help='Only report how many events would be archived.')
+    def do_archive(self, args):
+        """Move old completed service events out of the database."""
+        days = args.days
+        if days is None:
+            days = poncho.archive.CONF.archive_retention_days
+        before = datetime.now() - timedelta(days=days)
+        path = args.output or poncho.archive.archive_path()
+        if args.dry:
+            count = poncho.archive.archive_events(path, before, dry_run=True)
+            print "%d service events would be archived" % (count)
+            return
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        count = poncho.archive.archive_events(path, before)
+        print "Archived %d service events to %s" % (count, path)
+
+    @cli.arg('--version', help='Revision to upgrade to; default latest.')
+    def do_db_sync(self, args):
+        """Create or upgrade the poncho database schema."""
+        poncho.db.migration.db_sync(args.version)
+        print "Database at revision %s" % (poncho.db.migration.db_version())
+
+    def do_db_version(self, args):
+        """Show the revision of the poncho database schema."""
+        print "Database at revision %s (latest %s)" % (
+            poncho.db.migration.db_version(),
+            poncho.db.migration.head_version())
 
 def main():
     shell = ServiceShell()
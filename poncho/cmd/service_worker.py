@@ -4,52 +4,117 @@ service events and performing operations when possible.
 """
 import argparse
 import daemon
-import time
 import sys
+from datetime import datetime
+import poncho.annotation_sync
+import poncho.dispatcher
 import poncho.db.api as db
-import poncho.db.models
+import poncho.db.migration
+import poncho.hagroups
+import poncho.leases
+import poncho.nova.client
+import poncho.nova.inventory
+import poncho.runner
+import poncho.scheduler
 import poncho.workflows
 
 from oslo.config import cfg
+from sqlalchemy.orm.exc import NoResultFound
 
-opts = [
-    cfg.StrOpt('polling_interval', default=2,
-        help='Interval in seconds to update workflows for service events.'),
-]
 CONF = cfg.CONF
-CONF.register_opts(opts)
+
+def run_event(event_id, scheduler, owner):
+    """Run one workflow step for an event. Returns when the event should
+    next be run, or None if it is waiting on a trigger."""
+    # Each tick gets its own session on the runner thread, released
+    # when the tick ends.
+    with db.session_scope() as session:
+        return _run_event(session, event_id, scheduler, owner)
+
+def _run_event(session, event_id, scheduler, owner):
+    try:
+        event = db.get_event(event_id, session)
+    except NoResultFound:
+        print >>sys.stderr, "Unknown event %s" % (event_id)
+        return None
+    if event.completed:
+        return None
+    scheduler.watch(event.id, [h.name for h in event.hosts])
+    workflow_name = event.workflow
+    workflow = poncho.workflows.get_workflow(workflow_name)()
+    if not db.claim_event(event.id, owner, poncho.leases.lease_duration(),
+                          session=session):
+        # Another worker is running it; look again when its lease would
+        # run out or our own deadline comes up, whichever is first.
+        retry = datetime.now() + poncho.leases.lease_duration()
+        wake_at = workflow.next_run_at(event, datetime.now())
+        return min(wake_at, retry) if wake_at else retry
+    try:
+        session.refresh(event)
+        print "Event %d state: %s..." % (event.id, event.state)
+        newstate = workflow.run(event, {})
+        if newstate:
+            # A workflow reaching 'completed' finishes the event itself
+            if not db.transition_event(event.id, owner, event.state,
+                                       newstate, session=session,
+                                       completed=newstate == 'completed'):
+                print >>sys.stderr, (
+                    "Event %d: lost lease, not moving %s -> %s" %
+                    (event.id, event.state, newstate))
+                return datetime.now()
+            print "Event %d state: %s -> %s" % (event.id, event.state, newstate)
+            # Give the new state its first run straight away
+            return datetime.now()
+        else:
+            print "Event %d state: %s -X" % (event.id, event.state)
+        return workflow.next_run_at(event, datetime.now())
+    finally:
+        db.release_event(event.id, owner, session=session)
 
 def main_loop(context):
+    scheduler = poncho.scheduler.Scheduler(clock=datetime.now)
+    # The inventory thread feeds nova deltas to the annotation table and
+    # the HA group tracker, and wakes events whose hosts changed.
+    inventory = poncho.nova.inventory.inventory
+    annotation_sync = poncho.annotation_sync.AnnotationSync()
+    inventory.add_listener(annotation_sync.apply)
+    inventory.add_listener(poncho.hagroups.HaGroupTracker().update)
+    inventory.add_listener(lambda servers, full: scheduler.trigger_hosts(
+        set(poncho.nova.inventory.server_host(s) for s in servers)))
+    poncho.nova.inventory.InventorySync(
+        inventory, poncho.nova.client.Client()).start()
+    # Notifications are queued by workflows and delivered off the loop
+    poncho.dispatcher.DispatcherThread().start()
+    poncho.scheduler.TriggerListener(scheduler).start()
+    # Independent events tick concurrently; the runner reschedules each
+    # event when its tick finishes.
+    owner = poncho.leases.worker_identity()
+    runner = poncho.runner.EventRunner(
+        lambda event_id: run_event(event_id, scheduler, owner),
+        scheduler.reschedule)
+    poncho.leases.LeaseHeartbeat(owner, runner.in_flight).start()
+    if CONF.timings_report_interval > 0:
+        poncho.workflows.TimingsReporter().start()
+    scheduler.trigger()
     while True:
-        session = db.get_session() 
-        # Get service events that are not completed
-        events = db.get_events()
-        for event in events:
-            event = db.get_event_for_update(event.id, session)
-            print "Event %d state: %s..." % (event.id, event.state)
-            try:
-                workflow_name = event.workflow
-                workflow = poncho.workflows.get_workflow(workflow_name)
-                newstate = workflow().run(event, {})
-                if newstate:
-                    print "Event %d state: %s -> %s" % (event.id, event.state, newstate)
-                    event.state = newstate
-                else:
-                    print "Event %d state: %s -X" % (event.id, event.state)
-
-            #except Exception, e:
-            #    print "Event %d, exception: %s" % (event.id, e)
-            #    # TODO(scott): implement logging
-            #    pass
-            finally:
-                session.commit()
-        time.sleep(CONF.polling_interval)
+        max_sleep = min(CONF.scheduler_max_sleep, CONF.worker_tick_timeout)
+        (due, rescan) = scheduler.wait(max_sleep=max_sleep)
+        runner.check_timeouts()
+        if rescan:
+            # Pick up events created or changed behind our back; hosts
+            # come with the events in the same query.
+            with db.session_scope() as session:
+                for event in db.get_events(session=session):
+                    scheduler.watch(event.id, [h.name for h in event.hosts])
+                    due.append(event.id)
+        for event_id in set(due):
+            runner.submit(event_id)
 
 
 def main():
     context = None
+    poncho.db.migration.db_sync()
     main_loop(context)
 
 if __name__ == '__main__':
-    poncho.db.models.BASE.metadata.create_all(db.get_engine())
     main()
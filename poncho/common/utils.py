@@ -3,6 +3,8 @@
 poncho.common.utils : Utility Functions
 """
 from datetime import datetime
+import threading
+import time
 
 def readable_datetime(dt):
     """Turn a datetime into something readable, with time since or until."""
@@ -35,3 +37,49 @@ def readable_datetime(dt):
     if len(two_sizes):
         return "%s (%s %s)" % (dt, ", ".join(two_sizes), modifier)
     return "%s (right now)" % (dt) 
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter: refills at rate tokens per second and
+    holds at most capacity tokens. A rate of zero or less is unlimited."""
+    def __init__(self, rate, capacity=None, clock=time.time,
+                 sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self.tokens = self.capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_consume(self, tokens=1):
+        """Take tokens if available; returns the seconds to wait before
+        they would be, or 0 if they were taken."""
+        if self.rate <= 0:
+            return 0
+        with self._lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+    def consume(self, tokens=1):
+        """Block until tokens are available and take them."""
+        wait = self.try_consume(tokens)
+        while wait > 0:
+            self._sleep(wait)
+            wait = self.try_consume(tokens)
+
+    def refund(self, tokens=1):
+        """Give back tokens taken but not used."""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + tokens)
@@ -0,0 +1,152 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+"""
+Generator-based coroutines for workflow state functions.
+
+A state function may be written as a generator. Every value it yields is
+a Future, or a list of Futures, for blocking I/O started on the daemon's
+shared I/O pool; the generator is resumed with the result (or a list of
+results) once they complete, or has the exception thrown into it. Yielding
+a list overlaps all of its calls:
+
+    def state_active_drain(self, event, ctx):
+        servers = yield coroutines.call(nova.get_host_servers, host)
+        yield [coroutines.call(server.delete) for server in servers]
+        raise coroutines.Return("drained")
+
+The pool is bounded, so thousands of overlapping calls do not need a
+thread each.
+"""
+
+from oslo.config import cfg
+
+from multiprocessing.pool import ThreadPool
+import sys
+import threading
+
+opts = [
+    cfg.IntOpt('io_pool_size', default=32,
+        help='Threads in the shared pool running blocking I/O for '
+             'coroutine workflow states.'),
+]
+CONF = cfg.CONF
+CONF.register_opts(opts)
+
+
+class Return(Exception):
+    """Raised by a coroutine to return a value, since Python 2 generators
+    cannot return one."""
+    def __init__(self, value=None):
+        super(Return, self).__init__(value)
+        self.value = value
+
+
+class Future(object):
+    """Result of a call running on the I/O pool."""
+    def __init__(self, async_result):
+        self._async_result = async_result
+
+    def ready(self):
+        return self._async_result.ready()
+
+    def result(self, timeout=None):
+        """Block for the result, re-raising the call's exception."""
+        (ok, value) = self._async_result.get(timeout)
+        if ok:
+            return value
+        raise value[0], value[1], value[2]
+
+
+def _capture(fn, args, kwargs):
+    try:
+        return (True, fn(*args, **kwargs))
+    except Exception:
+        return (False, sys.exc_info())
+
+
+class IOLoop(object):
+    """Thread pool shared by every coroutine in the process."""
+    def __init__(self, size=None):
+        self.size = size or CONF.io_pool_size
+        self._pool = ThreadPool(self.size)
+
+    def call(self, fn, *args, **kwargs):
+        return Future(self._pool.apply_async(_capture, (fn, args, kwargs)))
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
+_LOOP = None
+_LOOP_LOCK = threading.Lock()
+
+
+def get_loop():
+    global _LOOP
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            _LOOP = IOLoop()
+    return _LOOP
+
+
+def call(fn, *args, **kwargs):
+    """Start fn(*args, **kwargs) on the shared I/O loop."""
+    return get_loop().call(fn, *args, **kwargs)
+
+
+class Async(object):
+    """Adapter turning every method call on obj into a Future, e.g.
+    Async(nova_client).get_host_servers(host) or
+    Async(nova_manage).service_disable_many(hosts, service)."""
+    def __init__(self, obj, loop=None):
+        self._obj = obj
+        self._loop = loop
+
+    def __getattr__(self, name):
+        fn = getattr(self._obj, name)
+        loop = self._loop or get_loop()
+
+        def start(*args, **kwargs):
+            return loop.call(fn, *args, **kwargs)
+        return start
+
+
+def _wait(yielded):
+    if isinstance(yielded, Future):
+        return yielded.result()
+    if isinstance(yielded, (list, tuple)):
+        # Let every call finish before raising the first failure
+        results = []
+        error = None
+        for future in yielded:
+            try:
+                results.append(future.result())
+            except Exception:
+                results.append(None)
+                error = error or sys.exc_info()
+        if error:
+            raise error[0], error[1], error[2]
+        return results
+    raise TypeError("Coroutines must yield Futures, got %r" % (yielded,))
+
+
+def run(gen):
+    """Drive a coroutine to completion and return its value."""
+    value = None
+    error = None
+    while True:
+        try:
+            if error:
+                yielded = gen.throw(*error)
+            else:
+                yielded = gen.send(value)
+        except StopIteration:
+            return None
+        except Return, r:
+            return r.value
+        try:
+            value = _wait(yielded)
+            error = None
+        except Exception:
+            value = None
+            error = sys.exc_info()
@@ -5,63 +5,241 @@ Database APIs for poncho
 from oslo.config import cfg
 
 from datetime import datetime, timedelta
+import collections
+import contextlib
+import threading
 
 import sqlalchemy
+import sqlalchemy.engine.url
+import sqlalchemy.event
+import sqlalchemy.exc
 import sqlalchemy.orm
+import sqlalchemy.pool
 
 from poncho.db.models import ServiceEvent, Host, Instance
+from poncho.db.models import host_association_table
+from poncho.db.models import InstanceAnnotation, QueuedNotification
 
 db_opts = [
     cfg.StrOpt('sql_connection', help='Database connection information.',
         default='sqlite:////Users/devoid/Desktop/test.sqlite'),
+    cfg.IntOpt('sql_pool_size', default=5,
+        help='Connections kept open to the database; ignored for sqlite.'),
+    cfg.IntOpt('sql_max_overflow', default=10,
+        help='Connections allowed beyond sql_pool_size under load.'),
+    cfg.IntOpt('sql_pool_timeout', default=30,
+        help='Seconds to wait for a free connection from the pool.'),
+    cfg.IntOpt('sql_pool_recycle', default=3600,
+        help='Seconds after which a pooled connection is reopened, to '
+             'stay ahead of server-side idle timeouts.'),
+    cfg.BoolOpt('sql_pre_ping', default=True,
+        help='Test pooled connections when they are checked out and '
+             'replace dead ones.'),
+    cfg.BoolOpt('sqlite_wal', default=True,
+        help='Use write-ahead logging with file-based sqlite, so readers '
+             'such as poncho-service do not block the worker.'),
+    cfg.IntOpt('sqlite_busy_timeout', default=5000,
+        help='Milliseconds sqlite waits on a locked database before '
+             'failing.'),
+    cfg.IntOpt('service_window_hours', default=24,
+        help='Hours a host is assumed to stay in service after its active '
+             'drain begins, when checking new events for overlaps.'),
  ]
 
 CONF = cfg.CONF
 CONF.register_opts(db_opts)
 _ENGINE = None
-_MAKER = None
+_ENGINE_LOCK = threading.Lock()
+# (autocommit, expire_on_commit) -> sessionmaker
+_MAKERS = {}
+_SCOPED_SESSION = None
+# Keep IN (...) clauses under sqlite's bound parameter limit
+_IN_CHUNK_SIZE = 500
+
+def _sqlite_on_connect(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA busy_timeout = %d" % (CONF.sqlite_busy_timeout))
+    if CONF.sqlite_wal:
+        cursor.execute("PRAGMA journal_mode = WAL")
+    cursor.close()
+
+def _ping_on_checkout(dbapi_connection, connection_record,
+                      connection_proxy):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    except Exception:
+        # The pool retries the checkout with a fresh connection
+        raise sqlalchemy.exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+def create_engine(connection):
+    url = sqlalchemy.engine.url.make_url(connection)
+    kwargs = {}
+    if url.drivername.startswith('sqlite'):
+        if url.database in (None, '', ':memory:'):
+            # Every thread must see the same in-memory database
+            kwargs = dict(poolclass=sqlalchemy.pool.StaticPool,
+                          connect_args={'check_same_thread': False})
+    else:
+        kwargs = dict(pool_size=CONF.sql_pool_size,
+                      max_overflow=CONF.sql_max_overflow,
+                      pool_timeout=CONF.sql_pool_timeout,
+                      pool_recycle=CONF.sql_pool_recycle)
+    engine = sqlalchemy.create_engine(connection, **kwargs)
+    if url.drivername.startswith('sqlite'):
+        sqlalchemy.event.listen(engine, 'connect', _sqlite_on_connect)
+    if CONF.sql_pre_ping:
+        sqlalchemy.event.listen(engine, 'checkout', _ping_on_checkout)
+    return engine
 
 def get_engine():
-    global _ENGINE
-    if _ENGINE is None:
-        _ENGINE = sqlalchemy.create_engine(CONF.sql_connection)
-        _ENGINE.connect()
-    return _ENGINE
+    global _ENGINE, _SCOPED_SESSION
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            _ENGINE = create_engine(CONF.sql_connection)
+            # Sessions made for a previous engine must not be reused
+            _MAKERS.clear()
+            _SCOPED_SESSION = None
+        return _ENGINE
 
 def make_sessionmaker(engine, autocommit, expire_on_commit):
     return sqlalchemy.orm.sessionmaker(
         bind=engine, autocommit=autocommit, expire_on_commit=expire_on_commit)
 
+def _get_maker(autocommit, expire_on_commit):
+    engine = get_engine()
+    with _ENGINE_LOCK:
+        key = (autocommit, expire_on_commit)
+        if key not in _MAKERS:
+            _MAKERS[key] = make_sessionmaker(engine, autocommit,
+                                             expire_on_commit)
+        return _MAKERS[key]
+
 def get_session(autocommit=False, expire_on_commit=False):
-    global _MAKER
-    if _MAKER is None:
-        engine = get_engine()
-        _MAKER = make_sessionmaker(engine, autocommit, expire_on_commit)
-    session = _MAKER()
-    return session
+    """Returns a new session; the caller is responsible for closing it."""
+    return _get_maker(autocommit, expire_on_commit)()
+
+def get_scoped_session():
+    """Returns the calling thread's session, used by API calls made
+    without one. Release it with remove_scoped_session() at the end of
+    each unit of work."""
+    global _SCOPED_SESSION
+    maker = _get_maker(False, False)
+    with _ENGINE_LOCK:
+        if _SCOPED_SESSION is None:
+            _SCOPED_SESSION = sqlalchemy.orm.scoped_session(maker)
+        return _SCOPED_SESSION()
+
+def remove_scoped_session():
+    """Close the calling thread's session and return its connection."""
+    if _SCOPED_SESSION is not None:
+        _SCOPED_SESSION.remove()
+
+@contextlib.contextmanager
+def session_scope():
+    """Yields the thread's session, rolling back on error and releasing
+    it afterwards."""
+    session = get_scoped_session()
+    try:
+        yield session
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        remove_scoped_session()
+
+class HostConflict(Exception):
+    """Hosts of a new event are in active events with overlapping drain
+    windows. conflicts maps host name to those events."""
+    def __init__(self, conflicts):
+        self.conflicts = conflicts
+
+    def __str__(self):
+        return "Hosts already in overlapping service events: %s" % (
+            ", ".join("%s (event %s)" % (host, ", ".join(
+                str(event.id) for event in events))
+                for (host, events) in sorted(self.conflicts.iteritems())))
 
 # The API
 
-def ensure_host(name, session=None):
+def ensure_hosts(names, session=None):
+    """Return the Host rows for names, in order, inserting missing ones.
+    Costs one SELECT per chunk of names, plus one multi-row INSERT and a
+    SELECT of the new rows if any were missing. If another writer inserts
+    one of the names first, the session's transaction is rolled back and
+    the rows are read again, so call this before making other changes."""
     if not session:
-        session = get_session()
-    q = session.query(Host).filter(Host.name != name)
-    if q.count() == 0:
-        host = Host(name=name)
-        session.add(host)
-        return host
-    else:
-        return q.first()
-        
+        session = get_scoped_session()
+    names = list(collections.OrderedDict.fromkeys(names))
+    while True:
+        hosts = {}
+        for chunk in _chunks(names):
+            for host in session.query(Host).filter(Host.name.in_(chunk)):
+                hosts.setdefault(host.name, host)
+        missing = [name for name in names if name not in hosts]
+        if not missing:
+            break
+        try:
+            session.execute(Host.__table__.insert(),
+                            [{'name': name} for name in missing])
+        except sqlalchemy.exc.IntegrityError:
+            # Lost a race with another writer for one of the names
+            session.rollback()
+            continue
+        for chunk in _chunks(missing):
+            for host in session.query(Host).filter(Host.name.in_(chunk)):
+                hosts.setdefault(host.name, host)
+        break
+    return [hosts[name] for name in names]
+
+def lock_hosts(hosts, session=None):
+    """Lock the rows of hosts until the session's transaction ends. Rows
+    are locked in id order so that concurrent callers cannot deadlock.
+    sqlite ignores SELECT ... FOR UPDATE, so there the rows are rewritten
+    in place instead, which takes the database write lock."""
+    if not session:
+        session = get_scoped_session()
+    table = Host.__table__
+    sqlite = session.get_bind(Host).dialect.name == 'sqlite'
+    for chunk in _chunks(sorted(host.id for host in hosts)):
+        if sqlite:
+            session.execute(table.update().where(table.c.id.in_(chunk)).
+                            values(name=table.c.name))
+        else:
+            session.query(Host).filter(Host.id.in_(chunk)).\
+                order_by(Host.id).with_lockmode('update').all()
+
+def ensure_host(name, session=None):
+    return ensure_hosts([name], session=session)[0]
+
 def create_event(args, session=None):
+    """Create a service event. Raises HostConflict if its hosts are in
+    active events with overlapping drain windows, unless args.force. With
+    args.dry the event is returned without being saved."""
     if not session:
-        session = get_session()
-    hosts = []
-    for name in args.hosts:
-        hosts.append(ensure_host(name, session=session))
+        session = get_scoped_session()
     now = datetime.now().replace(microsecond=0)
     passive_drain_time = now + timedelta(minutes=args.delay)
     active_drain_time = now + timedelta(minutes=args.notify)
+    if args.dry:
+        # A dry run writes nothing: its hosts are neither created nor
+        # locked, and the event is never added to the session.
+        hosts = [Host(name=name) for name
+                 in collections.OrderedDict.fromkeys(args.hosts)]
+    else:
+        hosts = ensure_hosts(args.hosts, session=session)
+        # Concurrent creates on the same hosts wait here until this one
+        # has committed, so they see its event in their own conflict check.
+        lock_hosts(hosts, session=session)
+    conflicts = find_host_conflicts(
+        args.hosts, passive_drain_time,
+        active_drain_time + timedelta(hours=CONF.service_window_hours),
+        session=session)
+    if conflicts and not getattr(args, 'force', False):
+        session.rollback()
+        raise HostConflict(conflicts)
     event = ServiceEvent(
         created_at = datetime.now(),
         description = args.description,
@@ -72,28 +250,478 @@ def create_event(args, session=None):
         state = 'initialized',
         hosts = hosts,
     )
-    if not args.dry:
+    if args.dry:
+        session.rollback()
+    else:
         session.add(event)
         session.commit()
     return event
 
 def get_event(event_id, session=None):
     if not session:
-        session = get_session()
+        session = get_scoped_session()
     return session.query(ServiceEvent).\
         filter(ServiceEvent.id == event_id).one()
 
 
 def get_event_for_update(event_id, session=None):
     if not session:
-        session = get_session()
+        session = get_scoped_session()
     return session.query(ServiceEvent).filter(ServiceEvent.id == event_id).\
             with_lockmode("update").one()
 
-# TODO(scott): make db.api.get_events filerable
-def get_events(session=None):
+def get_events_for_update(event_ids, session=None):
+    """Lock many events at once. Returns {id: ServiceEvent} with hosts
+    loaded; unknown ids are left out."""
+    if not session:
+        session = get_scoped_session()
+    events = {}
+    for chunk in _chunks(sorted(set(event_ids))):
+        query = session.query(ServiceEvent).\
+            options(sqlalchemy.orm.joinedload('hosts')).\
+            filter(ServiceEvent.id.in_(chunk)).\
+            order_by(ServiceEvent.id).\
+            with_lockmode("update")
+        for event in query:
+            events[event.id] = event
+    return events
+
+def claim_event(event_id, owner, duration, session=None):
+    """Take or extend the lease on an active event for owner. Succeeds if
+    the event is unleased, already leased by owner or its lease expired.
+    Returns True if owner now holds the lease."""
+    if not session:
+        session = get_scoped_session()
+    now = datetime.utcnow()
+    rows = session.query(ServiceEvent).\
+        filter(ServiceEvent.id == event_id).\
+        filter(ServiceEvent.completed == 0).\
+        filter(sqlalchemy.or_(ServiceEvent.lease_owner == None,
+                              ServiceEvent.lease_owner == owner,
+                              ServiceEvent.lease_expires_at < now)).\
+        update({'lease_owner': owner,
+                'lease_expires_at': now + duration},
+               synchronize_session=False)
+    session.commit()
+    return rows == 1
+
+
+def renew_leases(owner, event_ids, duration, session=None):
+    """Extend the leases owner still holds on event_ids. Returns the
+    number of leases renewed."""
+    if not session:
+        session = get_scoped_session()
+    expires = datetime.utcnow() + duration
+    renewed = 0
+    for chunk in _chunks(event_ids):
+        renewed += session.query(ServiceEvent).\
+            filter(ServiceEvent.id.in_(chunk)).\
+            filter(ServiceEvent.lease_owner == owner).\
+            update({'lease_expires_at': expires}, synchronize_session=False)
+    session.commit()
+    return renewed
+
+
+def release_event(event_id, owner, session=None):
+    if not session:
+        session = get_scoped_session()
+    session.query(ServiceEvent).\
+        filter(ServiceEvent.id == event_id).\
+        filter(ServiceEvent.lease_owner == owner).\
+        update({'lease_owner': None, 'lease_expires_at': None},
+               synchronize_session=False)
+    session.commit()
+
+
+def transition_event(event_id, owner, old_state, new_state, session=None,
+                     completed=False):
+    """Move an event from old_state to new_state, only if owner still holds
+    an unexpired lease and nobody moved the event first; with completed,
+    the event is marked completed as well. Returns True if the transition
+    was applied."""
+    if not session:
+        session = get_scoped_session()
+    values = {'state': new_state}
+    if completed:
+        values['completed'] = True
+        values['completed_at'] = datetime.now().replace(microsecond=0)
+    rows = session.query(ServiceEvent).\
+        filter(ServiceEvent.id == event_id).\
+        filter(ServiceEvent.state == old_state).\
+        filter(ServiceEvent.lease_owner == owner).\
+        filter(ServiceEvent.lease_expires_at >= datetime.utcnow()).\
+        update(values, synchronize_session=False)
+    session.commit()
+    return rows == 1
+
+def get_event_instances(event_id, session=None):
+    """Returns {uuid: Instance} progress rows of a service event."""
     if not session:
-        session = get_session()
+        session = get_scoped_session()
+    rows = session.query(Instance).\
+        filter(Instance.service_event_id == event_id).all()
+    return dict((row.uuid, row) for row in rows)
+
+
+def track_event_instances(event, servers, ledger, session=None):
+    """Add progress rows for servers not yet in ledger, as returned by
+    get_event_instances(). New rows are added to ledger as well."""
+    if not session:
+        session = get_scoped_session()
+    host_ids = dict((host.name, host.id) for host in event.hosts)
+    now = datetime.utcnow()
+    for (uuid, host) in servers:
+        if uuid in ledger:
+            continue
+        row = Instance(uuid=uuid, host_id=host_ids.get(host),
+                       service_event_id=event.id, state='pending',
+                       notified=False, updated_at=now)
+        session.add(row)
+        ledger[uuid] = row
+    return ledger
+
+def get_events(session=None, include_completed=False):
+    """Return service events with their hosts loaded in the same query;
+    only active events unless include_completed is set."""
+    if not session:
+        session = get_scoped_session()
+    query = session.query(ServiceEvent).\
+            options(sqlalchemy.orm.joinedload('hosts'))
+    if not include_completed:
+        query = query.filter(ServiceEvent.completed == 0)
+    return query.order_by(ServiceEvent.id).all()
+
+def _archivable_events(completed_before, session):
     return session.query(ServiceEvent).\
-            filter(ServiceEvent.completed == 0).all()
+        filter(ServiceEvent.completed == 1).\
+        filter(ServiceEvent.completed_at < completed_before)
+
+def count_archivable_events(completed_before, session=None):
+    if not session:
+        session = get_scoped_session()
+    return _archivable_events(completed_before, session).count()
+
+def get_active_events_for_hosts(host_names, exclude_event_id=None,
+                                session=None):
+    """Return {host name: [active ServiceEvent]} for the named hosts in
+    one join per chunk of names, through the host_id index of
+    service_events_to_hosts."""
+    if not session:
+        session = get_scoped_session()
+    assoc = host_association_table
+    events = {}
+    for chunk in _chunks(set(host_names)):
+        query = session.query(Host.name, ServiceEvent).select_from(Host).\
+            join(assoc, assoc.c.host_id == Host.id).\
+            join(ServiceEvent, ServiceEvent.id == assoc.c.service_event_id).\
+            filter(Host.name.in_(chunk)).\
+            filter(ServiceEvent.completed == 0)
+        if exclude_event_id is not None:
+            query = query.filter(ServiceEvent.id != exclude_event_id)
+        for (name, event) in query.order_by(ServiceEvent.id):
+            events.setdefault(name, []).append(event)
+    return events
+
+def event_window(event):
+    """(start, end) of the time an event keeps its hosts out of service.
+    The end is an estimate, service_window_hours after the active drain
+    begins."""
+    return (event.begin_passive_drain_at, event.begin_active_drain_at +
+            timedelta(hours=CONF.service_window_hours))
+
+def find_host_conflicts(host_names, start, end, exclude_event_id=None,
+                        session=None):
+    """Return {host name: [ServiceEvent]} of active events on the named
+    hosts whose window overlaps [start, end)."""
+    candidates = get_active_events_for_hosts(
+        host_names, exclude_event_id=exclude_event_id, session=session)
+    conflicts = {}
+    for (name, events) in candidates.iteritems():
+        overlapping = []
+        for event in events:
+            (event_start, event_end) = event_window(event)
+            if event_start < end and start < event_end:
+                overlapping.append(event)
+        if overlapping:
+            conflicts[name] = overlapping
+    return conflicts
+
+def get_releasable_hosts(event_id, session=None):
+    """Return the names of an event's hosts that are in no other active
+    event, and so may be put back into service once it completes."""
+    if not session:
+        session = get_scoped_session()
+    assoc = host_association_table
+    other = assoc.alias('other')
+    busy = sqlalchemy.sql.exists().where(sqlalchemy.and_(
+        other.c.host_id == Host.id,
+        other.c.service_event_id != event_id,
+        other.c.service_event_id == ServiceEvent.id,
+        ServiceEvent.completed == 0))
+    rows = session.query(Host.name).\
+        join(assoc, assoc.c.host_id == Host.id).\
+        filter(assoc.c.service_event_id == event_id).\
+        filter(~busy).order_by(Host.name)
+    return [name for (name,) in rows]
+
+def get_archivable_events(completed_before, limit, session=None):
+    """Return up to limit events completed before a datetime, oldest
+    first, with their hosts loaded."""
+    if not session:
+        session = get_scoped_session()
+    return _archivable_events(completed_before, session).\
+        options(sqlalchemy.orm.joinedload('hosts')).\
+        order_by(ServiceEvent.id).limit(limit).all()
+
+def get_instances_for_events(event_ids, session=None):
+    """Return {event_id: [Instance]} progress rows of many events."""
+    if not session:
+        session = get_scoped_session()
+    instances = {}
+    for chunk in _chunks(event_ids):
+        rows = session.query(Instance).\
+            filter(Instance.service_event_id.in_(chunk)).\
+            order_by(Instance.id)
+        for row in rows:
+            instances.setdefault(row.service_event_id, []).append(row)
+    return instances
 
+def delete_events(event_ids, session=None):
+    """Delete events with their host associations and instance rows, in
+    one transaction."""
+    if not session:
+        session = get_scoped_session()
+    deleted = 0
+    for chunk in _chunks(event_ids):
+        session.query(Instance).\
+            filter(Instance.service_event_id.in_(chunk)).\
+            delete(synchronize_session=False)
+        session.execute(host_association_table.delete().where(
+            host_association_table.c.service_event_id.in_(chunk)))
+        deleted += session.query(ServiceEvent).\
+            filter(ServiceEvent.id.in_(chunk)).\
+            delete(synchronize_session=False)
+    session.commit()
+    return deleted
+
+
+def _chunks(items, size=_IN_CHUNK_SIZE):
+    items = list(items)
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+def sync_annotations(annotations, session=None):
+    """Bring the annotation table in line with nova.
+
+    annotations maps instance uuid to a (tenant_id, {key: value}) tuple,
+    or to None if the instance was deleted. Only the rows for the supplied
+    instances are read and only the differences are written.
+    """
+    if not session:
+        session = get_scoped_session()
+    existing = {}
+    for chunk in _chunks(annotations.keys()):
+        rows = session.query(InstanceAnnotation).\
+            filter(InstanceAnnotation.instance_uuid.in_(chunk)).all()
+        for row in rows:
+            existing[(row.instance_uuid, row.key)] = row
+    now = datetime.utcnow()
+    for (uuid, annotated) in annotations.iteritems():
+        (tenant_id, values) = annotated or (None, {})
+        for (key, value) in values.iteritems():
+            row = existing.pop((uuid, key), None)
+            if row is None:
+                session.add(InstanceAnnotation(
+                    instance_uuid=uuid, tenant_id=tenant_id, key=key,
+                    value=value, updated_at=now))
+            elif row.value != value or row.tenant_id != tenant_id:
+                row.value = value
+                row.tenant_id = tenant_id
+                row.updated_at = now
+    # Anything left over was removed from nova
+    for row in existing.itervalues():
+        session.delete(row)
+    session.commit()
+
+
+def prune_annotations(instance_uuids, session=None):
+    """Delete annotations of every instance not in instance_uuids."""
+    if not session:
+        session = get_scoped_session()
+    keep = set(instance_uuids)
+    stored = session.query(InstanceAnnotation.instance_uuid).distinct().all()
+    stale = [row.instance_uuid for row in stored
+             if row.instance_uuid not in keep]
+    for chunk in _chunks(stale):
+        session.query(InstanceAnnotation).\
+            filter(InstanceAnnotation.instance_uuid.in_(chunk)).\
+            delete(synchronize_session=False)
+    session.commit()
+
+
+def get_instance_annotations(instance_uuid, session=None):
+    if not session:
+        session = get_scoped_session()
+    rows = session.query(InstanceAnnotation).\
+        filter(InstanceAnnotation.instance_uuid == instance_uuid).all()
+    return dict((row.key, row.value) for row in rows)
+
+
+def get_annotated_instances(key, value, session=None):
+    """Return the uuids of instances annotated with key=value."""
+    if not session:
+        session = get_scoped_session()
+    rows = session.query(InstanceAnnotation.instance_uuid).\
+        filter(InstanceAnnotation.key == key).\
+        filter(InstanceAnnotation.value == value).all()
+    return [row.instance_uuid for row in rows]
+
+
+def get_ha_group_instances(ha_group_id, session=None):
+    return get_annotated_instances('ha_group_id', ha_group_id,
+                                   session=session)
+
+
+def get_annotations_for_instances(uuids, keys=None, session=None):
+    """Return {instance_uuid: {key: value}} for many instances at once,
+    optionally limited to keys. Unannotated instances are left out."""
+    if not session:
+        session = get_scoped_session()
+    annotations = {}
+    for chunk in _chunks(uuids):
+        query = session.query(InstanceAnnotation.instance_uuid,
+                              InstanceAnnotation.key,
+                              InstanceAnnotation.value).\
+            filter(InstanceAnnotation.instance_uuid.in_(chunk))
+        if keys is not None:
+            query = query.filter(InstanceAnnotation.key.in_(list(keys)))
+        for (uuid, key, value) in query:
+            annotations.setdefault(uuid, {})[key] = value
+    return annotations
+
+
+def get_ha_group_sizes(groups, session=None):
+    """Return {(tenant_id, ha_group_id): number of instances in the group}
+    for a list of (tenant_id, ha_group_id) pairs."""
+    if not session:
+        session = get_scoped_session()
+    groups = set(groups)
+    sizes = {}
+    for chunk in _chunks(list(set(group_id for (_, group_id) in groups))):
+        rows = session.query(InstanceAnnotation.tenant_id,
+                             InstanceAnnotation.value,
+                             sqlalchemy.func.count()).\
+            filter(InstanceAnnotation.key == 'ha_group_id').\
+            filter(InstanceAnnotation.value.in_(chunk)).\
+            group_by(InstanceAnnotation.tenant_id,
+                     InstanceAnnotation.value).all()
+        for (tenant_id, group_id, count) in rows:
+            if (tenant_id, group_id) in groups:
+                sizes[(tenant_id, group_id)] = count
+    return sizes
+
+
+def get_tenant_annotations(tenant_id, key, session=None):
+    """Return {instance_uuid: value} for a key across a tenant."""
+    if not session:
+        session = get_scoped_session()
+    rows = session.query(InstanceAnnotation.instance_uuid,
+                         InstanceAnnotation.value).\
+        filter(InstanceAnnotation.tenant_id == tenant_id).\
+        filter(InstanceAnnotation.key == key).all()
+    return dict(rows)
+
+
+def get_tenant_notify_urls(tenant_id, session=None):
+    return set(get_tenant_annotations(tenant_id, 'notify_url',
+                                      session=session).values())
+
+
+def enqueue_notification(transport, destination, payload, dedup_key,
+                         subject=None, deliver_after=None, session=None):
+    """Queue a notification for delivery. Returns the queued row, or None
+    if a notification with the same dedup_key was already queued."""
+    if not session:
+        session = get_scoped_session()
+    exists = session.query(QueuedNotification.id).\
+        filter(QueuedNotification.dedup_key == dedup_key).first()
+    if exists:
+        return None
+    now = datetime.utcnow()
+    row = QueuedNotification(
+        created_at=now, transport=transport, destination=destination,
+        subject=subject, payload=payload, dedup_key=dedup_key,
+        status='pending', attempts=0,
+        next_attempt_at=deliver_after or now)
+    session.add(row)
+    try:
+        session.commit()
+    except sqlalchemy.exc.IntegrityError:
+        # Lost a race with another writer for the same dedup_key
+        session.rollback()
+        return None
+    return row
+
+
+def get_pending_delivery_time(transport, destination, session=None):
+    """Earliest delivery time of pending notifications to destination."""
+    if not session:
+        session = get_scoped_session()
+    return session.query(sqlalchemy.func.min(
+            QueuedNotification.next_attempt_at)).\
+        filter(QueuedNotification.status == 'pending').\
+        filter(QueuedNotification.transport == transport).\
+        filter(QueuedNotification.destination == destination).scalar()
+
+
+def get_due_notifications(limit=100, now=None, session=None):
+    if not session:
+        session = get_scoped_session()
+    now = now or datetime.utcnow()
+    return session.query(QueuedNotification).\
+        filter(QueuedNotification.status == 'pending').\
+        filter(QueuedNotification.next_attempt_at <= now).\
+        order_by(QueuedNotification.next_attempt_at).\
+        limit(limit).all()
+
+
+def mark_notifications_delivered(ids, session=None):
+    if not session:
+        session = get_scoped_session()
+    now = datetime.utcnow()
+    for chunk in _chunks(ids):
+        session.query(QueuedNotification).\
+            filter(QueuedNotification.id.in_(chunk)).\
+            update({'status': 'delivered', 'delivered_at': now},
+                   synchronize_session=False)
+    session.commit()
+
+
+def mark_notification_failed(notification_id, error, retry_at=None,
+                             session=None):
+    """Record a failed attempt. The notification is retried at retry_at,
+    or given up on if retry_at is None."""
+    if not session:
+        session = get_scoped_session()
+    values = {'attempts': QueuedNotification.attempts + 1,
+              'last_error': error}
+    if retry_at is None:
+        values['status'] = 'failed'
+    else:
+        values['next_attempt_at'] = retry_at
+    session.query(QueuedNotification).\
+        filter(QueuedNotification.id == notification_id).\
+        update(values, synchronize_session=False)
+    session.commit()
+
+
+def defer_notifications(ids, until, session=None):
+    """Push back delivery without counting an attempt."""
+    if not session:
+        session = get_scoped_session()
+    for chunk in _chunks(ids):
+        session.query(QueuedNotification).\
+            filter(QueuedNotification.id.in_(chunk)).\
+            update({'next_attempt_at': until}, synchronize_session=False)
+    session.commit()
@@ -0,0 +1,46 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+"""
+Schema migrations for the poncho database, run through alembic.
+"""
+
+from alembic import command
+from alembic.config import Config
+from alembic.migration import MigrationContext
+from alembic.script import ScriptDirectory
+import os
+
+from poncho.db import api as db
+
+# Schema that metadata.create_all() produced before migrations existed
+INITIAL_REVISION = '3f2a1c9b8e4d'
+
+
+def get_config():
+    path = os.path.join(os.path.dirname(__file__), 'alembic.ini')
+    config = Config(path)
+    config.set_main_option('script_location', os.path.join(
+        os.path.dirname(__file__), 'migrations'))
+    return config
+
+
+def db_version():
+    """Revision the database is at, or None if it is not versioned."""
+    connection = db.get_engine().connect()
+    try:
+        return MigrationContext.configure(connection).get_current_revision()
+    finally:
+        connection.close()
+
+
+def head_version():
+    return ScriptDirectory.from_config(get_config()).get_current_head()
+
+
+def db_sync(version=None):
+    """Upgrade the database to version, or to the latest revision."""
+    config = get_config()
+    engine = db.get_engine()
+    if db_version() is None and engine.has_table('service_events'):
+        # Tables made by create_all(); record them as the initial schema
+        command.stamp(config, INITIAL_REVISION)
+    command.upgrade(config, version or 'head')
@@ -0,0 +1,37 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+"""
+Alembic environment for poncho. Migrations run on the engine configured
+by sql_connection, see poncho.db.api.get_engine.
+"""
+from __future__ import with_statement
+
+from alembic import context
+
+from poncho.db import api as db
+from poncho.db import models
+
+config = context.config
+target_metadata = models.BASE.metadata
+
+
+def run_migrations_offline():
+    context.configure(url=db.CONF.sql_connection,
+                      target_metadata=target_metadata)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online():
+    connection = db.get_engine().connect()
+    context.configure(connection=connection,
+                      target_metadata=target_metadata)
+    try:
+        with context.begin_transaction():
+            context.run_migrations()
+    finally:
+        connection.close()
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,58 @@
+"""Initial schema
+
+Revision ID: 3f2a1c9b8e4d
+Revises: None
+Create Date: 2026-10-18 12:00:00
+
+Databases created with metadata.create_all() before migrations existed
+are stamped with this revision by poncho.db.migration.db_sync.
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f2a1c9b8e4d'
+down_revision = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'service_events',
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('created_at', sa.DateTime),
+        sa.Column('description', sa.Text, nullable=False),
+        sa.Column('notes', sa.Text, nullable=False),
+        sa.Column('workflow', sa.String, nullable=False),
+        sa.Column('begin_passive_drain_at', sa.DateTime, nullable=False),
+        sa.Column('begin_active_drain_at', sa.DateTime, nullable=False),
+        sa.Column('state', sa.String),
+        sa.Column('completed', sa.Boolean),
+        sa.Column('completed_at', sa.DateTime),
+    )
+    op.create_table(
+        'hosts',
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('name', sa.String, nullable=False),
+    )
+    op.create_table(
+        'service_events_to_hosts',
+        sa.Column('service_event_id', sa.Integer,
+                  sa.ForeignKey('service_events.id')),
+        sa.Column('host_id', sa.Integer, sa.ForeignKey('hosts.id')),
+    )
+    op.create_table(
+        'instance',
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('uuid', sa.String),
+        sa.Column('notified', sa.Boolean),
+        sa.Column('notified_at', sa.DateTime),
+        sa.Column('host_id', sa.Integer, sa.ForeignKey('hosts.id')),
+    )
+
+
+def downgrade():
+    op.drop_table('instance')
+    op.drop_table('service_events_to_hosts')
+    op.drop_table('hosts')
+    op.drop_table('service_events')
@@ -0,0 +1,62 @@
+"""Indexes for the worker's hot queries and unique host names
+
+Revision ID: 5b8d0e7c4a19
+Revises: 9e6c2d4b7a51
+Create Date: 2026-10-18 12:30:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b8d0e7c4a19'
+down_revision = '9e6c2d4b7a51'
+
+from alembic import op
+import sqlalchemy as sa
+
+# Keyed by dialect; MySQL has no partial indexes and relies on
+# ix_service_events_completed_state instead.
+ACTIVE_EVENTS_INDEX = {
+    'postgresql': "CREATE INDEX ix_service_events_active "
+                  "ON service_events (id) WHERE completed = false",
+    'sqlite': "CREATE INDEX ix_service_events_active "
+              "ON service_events (id) WHERE completed = 0",
+}
+
+
+def _merge_duplicate_hosts():
+    # ensure_host() used to return the wrong host and create duplicates;
+    # point every reference at the lowest id of each name first.
+    for table in ('service_events_to_hosts', 'instance'):
+        op.execute(
+            "UPDATE %(table)s SET host_id = ("
+            "SELECT MIN(h2.id) FROM hosts h1, hosts h2 "
+            "WHERE h1.id = %(table)s.host_id AND h2.name = h1.name) "
+            "WHERE host_id IS NOT NULL" % {'table': table})
+    op.execute(
+        "DELETE FROM hosts WHERE id NOT IN ("
+        "SELECT id FROM (SELECT MIN(id) AS id FROM hosts GROUP BY name) "
+        "AS keep)")
+
+
+def upgrade():
+    _merge_duplicate_hosts()
+    op.create_index('uq_hosts_name', 'hosts', ['name'], unique=True)
+    op.create_index('ix_service_events_completed_state', 'service_events',
+                    ['completed', 'state'])
+    op.create_index('ix_service_events_to_hosts_host',
+                    'service_events_to_hosts',
+                    ['host_id', 'service_event_id'])
+    op.create_index('ix_instance_uuid', 'instance', ['uuid'])
+    dialect = op.get_bind().dialect.name
+    if dialect in ACTIVE_EVENTS_INDEX:
+        op.execute(ACTIVE_EVENTS_INDEX[dialect])
+
+
+def downgrade():
+    if op.get_bind().dialect.name in ACTIVE_EVENTS_INDEX:
+        op.drop_index('ix_service_events_active', 'service_events')
+    op.drop_index('ix_instance_uuid', 'instance')
+    op.drop_index('ix_service_events_to_hosts_host',
+                  'service_events_to_hosts')
+    op.drop_index('ix_service_events_completed_state', 'service_events')
+    op.drop_index('uq_hosts_name', 'hosts')
@@ -0,0 +1,80 @@
+"""Event leases, per-instance progress, annotations and notification queue
+
+Revision ID: 9e6c2d4b7a51
+Revises: 3f2a1c9b8e4d
+Create Date: 2026-10-18 12:15:00
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9e6c2d4b7a51'
+down_revision = '3f2a1c9b8e4d'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('service_events', sa.Column('lease_owner', sa.String(255)))
+    op.add_column('service_events', sa.Column('lease_expires_at',
+                                              sa.DateTime))
+    op.add_column('instance', sa.Column('service_event_id', sa.Integer))
+    if op.get_bind().dialect.name != 'sqlite':
+        # sqlite cannot add constraints to an existing table; written out
+        # because op.create_foreign_key needs a newer SQLAlchemy
+        op.execute("ALTER TABLE instance ADD CONSTRAINT "
+                   "fk_instance_service_event_id FOREIGN KEY "
+                   "(service_event_id) REFERENCES service_events (id)")
+    op.add_column('instance', sa.Column('state', sa.String(16)))
+    op.add_column('instance', sa.Column('updated_at', sa.DateTime))
+    op.create_index('uq_instance_event_uuid', 'instance',
+                    ['service_event_id', 'uuid'], unique=True)
+    op.create_table(
+        'instance_annotations',
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('instance_uuid', sa.String(36), nullable=False),
+        sa.Column('tenant_id', sa.String(255)),
+        sa.Column('key', sa.String(255), nullable=False),
+        sa.Column('value', sa.String(255), nullable=False),
+        sa.Column('updated_at', sa.DateTime),
+        sa.UniqueConstraint('instance_uuid', 'key',
+                            name='uq_instance_annotations_uuid_key'),
+    )
+    op.create_index('ix_instance_annotations_key_value',
+                    'instance_annotations', ['key', 'value'])
+    op.create_index('ix_instance_annotations_tenant_key',
+                    'instance_annotations', ['tenant_id', 'key'])
+    op.create_table(
+        'notification_queue',
+        sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column('created_at', sa.DateTime),
+        sa.Column('transport', sa.String(16), nullable=False),
+        sa.Column('destination', sa.String(255), nullable=False),
+        sa.Column('subject', sa.String(255)),
+        sa.Column('payload', sa.Text, nullable=False),
+        sa.Column('dedup_key', sa.String(64), nullable=False),
+        sa.Column('status', sa.String(16), nullable=False),
+        sa.Column('attempts', sa.Integer, nullable=False),
+        sa.Column('next_attempt_at', sa.DateTime, nullable=False),
+        sa.Column('last_error', sa.Text),
+        sa.Column('delivered_at', sa.DateTime),
+        sa.UniqueConstraint('dedup_key',
+                            name='uq_notification_queue_dedup_key'),
+    )
+    op.create_index('ix_notification_queue_status_next',
+                    'notification_queue', ['status', 'next_attempt_at'])
+
+
+def downgrade():
+    op.drop_table('notification_queue')
+    op.drop_table('instance_annotations')
+    op.drop_index('uq_instance_event_uuid', 'instance')
+    # sqlite cannot drop columns; the added ones are left in place there
+    if op.get_bind().dialect.name != 'sqlite':
+        op.drop_constraint('fk_instance_service_event_id', 'instance',
+                           type_='foreignkey')
+        op.drop_column('instance', 'updated_at')
+        op.drop_column('instance', 'state')
+        op.drop_column('instance', 'service_event_id')
+        op.drop_column('service_events', 'lease_expires_at')
+        op.drop_column('service_events', 'lease_owner')
@@ -15,13 +15,19 @@ host_association_table = Table(
     'service_events_to_hosts', BASE.metadata,
     Column('service_event_id', Integer, ForeignKey('service_events.id')),
     Column('host_id', Integer, ForeignKey('hosts.id')),
+    # Events of a host, for conflict checks and re-enabling hosts
+    Index('ix_service_events_to_hosts_host', 'host_id', 'service_event_id'),
 )
 
 
 class ServiceEvent(BASE):
     """Represents a single service event."""
     __tablename__ = 'service_events'
-    __table_args__ = ()
+    # The migrations also add ix_service_events_active, a partial index on
+    # id for completed = 0, where the database supports it.
+    __table_args__ = (
+        Index('ix_service_events_completed_state', 'completed', 'state'),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     created_at = Column(DateTime, default=datetime.utcnow())
     description = Column(Text, nullable=False)
@@ -32,6 +38,10 @@ class ServiceEvent(BASE):
     state = Column(String, default='initialized')
     completed = Column(Boolean, default=False)
     completed_at = Column(DateTime)
+    # Worker currently allowed to run the event's workflow, see
+    # poncho.db.api.claim_event
+    lease_owner = Column(String(255))
+    lease_expires_at = Column(DateTime)
     hosts = relationship("Host", secondary=host_association_table,
                          backref="service_events")
 
@@ -40,7 +50,9 @@ class ServiceEvent(BASE):
 class Host(BASE):
     """Represents a single host on the system."""
     __tablename__ = 'hosts'
-    __table_args__ = ()
+    __table_args__ = (
+        Index('uq_hosts_name', 'name', unique=True),
+    )
     # Note that all status is gathered from the nova APIs.
     # This just maintains relationships with the service event table; when
     # a service event is completed, the host should only be reactivated if
@@ -51,10 +63,74 @@ class Host(BASE):
         
 
 class Instance(BASE):
-    """Represents the status of instance notifications and operations."""
+    """Represents the status of instance notifications and operations.
+
+    One row per instance per service event, so a restarted worker knows
+    which instances were already notified or acted on.
+    """
     __tablename__ = 'instance'
+    __table_args__ = (
+        # An index rather than a constraint so that the migrations can add
+        # it to existing tables on sqlite
+        Index('uq_instance_event_uuid', 'service_event_id', 'uuid',
+              unique=True),
+        Index('ix_instance_uuid', 'uuid'),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     uuid = Column(String)
     notified = Column(Boolean, default=False)
     notified_at = Column(DateTime)
     host_id = Column(Integer, ForeignKey('hosts.id'))
+    service_event_id = Column(Integer, ForeignKey('service_events.id'))
+    # pending -> notified -> acting -> done; 'gone' if it left the host
+    # without poncho acting on it. restart-instances moves done rows to
+    # 'restarted' once it starts them again.
+    state = Column(String(16), default='pending')
+    updated_at = Column(DateTime)
+
+
+class InstanceAnnotation(BASE):
+    """Local copy of an annotation from nova instance metadata.
+
+    Kept in sync by poncho.annotation_sync so that lookups by HA group,
+    priority or tenant are indexed queries instead of nova listings.
+    """
+    __tablename__ = 'instance_annotations'
+    __table_args__ = (
+        schema.UniqueConstraint('instance_uuid', 'key',
+                                name='uq_instance_annotations_uuid_key'),
+        # Serves key = 'ha_group_id' / 'priority' / ... value lookups
+        Index('ix_instance_annotations_key_value', 'key', 'value'),
+        Index('ix_instance_annotations_tenant_key', 'tenant_id', 'key'),
+    )
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    instance_uuid = Column(String(36), nullable=False)
+    tenant_id = Column(String(255))
+    key = Column(String(255), nullable=False)
+    value = Column(String(255), nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class QueuedNotification(BASE):
+    """An outbound notification waiting for, or done with, delivery."""
+    __tablename__ = 'notification_queue'
+    __table_args__ = (
+        schema.UniqueConstraint('dedup_key',
+                                name='uq_notification_queue_dedup_key'),
+        Index('ix_notification_queue_status_next', 'status',
+              'next_attempt_at'),
+    )
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # 'http' posts payload as JSON to a URL, 'email' mails it to an address
+    transport = Column(String(16), nullable=False)
+    destination = Column(String(255), nullable=False)
+    subject = Column(String(255))
+    payload = Column(Text, nullable=False)
+    dedup_key = Column(String(64), nullable=False)
+    # pending -> delivered | failed
+    status = Column(String(16), nullable=False, default='pending')
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    last_error = Column(Text)
+    delivered_at = Column(DateTime)
@@ -0,0 +1,132 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+"""
+Delivery of queued notifications.
+
+Notification.send() only writes to the notification_queue table. The
+dispatcher drains due entries on a thread pool, one worker per endpoint,
+and reschedules failures with exponential backoff. Endpoints that accept
+batches get all of their due entries in a single delivery.
+"""
+
+from oslo.config import cfg
+
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+import sys
+import threading
+
+from poncho.db import api as db
+from poncho import notifications
+
+dispatch_opts = [
+    cfg.IntOpt('dispatch_concurrency', default=4,
+        help='Number of endpoints notifications are delivered to at once.'),
+    cfg.IntOpt('dispatch_batch_size', default=200,
+        help='Maximum number of queued notifications handled per pass.'),
+    cfg.IntOpt('dispatch_interval', default=5,
+        help='Seconds between passes over the notification queue.'),
+    cfg.IntOpt('dispatch_max_attempts', default=8,
+        help='Give up on a notification after this many failed attempts.'),
+    cfg.IntOpt('dispatch_backoff_base', default=30,
+        help='Seconds before the first retry; doubled on each attempt.'),
+    cfg.IntOpt('dispatch_backoff_max', default=3600,
+        help='Upper bound in seconds on the retry delay.'),
+]
+CONF = cfg.CONF
+for opt in dispatch_opts:
+    CONF.register_opt(opt, group='notify')
+
+
+def backoff(attempts):
+    """Delay before retrying a notification that has failed attempts
+    times, or None if it should not be retried."""
+    if attempts >= CONF.notify.dispatch_max_attempts:
+        return None
+    delay = CONF.notify.dispatch_backoff_base * (2 ** (attempts - 1))
+    return timedelta(seconds=min(delay, CONF.notify.dispatch_backoff_max))
+
+
+class NotificationDispatcher(object):
+    def __init__(self, transports=None, concurrency=None, batcher=None):
+        self.transports = transports or notifications.DELIVERY_TRANSPORTS
+        self.batcher = batcher or notifications.batch_delivery
+        self.concurrency = concurrency or CONF.notify.dispatch_concurrency
+        self.pool = ThreadPool(self.concurrency)
+
+    def _deliver_endpoint(self, items):
+        """Deliver one endpoint's items in order, stopping at the first
+        failure. Returns (delivered ids, failed item, error, skipped ids).
+        Runs on the pool, so it must not touch the database."""
+        batch = None
+        if len(items) > 1:
+            batch = self.batcher(items[0].transport, items[0].destination)
+        if batch is not None:
+            try:
+                batch(items)
+            except Exception, e:
+                return ([], items[0], e, [other.id for other in items[1:]])
+            return ([item.id for item in items], None, None, [])
+        delivered = []
+        for (i, item) in enumerate(items):
+            try:
+                self.transports[item.transport](item)
+            except Exception, e:
+                skipped = [other.id for other in items[i + 1:]]
+                return (delivered, item, e, skipped)
+            delivered.append(item.id)
+        return (delivered, None, None, [])
+
+    def dispatch_once(self):
+        """Deliver every due notification. Returns the number delivered."""
+        session = db.get_session()
+        try:
+            due = db.get_due_notifications(
+                limit=CONF.notify.dispatch_batch_size, session=session)
+            endpoints = {}
+            for item in due:
+                key = (item.transport, item.destination)
+                endpoints.setdefault(key, []).append(item)
+            results = self.pool.map(self._deliver_endpoint,
+                                     endpoints.values())
+            return self._record(results, session)
+        finally:
+            session.close()
+
+    def _record(self, results, session):
+        now = datetime.utcnow()
+        delivered = []
+        for (ok, failed, error, skipped) in results:
+            delivered.extend(ok)
+            if failed is None:
+                continue
+            delay = backoff(failed.attempts + 1)
+            retry_at = now + delay if delay is not None else None
+            db.mark_notification_failed(failed.id, str(error),
+                                        retry_at=retry_at, session=session)
+            # The endpoint is down; hold its other items back as well
+            if skipped:
+                db.defer_notifications(skipped, retry_at or now,
+                                       session=session)
+        if delivered:
+            db.mark_notifications_delivered(delivered, session=session)
+        return len(delivered)
+
+
+class DispatcherThread(threading.Thread):
+    """Runs a NotificationDispatcher in the background of the worker."""
+    def __init__(self, dispatcher=None):
+        super(DispatcherThread, self).__init__(name='notification-dispatch')
+        self.daemon = True
+        self.dispatcher = dispatcher or NotificationDispatcher()
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                self.dispatcher.dispatch_once()
+            except Exception, e:
+                print >>sys.stderr, "Notification dispatch failed: %s" % (e)
+            self._stopping.wait(CONF.notify.dispatch_interval)
@@ -0,0 +1,141 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+"""
+Batch evaluation of compiled constraint programs across many instances.
+
+Rather than calling is_valid() on every constraint of every instance, each
+distinct ConstraintProgram is reduced once to a set of numeric terms and the
+per-instance comparisons are done over NumPy arrays of epoch seconds.
+"""
+
+from datetime import datetime
+import calendar
+import collections
+import threading
+
+import numpy
+
+from poncho import annotations
+
+_SECONDS_PER_DAY = 86400
+
+
+class ProgramTerms(collections.namedtuple(
+        'ProgramTerms', ['min_runtime', 'notified', 'windows'])):
+    """Numeric reduction of a ConstraintProgram.
+
+    min_runtime: seconds the instance must have run, or None.
+    notified: seconds since notification required, or None.
+    windows: tuple of (start, stop, tz) TimeOfDay windows in seconds.
+    """
+    __slots__ = ()
+
+
+# LRU of ConstraintProgram -> ProgramTerms, bounded like the programs
+# themselves are in ConstraintSet.compile
+_TERMS = collections.OrderedDict()
+_TERMS_LOCK = threading.Lock()
+_TERMS_SIZE = annotations.ConstraintSet.cache_size
+
+
+def _seconds(timedelta):
+    return timedelta.days * _SECONDS_PER_DAY + timedelta.seconds
+
+
+def program_terms(program):
+    """Return the ProgramTerms for a ConstraintProgram, memoized."""
+    with _TERMS_LOCK:
+        terms = _TERMS.pop(program, None)
+        if terms is not None:
+            _TERMS[program] = terms
+            return terms
+    min_runtime = None
+    notified = None
+    windows = []
+    for constraint in program:
+        if isinstance(constraint, annotations.MinRuntimeConstraint):
+            min_runtime = max(min_runtime, _seconds(constraint.duration))
+        elif isinstance(constraint, annotations.NotifiedConstraint):
+            notified = max(notified, _seconds(constraint.duration))
+        elif isinstance(constraint, annotations.TimeOfDayConstraint):
+            windows.append(constraint.window_seconds())
+        else:
+            raise TypeError("No batch evaluation for %s" %
+                            (constraint.__class__.__name__))
+    terms = ProgramTerms(min_runtime, notified, tuple(windows))
+    with _TERMS_LOCK:
+        _TERMS[program] = terms
+        while len(_TERMS) > _TERMS_SIZE:
+            _TERMS.popitem(last=False)
+    return terms
+
+
+def to_epoch(dt):
+    """Convert a naive UTC datetime to epoch seconds; None becomes NaN."""
+    if dt is None:
+        return numpy.nan
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+def epoch_array(values):
+    """Return a float array of epoch seconds from datetimes or numbers."""
+    if isinstance(values, numpy.ndarray):
+        return values.astype(numpy.float64)
+    return numpy.array([v if isinstance(v, (int, long, float)) else
+                        to_epoch(v) for v in values], dtype=numpy.float64)
+
+
+def in_window(window, now):
+    """True if the epoch time now falls inside a (start, stop, tz) window.
+    Matches TimeOfDayConstraint.is_valid, including midnight wrap-around."""
+    (start, stop, tz) = window
+    t = (now + tz) % _SECONDS_PER_DAY
+    if start > stop:
+        return start < t or t < stop
+    return start < t < stop
+
+
+def evaluate(programs, launched_at, notified_at, now=None):
+    """Return a boolean eligibility mask for N instances.
+
+    programs: sequence of N ConstraintPrograms.
+    launched_at, notified_at: sequences of N naive UTC datetimes (or None)
+        or arrays of epoch seconds (NaN for unknown).
+    now: datetime used for all instances, defaults to utcnow().
+    """
+    n = len(programs)
+    if now is None:
+        now = datetime.utcnow()
+    now = to_epoch(now)
+    launched = epoch_array(launched_at)
+    notified = epoch_array(notified_at)
+    if len(launched) != n or len(notified) != n:
+        raise ValueError("programs, launched_at and notified_at must be "
+                         "the same length")
+
+    # Assign each instance the index of its distinct program
+    index = {}
+    idx = numpy.fromiter((index.setdefault(p, len(index)) for p in programs),
+                         dtype=numpy.intp, count=n)
+    unique = sorted(index, key=index.get)
+    terms = [program_terms(p) for p in unique]
+
+    # Per-program thresholds; TimeOfDay only depends on now so it is
+    # decided once per program rather than once per instance.
+    need_runtime = numpy.array([t.min_runtime is not None for t in terms],
+                               dtype=bool)
+    min_runtime = numpy.array([t.min_runtime or 0 for t in terms],
+                              dtype=numpy.float64)
+    need_notify = numpy.array([t.notified is not None for t in terms],
+                              dtype=bool)
+    min_notify = numpy.array([t.notified or 0 for t in terms],
+                             dtype=numpy.float64)
+    time_ok = numpy.array([all(in_window(w, now) for w in t.windows)
+                           for t in terms], dtype=bool)
+
+    with numpy.errstate(invalid='ignore'):
+        runtime_ok = (now - launched) >= min_runtime[idx]
+        notify_ok = (now - notified) >= min_notify[idx]
+    mask = time_ok[idx]
+    mask &= ~need_runtime[idx] | runtime_ok
+    mask &= ~need_notify[idx] | notify_ok
+    return mask
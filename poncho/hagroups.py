@@ -0,0 +1,151 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+"""
+HA group health, tracked incrementally from nova server deltas.
+
+Each group keeps the set of its active members and a count of the
+ha_group_min values its members ask for, so a batch of changed servers
+only touches the groups those servers belong to. A group is healthy while
+at least ha_group_min members are ACTIVE; notifications are sent only
+when a group crosses that threshold.
+"""
+
+from datetime import datetime
+import sys
+import threading
+
+from poncho import annotations
+from poncho import notifications
+
+
+class HaGroup(object):
+    def __init__(self, tenant_id, group_id):
+        self.tenant_id = tenant_id
+        self.group_id = group_id
+        self.members = set()
+        self.active = set()
+        # ha_group_min value -> number of members asking for it
+        self.mins = {}
+        self.healthy = None
+
+    def minimum(self):
+        return max(self.mins) if self.mins else None
+
+    def is_healthy(self):
+        minimum = self.minimum()
+        if minimum is None:
+            return True
+        return len(self.active) >= minimum
+
+
+class HaGroupTracker(object):
+    """Per-group membership and active counts of the whole fleet. Feed it
+    with apply(servers, full) from the inventory; it returns the groups
+    that became degraded or healthy."""
+    def __init__(self, grammar=annotations.default, send=True):
+        self.grammar = grammar
+        self.send = send
+        self._lock = threading.Lock()
+        self._groups = {}
+        # uuid -> (group key, ha_group_min or None, active)
+        self._members = {}
+
+    def get_group(self, tenant_id, group_id):
+        return self._groups.get((tenant_id, group_id))
+
+    def _remove(self, uuid, dirty):
+        entry = self._members.pop(uuid, None)
+        if entry is None:
+            return
+        (key, minimum, active) = entry
+        group = self._groups[key]
+        group.members.discard(uuid)
+        group.active.discard(uuid)
+        if minimum is not None:
+            group.mins[minimum] -= 1
+            if not group.mins[minimum]:
+                del group.mins[minimum]
+        if not group.members:
+            del self._groups[key]
+            dirty.discard(key)
+        else:
+            dirty.add(key)
+
+    def _add(self, uuid, key, minimum, active, dirty):
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = HaGroup(*key)
+        group.members.add(uuid)
+        if active:
+            group.active.add(uuid)
+        if minimum is not None:
+            group.mins[minimum] = group.mins.get(minimum, 0) + 1
+        self._members[uuid] = (key, minimum, active)
+        dirty.add(key)
+
+    def _parse(self, server, invalid):
+        metadata = getattr(server, 'metadata', None) or {}
+        group_id = metadata.get('ha_group_id')
+        if not group_id or 'ha_group_id' in invalid:
+            return (None, None)
+        minimum = metadata.get('ha_group_min')
+        if minimum is None or 'ha_group_min' in invalid:
+            return ((getattr(server, 'tenant_id', None), group_id), None)
+        return ((getattr(server, 'tenant_id', None), group_id),
+                int(minimum))
+
+    def apply(self, servers, full=False):
+        """Apply changed servers; with full, servers is a complete listing
+        and anything else is dropped. Returns [(HaGroup, healthy)] for the
+        groups whose health changed."""
+        errors = self.grammar.validate_many(servers)
+        with self._lock:
+            dirty = set()
+            seen = set()
+            for server in servers:
+                seen.add(server.id)
+                (key, minimum) = self._parse(server,
+                                             errors.get(server.id, {}))
+                status = getattr(server, 'status', None)
+                active = status == 'ACTIVE'
+                if key is None or status == 'DELETED':
+                    self._remove(server.id, dirty)
+                    continue
+                if self._members.get(server.id) == (key, minimum, active):
+                    continue
+                self._remove(server.id, dirty)
+                self._add(server.id, key, minimum, active, dirty)
+            if full:
+                for uuid in set(self._members) - seen:
+                    self._remove(uuid, dirty)
+            transitions = []
+            for key in dirty:
+                group = self._groups[key]
+                healthy = group.is_healthy()
+                if group.healthy is not None and healthy != group.healthy:
+                    transitions.append((group, healthy))
+                # The first sighting of a group sets its baseline
+                group.healthy = healthy
+        return transitions
+
+    def notify(self, transitions):
+        for (group, healthy) in transitions:
+            try:
+                notifications.notification(
+                    timestamp=datetime.now(),
+                    description="HA group %s" % (group.group_id),
+                    type='ha_group_healthy' if healthy
+                        else 'ha_group_degraded',
+                    ha_group_id=group.group_id,
+                    ha_group_active_count=len(group.active),
+                    ha_group_active_list=", ".join(sorted(group.active)),
+                    tenant_id=group.tenant_id).send()
+            except Exception, e:
+                print >>sys.stderr, (
+                    "Notifying HA group %s failed: %s" % (group.group_id, e))
+
+    def update(self, servers, full=False):
+        """Inventory listener: apply servers and notify transitions."""
+        transitions = self.apply(servers, full)
+        if self.send:
+            self.notify(transitions)
+        return transitions
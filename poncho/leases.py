@@ -0,0 +1,65 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+"""
+Lease-based ownership of service events, so several poncho-daemons can
+share the event table without running the same workflow step twice.
+
+A worker claims an event's lease before each tick and releases it after.
+State changes are compare-and-set on the lease, and a heartbeat keeps the
+leases of long ticks alive. Leases left behind by a crashed worker expire
+and are taken over by the next claim.
+"""
+
+from oslo.config import cfg
+
+from datetime import timedelta
+import os
+import socket
+import sys
+import threading
+
+from poncho.db import api as db
+
+opts = [
+    cfg.StrOpt('worker_id', default=None,
+        help='Unique name of this worker in a poncho-daemon fleet. '
+             'Defaults to hostname:pid.'),
+    cfg.IntOpt('lease_duration', default=120,
+        help='Seconds a worker owns an event without renewing its lease.'),
+]
+CONF = cfg.CONF
+CONF.register_opts(opts)
+
+
+def worker_identity():
+    return CONF.worker_id or "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+def lease_duration():
+    return timedelta(seconds=CONF.lease_duration)
+
+
+class LeaseHeartbeat(threading.Thread):
+    """Renews the leases of events returned by held_fn() every third of
+    the lease duration."""
+    def __init__(self, owner, held_fn):
+        super(LeaseHeartbeat, self).__init__(name='lease-heartbeat')
+        self.daemon = True
+        self.owner = owner
+        self.held_fn = held_fn
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    def beat(self):
+        held = self.held_fn()
+        if held:
+            db.renew_leases(self.owner, held, lease_duration())
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                self.beat()
+            except Exception, e:
+                print >>sys.stderr, "Lease heartbeat failed: %s" % (e)
+            self._stopping.wait(CONF.lease_duration / 3.0)
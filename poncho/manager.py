@@ -5,34 +5,78 @@ Poncho Manager - handles service event operations.
 
 from oslo.config import cfg
 
+from datetime import datetime
+import sys
+
 from poncho import annotations as annotations
 from poncho.db import api as db
 from poncho import notifications as notifications
+from poncho import scheduler as scheduler
+from poncho import simulator as simulator
 from poncho import workflows as workflows
-#import poncho.nova.client
-#import poncho.nova.manage
 
 class ServiceEventManager(object):
     def create_event(self, args):
-        return db.create_event(args)
-     
-    def _event_complete(event_id, final_state):
-        session = db.get_session()
-        event = db.get_event_for_update(event_id, session=session)
-        # TODO(scott): switch these to exceptions
-        if not event:
-            print >>sys.stderr, "Unknown event '%s'" % (event_id)
-        if event.completed:
-            print >>sys.stderr, "Cancel failed: event already compelted."
-            session.rollback()
-        else:
-            event.completed = True
-            event.state = final_state 
-            event.completed_at = datetime.now().replace(microsecond=0)
-            session.commit()
+        event = db.create_event(args)
+        if not args.dry:
+            scheduler.send_trigger(event.id)
         return event
+
+    def simulate_event(self, event):
+        """Play the event's workflow forward against the instances now on
+        its hosts. Returns (simulator.Simulation, hosts that could not be
+        listed)."""
+        (servers, failures) = workflows.get_event_servers(event)
+        offset = simulator.utc_offset()
+        simulation = simulator.simulate(
+            event.workflow, servers, event.begin_passive_drain_at + offset,
+            event.begin_active_drain_at + offset)
+        return (simulation, failures)
+     
+    def _event_complete(self, event_id, final_state):
+        with db.session_scope() as session:
+            event = db.get_event_for_update(event_id, session=session)
+            # TODO(scott): switch these to exceptions
+            if not event:
+                print >>sys.stderr, "Unknown event '%s'" % (event_id)
+            if event.completed:
+                print >>sys.stderr, "Cancel failed: event already compelted."
+                session.rollback()
+            elif final_state == 'completed' and self._resume_state(event):
+                # The workflow has more to do once the hosts are serviced
+                event.state = self._resume_state(event)
+                session.commit()
+                scheduler.send_trigger(event.id)
+            else:
+                # Hosts of an event cancelled before its drain began were
+                # never disabled by poncho; leave them as they are.
+                disabled = self._hosts_disabled(event)
+                event.completed = True
+                event.state = final_state 
+                event.completed_at = datetime.now().replace(microsecond=0)
+                session.commit()
+                scheduler.send_trigger(event.id)
+                if disabled:
+                    self.enable_event_hosts(event, session=session)
+            return event
+
+    def _workflow(self, event):
+        try:
+            return workflows.get_workflow(event.workflow)
+        except Exception:
+            return None
+
+    def _resume_state(self, event):
+        workflow = self._workflow(event)
+        return workflow.resume.get(event.state) if workflow else None
+
+    def _hosts_disabled(self, event):
+        workflow = self._workflow(event)
+        return workflow is not None and \
+            event.state in workflow.hosts_disabled_in
+
     def complete_event(self, event_id):
-        return self._event_complete(event_id, 'complete')
+        return self._event_complete(event_id, 'completed')
 
     def cancel_event(self, event_id, silent=False):
         # TODO(scott): implement event-canceled notifications
@@ -50,9 +94,7 @@ class ServiceEventManager(object):
                 delays.append(wanted)
         return min(max_delay, max(delays))
 
-    def disable_event_hosts(self, event):
-        for host in event.hosts:
-            se
-
-
-    
+    def enable_event_hosts(self, event, session=None):
+        """Re-enable nova-compute on the hosts of a finished event that
+        no other active event still holds. Returns the enabled hosts."""
+        return workflows.enable_event_hosts(event, session=session)
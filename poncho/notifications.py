@@ -10,12 +10,22 @@ from email.MIMEBase import MIMEBase
 from email.MIMEText import MIMEText
 from email.Utils import COMMASPACE, formatdate
 from email import Encoders
+from datetime import datetime, timedelta
+import hashlib
 import importlib
+import json
+import os
 import re
 import requests
+import requests.adapters
 import smtplib
 import string
 import sys
+import threading
+
+from poncho.common.utils import TokenBucket
+from poncho.db import api as db
+from poncho.nova.client import Client
 
 DEFAULT_NOTIFICATIONS = [
     'poncho.notifications.RebootScheduled',
@@ -57,6 +67,38 @@ notify_group_options = [
     cfg.StrOpt(
         'email_notifications_smtp_server',
         help='SMTP server to use when sending notification emails'),
+    cfg.StrOpt(
+        'email_notifications_smtp_username',
+        help='Username to authenticate to the SMTP server with, if any.'),
+    cfg.StrOpt(
+        'email_notifications_smtp_password', secret=True,
+        help='Password to authenticate to the SMTP server with.'),
+    cfg.BoolOpt(
+        'email_notifications_smtp_starttls', default=False,
+        help='Use STARTTLS on the SMTP connection.'),
+    cfg.FloatOpt(
+        'email_notifications_rate', default=5.0,
+        help='Maximum emails sent per second; 0 for no limit.'),
+    cfg.IntOpt(
+        'email_digest_window', default=300,
+        help='Seconds to collect notifications for one recipient into a '
+        'single digest email.'),
+    cfg.FloatOpt(
+        'http_connect_timeout', default=5.0,
+        help='Seconds to wait for a notify_url to accept a connection.'),
+    cfg.FloatOpt(
+        'http_read_timeout', default=30.0,
+        help='Seconds to wait for a notify_url to respond.'),
+    cfg.IntOpt(
+        'http_pool_connections', default=32,
+        help='Number of notify_url hosts to keep connection pools for.'),
+    cfg.IntOpt(
+        'http_pool_maxsize', default=4,
+        help='Maximum open keep-alive connections per notify_url host.'),
+    cfg.ListOpt(
+        'http_batch_urls', default=[],
+        help='notify_url prefixes that accept a JSON array of '
+        'notifications in one POST.'),
 ]
 
 CONF = cfg.CONF
@@ -65,8 +107,8 @@ for opt in notify_group_options:
     CONF.register_opt(opt, group=notify_group)
 
 def email_body(notification):
-    reply = (CONF.email_notifications_reply_to or
-        CONF.email_notifications_from)
+    reply = (CONF.notify.email_notifications_reply_to or
+        CONF.notify.email_notifications_from_addr)
     return """%s
     The reason given for this event was:
     %s
@@ -75,18 +117,19 @@ def email_body(notification):
     Please direct any questions to %s.
     """ % (notification, notification.description, reply)
 
-def _send_email(to_addrs=[], subject="", body="", files=[]):
-    assert type(to_addrs)==list
-    assert type(files)==list
-    from_addr = CONF.email_notifications_from_addr
-    smtp_server = CONF.email_notifications_smtp_server
-    assert type(from_addr)==str
-    assert type(smtp_server)==str
+def digest_body(bodies):
+    """Combine several notification email bodies into one."""
+    header = "You have %d notifications about your instances:\n" % (
+        len(bodies))
+    separator = "\n" + "-" * 72 + "\n"
+    return header + separator + separator.join(bodies)
+
+def _build_email(to_addrs, subject, body, files):
     msg = MIMEMultipart()
-    msg['From'] = from_addr
+    msg['From'] = CONF.notify.email_notifications_from_addr
     msg['To'] = COMMASPACE.join(to_addrs)
-    if CONF.get('email_notifications_reply_to', None):
-        msg['Reply-To'] = CONF.email_notifications_reply_to
+    if CONF.notify.email_notifications_reply_to:
+        msg['Reply-To'] = CONF.notify.email_notifications_reply_to
     msg['Date'] = formatdate(localtime=True)
     msg['Subject'] = subject
     msg.attach( MIMEText(body) )
@@ -98,10 +141,163 @@ def _send_email(to_addrs=[], subject="", body="", files=[]):
             'Content-Disposition',
             'attachment; filename="%s"' % os.path.basename(f))
         msg.attach(part)
-    smtp = smtplib.SMTP(smtp_server)
-    smtp.sendmail(from_addr, to_addrs, msg.as_string())
-    smtp.close()
-    
+    return msg
+
+class SmtpSender(object):
+    """Keeps one authenticated SMTP connection open per thread and limits
+    the rate at which messages go out."""
+    def __init__(self, rate=None):
+        if rate is None:
+            rate = CONF.notify.email_notifications_rate
+        self.bucket = TokenBucket(rate)
+        self._local = threading.local()
+
+    def _connect(self):
+        smtp = smtplib.SMTP(CONF.notify.email_notifications_smtp_server)
+        if CONF.notify.email_notifications_smtp_starttls:
+            smtp.starttls()
+        if CONF.notify.email_notifications_smtp_username:
+            smtp.login(CONF.notify.email_notifications_smtp_username,
+                       CONF.notify.email_notifications_smtp_password)
+        return smtp
+
+    def _connection(self):
+        smtp = getattr(self._local, 'smtp', None)
+        if smtp is None:
+            smtp = self._local.smtp = self._connect()
+        return smtp
+
+    def close(self):
+        smtp = getattr(self._local, 'smtp', None)
+        self._local.smtp = None
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except smtplib.SMTPException:
+                pass
+
+    def send(self, from_addr, to_addrs, message):
+        self.bucket.consume()
+        try:
+            self._connection().sendmail(from_addr, to_addrs, message)
+        except smtplib.SMTPServerDisconnected:
+            # Idle connection was dropped by the server; retry once
+            self._local.smtp = None
+            self._connection().sendmail(from_addr, to_addrs, message)
+
+_SMTP_SENDER = None
+
+def get_smtp_sender():
+    global _SMTP_SENDER
+    if _SMTP_SENDER is None:
+        _SMTP_SENDER = SmtpSender()
+    return _SMTP_SENDER
+
+def _send_email(to_addrs=[], subject="", body="", files=[]):
+    assert type(to_addrs)==list
+    assert type(files)==list
+    from_addr = CONF.notify.email_notifications_from_addr
+    smtp_server = CONF.notify.email_notifications_smtp_server
+    assert type(from_addr)==str
+    assert type(smtp_server)==str
+    msg = _build_email(to_addrs, subject, body, files)
+    get_smtp_sender().send(from_addr, to_addrs, msg.as_string())
+
+_HTTP_SESSION = None
+
+def get_http_session():
+    """Shared requests session, keeping connections to notify_urls alive
+    between notifications."""
+    global _HTTP_SESSION
+    if _HTTP_SESSION is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=CONF.notify.http_pool_connections,
+            pool_maxsize=CONF.notify.http_pool_maxsize,
+            pool_block=True)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['content-type'] = 'application/json'
+        _HTTP_SESSION = session
+    return _HTTP_SESSION
+
+def deliver_http(url, payload):
+    """POST a JSON payload, raising on connection errors or bad status."""
+    timeout = (CONF.notify.http_connect_timeout,
+               CONF.notify.http_read_timeout)
+    r = get_http_session().post(url, data=payload, timeout=timeout)
+    r.raise_for_status()
+
+def accepts_batches(url):
+    return any(url.startswith(prefix)
+               for prefix in CONF.notify.http_batch_urls)
+
+def deliver_http_batch(url, payloads):
+    """POST several JSON payloads to url as a single JSON array."""
+    deliver_http(url, "[%s]" % ",".join(payloads))
+
+def deliver_email(address, subject, body):
+    _send_email(to_addrs=[address], subject=subject, body=body)
+
+DELIVERY_TRANSPORTS = {
+    'http': lambda item: deliver_http(item.destination, item.payload),
+    'email': lambda item: deliver_email(item.destination, item.subject,
+                                        item.payload),
+}
+
+def batch_delivery(transport, destination):
+    """Return a fn(items) delivering several queued items to destination
+    at once, or None if they must be sent one by one."""
+    if transport == 'http' and accepts_batches(destination):
+        return lambda items: deliver_http_batch(
+            destination, [item.payload for item in items])
+    if transport == 'email':
+        return lambda items: deliver_email(
+            destination, items[0].subject,
+            digest_body([item.payload for item in items]))
+    return None
+
+_NOVA_CLIENT = None
+
+def get_nova_client():
+    global _NOVA_CLIENT
+    if _NOVA_CLIENT is None:
+        _NOVA_CLIENT = Client()
+    return _NOVA_CLIENT
+
+_KEYSTONE_CLIENT = None
+
+def get_keystone_client():
+    global _KEYSTONE_CLIENT
+    if _KEYSTONE_CLIENT is None:
+        from keystoneclient.v2_0 import client as keystone_client
+        conf = CONF.service_credentials
+        # User lookups need keystone's admin endpoint, which the client
+        # picks from the catalog by default.
+        _KEYSTONE_CLIENT = keystone_client.Client(
+            username=conf.os_username,
+            password=conf.os_password,
+            tenant_id=conf.os_tenant_id or None,
+            tenant_name=conf.os_tenant_name,
+            auth_url=conf.os_auth_url)
+    return _KEYSTONE_CLIENT
+
+def get_owner_email(instance_uuid, user_id=None):
+    """Email address of the user that owns an instance, or None. The
+    owner is looked up in nova unless user_id is given."""
+    if not user_id:
+        try:
+            server = get_nova_client().get_server(instance_uuid)
+        except Exception, e:
+            # The instance may already be deleted
+            print >>sys.stderr, "Cannot find the owner of %s: %s" % (
+                instance_uuid, e)
+            return None
+        user_id = getattr(server, 'user_id', None)
+    if not user_id:
+        return None
+    return getattr(get_keystone_client().users.get(user_id), 'email', None)
+
 def notification(**kwargs):
     """Factory to generate a new notification object"""
     def convert(name):
@@ -118,23 +314,48 @@ class InvalidNotification(Exception):
     
 class Notification(object):
     required_keys = set(['timestamp', 'description', 'type'])
+    # Attributes identifying a notification for deduplication; None uses
+    # the whole payload.
+    dedup_keys = None
     def __init__(self, **kwargs):
         for key in self.required_keys:
             if key not in kwargs:
                 raise InvalidNotification("kwarg %s required" % key)
             else:
                 setattr(self, key, kwargs[key])
+        # Service event the notification is sent for, if any
+        self.event_id = kwargs.get('event_id')
 
     def __str__(self):
         """Representation used for sending emails."""
         raise NotImplementedError()
 
-    def as_json(self):
-        """Format as json structure"""
+    def _format(self, template):
+        return string.Template(template).safe_substitute(self.__dict__)
+
+    def as_dict(self):
         body = {}
         for key in self.required_keys:
-            body[key] = self.key
-        return json.dumps(body)
+            value = getattr(self, key)
+            if isinstance(value, datetime):
+                value = value.isoformat()
+            body[key] = value
+        return body
+
+    def as_json(self):
+        """Format as json structure"""
+        return json.dumps(self.as_dict(), sort_keys=True)
+
+    def dedup_key(self, transport, destination):
+        """Notifications with the same dedup_keys to the same destination
+        are only queued once."""
+        if self.dedup_keys is None:
+            identity = [self.as_json()]
+        else:
+            identity = ["%s=%s" % (key, getattr(self, key))
+                        for key in self.dedup_keys]
+        return hashlib.sha1("\n".join(
+            [transport, destination] + identity)).hexdigest()
     
     def notify_urls(self):
         """Return an array of notify_urls applicaable to this event.""" 
@@ -145,72 +366,87 @@ class Notification(object):
         raise NotImplementedError()
     
     def send(self):
+        """Queue the notification for each destination; delivery is done
+        by poncho.dispatcher."""
         urls = self.notify_urls()
         if len(urls) > 0:
             data = self.as_json()
-            headers = { 'content-type' : 'application/json' }
             for url in urls:
-                r = requests.post(url, data=data, headers=headers)
-                # TODO(scott): check status and retry? possibly a queue?
+                db.enqueue_notification(
+                    'http', url, data, self.dedup_key('http', url))
         else:
-            emails = self.notifiy_urls()
+            emails = self.notify_emails()
             body = email_body(self)
-            from_addr=CONF.email_notifications_from
             # TODO(scott): reasonable subject fields
-            _send_email(to_addrs=emails, subject="Subject", body=body)
+            subject = CONF.notify.email_notifications_subject
+            window = timedelta(seconds=CONF.notify.email_digest_window)
+            for email in emails:
+                # Join the digest already pending for this recipient, or
+                # open a new one.
+                deliver_after = db.get_pending_delivery_time('email', email)
+                if deliver_after is None:
+                    deliver_after = datetime.utcnow() + window
+                db.enqueue_notification(
+                    'email', email, body, self.dedup_key('email', email),
+                    subject=subject, deliver_after=deliver_after)
     
 
 class InstanceNotification(Notification):
     required_keys = (Notification.required_keys |
                      set(['instance_name', 'instance_uuid']))
+    # Sent at most once per event, whatever time a retry builds it with
+    dedup_keys = ('event_id', 'type', 'instance_uuid')
+    def __init__(self, **kwargs):
+        super(InstanceNotification, self).__init__(**kwargs)
+        # Owner of the instance, if the sender already knows it
+        self.user_id = kwargs.get('user_id')
+
     def notify_urls(self):
-        metadata = nova.servers.get(self.instance_uuid).meta
-        if 'notify_url' in metadata:
-            return [ metadata['notify_url'] ]
+        annotations = db.get_instance_annotations(self.instance_uuid)
+        if 'notify_url' in annotations:
+            return [ annotations['notify_url'] ]
         else:
             return []
  
-    def notify_emails(self):    
-        owner = nova.servers.get(self.instance_uuid).user_id
-        if owner:
-            email = keystone.users.get(owner).email
-            if email:
-                return [email]
+    def notify_emails(self):
+        email = get_owner_email(self.instance_uuid, self.user_id)
+        if email:
+            return [email]
         return []
     
         
 class RebootScheduled(InstanceNotification):
    def __str__(self):
-        return """The instance "${instance_name}" \
-(UUID: ${instance_uuid}) will reboot at ${timestamp}.""" % (self)
+        return self._format("""The instance "${instance_name}" \
+(UUID: ${instance_uuid}) will reboot at ${timestamp}.""")
     
 
 class Rebooting(InstanceNotification) :
     def __str__(self):
-        return """The instance "${instance_name}" \
-(UUID: ${instance_uuid}) rebooted at ${timestamp}.""" % (self)
+        return self._format("""The instance "${instance_name}" \
+(UUID: ${instance_uuid}) rebooted at ${timestamp}.""")
 
 
 class TerminateScheduled(InstanceNotification):
     def __str__(self):
-        return """The instance "${instance_name}" \
-(UUID: ${instance_uuid}) will be terminated at ${timestamp}.""" % (self)
+        return self._format("""The instance "${instance_name}" \
+(UUID: ${instance_uuid}) will be terminated at ${timestamp}.""")
 
 
 class Terminating(InstanceNotification):
     def __str__(self):
-        return """The instance "${instance_name}" \
-(UUID: ${instance_uuid}) was terminated at ${timestamp}.""" % (self)
+        return self._format("""The instance "${instance_name}" \
+(UUID: ${instance_uuid}) was terminated at ${timestamp}.""")
 
 
 class SnapshotCreated(InstanceNotification):
     required_keys = (InstanceNotification.required_keys |
                      set(['snapshot_name', 'snapshot_id']))
     def __str__(self):
-        """A snapshot of "${instance_name}" \
+        return self._format("""A snapshot of "${instance_name}" \
 (UUID: ${instance_uuid}) was created at ${timestamp}.
 Snapshot Name: ${snapshot_name}
-Snapshot ID: ${snapshot_id}""" % (self)
+Snapshot ID: ${snapshot_id}""")
 
 
 class TenantWide(Notification):
@@ -218,13 +454,7 @@ class TenantWide(Notification):
                      set(['ha_group_id', 'ha_group_active_count',
                      'ha_group_active_list', 'tenant_id']))
     def notify_urls(self):
-        servers = [ server for server in nova.servers.list()
-            if server.tenant_id == self.tenant_id ]
-        urls = set()
-        for server in servers:
-            if 'notify_url' in server.meta:
-                urls |= server.meta['notify_url']
-        return urls
+        return db.get_tenant_notify_urls(self.tenant_id)
     def notify_emails(self):
         # TODO(scott): Figure out how to get admin users from tenant
         emails = set()
@@ -233,22 +463,22 @@ class TenantWide(Notification):
 
 class HaGroupDegraded(TenantWide):
     def __str__(self):
-        return """The HA group ${ha_group_id} went into \
+        return self._format("""The HA group ${ha_group_id} went into \
 degraded mode at ${timestamp} with ${ha_group_active_count} instances active.
 Active instances: ${ha_group_active_list}
-""" % (self)
+""")
 
 
 class HaGroupHealthy(TenantWide):
     def __str__(self):
-        return """The HA group ${ha_group_id} transitioned \
+        return self._format("""The HA group ${ha_group_id} transitioned \
 to a healthy state at ${timestamp} with ${ha_group_active_count} instances \
 active.
 Active instances: ${ha_group_active_list}
-""" % (self)
+""")
 
 
 class ShedLoadRequest(TenantWide):
     def __str__(self):
-        return """This is a load shedding request. \
-Please delete any idle or unneeded instances.""" % (self)
+        return self._format("""This is a load shedding request. \
+Please delete any idle or unneeded instances.""")
@@ -5,10 +5,13 @@ Wrapper for novaclient object construction
 
 from oslo.config import cfg
 
+from multiprocessing.pool import ThreadPool
 import os
 
 from novaclient.v1_1 import client as nova_client
 
+from poncho.nova.inventory import inventory as shared_inventory
+
 OPTIONS = [
     cfg.StrOpt('os-username',
                deprecated_group="DEFAULT",
@@ -43,10 +46,33 @@ OPTIONS = [
 ]
 cfg.CONF.register_cli_opts(OPTIONS, group="service_credentials")
 
-class Client(object):
+API_OPTIONS = [
+    cfg.IntOpt('nova_concurrency', default=8,
+               help='Maximum number of concurrent nova API requests when '
+                    'fetching or altering many hosts at once.'),
+    cfg.IntOpt('nova_timeout', default=60,
+               help='Timeout in seconds for each nova API request.'),
+    cfg.IntOpt('nova_page_size', default=1000,
+               help='Number of servers requested per page when listing '
+                    'servers from nova. Must not exceed nova\'s '
+                    'osapi_max_limit, or listings stop after one page.'),
+]
+cfg.CONF.register_opts(API_OPTIONS)
+
 
+class HostResults(dict):
+    """Mapping of hostname to result. Hosts whose request raised are left
+    out and reported in failures, mapped to the exception."""
     def __init__(self):
+        super(HostResults, self).__init__()
+        self.failures = {}
+
+
+class Client(object):
+
+    def __init__(self, inventory=shared_inventory):
         """Returns a novaclient object"""
+        self.inventory = inventory
         conf = cfg.CONF.service_credentials
         tenant = conf.os_tenant_id and conf.os_tenant_id or conf.os_tenant_name
         self.nova_client = nova_client.Client(
@@ -55,11 +81,91 @@ class Client(object):
             project_id=tenant,
             auth_url=cfg.CONF.service_credentials.os_auth_url,
             endpoint_type=cfg.CONF.service_credentials.os_endpoint_type,
+            timeout=cfg.CONF.nova_timeout,
             no_cache=True)
 
+    def _fan_out(self, fn, hosts, concurrency=None):
+        """Call fn(host) for each host on a bounded thread pool."""
+        hosts = list(set(hosts))
+        results = HostResults()
+        if not hosts:
+            return results
+
+        def call(host):
+            try:
+                return (host, True, fn(host))
+            except Exception, e:
+                return (host, False, e)
+        size = min(concurrency or cfg.CONF.nova_concurrency, len(hosts))
+        pool = ThreadPool(max(size, 1))
+        try:
+            for (host, ok, value) in pool.imap_unordered(call, hosts):
+                if ok:
+                    results[host] = value
+                else:
+                    results.failures[host] = value
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
     def get_host_servers(self, hostname):
-        """Returns list of servers for hostname."""
-        all_tenants = cfg.CONF.service_credentials.all_tenants
-        return self.nova_client.servers.list(
-                search_opts={'host':hostname,
-                             'all_tenants':all_tenants})
+        """Returns list of servers for hostname. Served from the shared
+        inventory when it has been refreshed recently."""
+        if self.inventory is not None and self.inventory.is_fresh():
+            return self.inventory.get_host_servers(hostname)
+        all_tenants = cfg.CONF.service_credentials.os_all_tenants
+        return self.list_servers({'host': hostname,
+                                  'all_tenants': all_tenants})
+
+    def get_server(self, uuid):
+        """Returns the server with uuid. Served from the shared inventory
+        when it has been refreshed recently."""
+        if self.inventory is not None and self.inventory.is_fresh():
+            server = self.inventory.get_server(uuid)
+            if server is not None:
+                return server
+        return self.nova_client.servers.get(uuid)
+
+    def get_servers_for_hosts(self, hosts, concurrency=None):
+        """Returns a HostResults mapping each hostname to its servers.
+        Hosts are listed concurrently, up to concurrency at a time."""
+        if self.inventory is not None and self.inventory.is_fresh():
+            results = HostResults()
+            for host in hosts:
+                results[host] = self.inventory.get_host_servers(host)
+            return results
+        return self._fan_out(self.get_host_servers, hosts, concurrency)
+
+    def list_servers(self, search_opts):
+        """Returns every server matching search_opts, following the
+        marker through as many pages as nova returns. Raises if any page
+        fails, so a partial listing is never returned."""
+        limit = cfg.CONF.nova_page_size
+        servers = []
+        marker = None
+        while True:
+            page = self.nova_client.servers.list(search_opts=search_opts,
+                                                 marker=marker, limit=limit)
+            servers.extend(page)
+            if len(page) < limit:
+                return servers
+            marker = page[-1].id
+
+    def set_services_enabled(self, hosts, binary, enabled,
+                             concurrency=None):
+        """Enable or disable a service on many hosts through the
+        os-services API. Returns a HostResults of host to service."""
+        services = self.nova_client.services
+        alter = services.enable if enabled else services.disable
+        return self._fan_out(lambda host: alter(host, binary), hosts,
+                             concurrency)
+
+    def get_changed_servers(self, since=None):
+        """Returns list of servers changed since a UTC datetime, including
+        deleted servers. Returns every server if since is None."""
+        all_tenants = cfg.CONF.service_credentials.os_all_tenants
+        search_opts = {'all_tenants': all_tenants}
+        if since is not None:
+            search_opts['changes-since'] = since.isoformat()
+        return self.list_servers(search_opts)
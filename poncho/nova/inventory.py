@@ -0,0 +1,122 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+"""
+In-memory index of nova servers, kept current with changes-since polling.
+"""
+
+from oslo.config import cfg
+
+from datetime import datetime, timedelta
+import sys
+import threading
+
+OPTIONS = [
+    cfg.IntOpt('inventory_polling_interval', default=10,
+               help='Seconds between changes-since polls of nova.'),
+    cfg.IntOpt('inventory_max_age', default=60,
+               help='Seconds after the last successful poll that the '
+                    'inventory is still trusted by readers.'),
+    cfg.IntOpt('inventory_overlap', default=60,
+               help='Seconds of overlap between changes-since queries, to '
+                    'allow for clock skew between poncho and nova.'),
+]
+CONF = cfg.CONF
+CONF.register_opts(OPTIONS)
+
+HOST_ATTR = 'OS-EXT-SRV-ATTR:host'
+
+
+def server_host(server):
+    return getattr(server, HOST_ATTR, None)
+
+
+class Inventory(object):
+    """Host -> servers and uuid -> server index of the nova fleet.
+
+    The first refresh() takes a full snapshot; later refreshes only apply
+    the servers nova reports as changed. Listeners are called as
+    fn(servers, full) with every batch applied.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.by_uuid = {}
+        self.by_host = {}
+        self.last_sync = None
+        self.refreshed_at = None
+        self.listeners = []
+
+    def add_listener(self, fn):
+        self.listeners.append(fn)
+
+    def is_fresh(self):
+        if self.refreshed_at is None:
+            return False
+        max_age = timedelta(seconds=CONF.inventory_max_age)
+        return datetime.utcnow() - self.refreshed_at < max_age
+
+    def refresh(self, client):
+        started = datetime.utcnow()
+        full = self.last_sync is None
+        # get_changed_servers raises rather than return a partial listing,
+        # so the inventory is only marked fresh after a complete one.
+        servers = client.get_changed_servers(since=self.last_sync)
+        self.apply(servers, full=full)
+        self.last_sync = started - timedelta(seconds=CONF.inventory_overlap)
+        self.refreshed_at = started
+        return len(servers)
+
+    def apply(self, servers, full=False):
+        with self._lock:
+            if full:
+                self.by_uuid = {}
+                self.by_host = {}
+            for server in servers:
+                self._remove(server.id)
+                if getattr(server, 'status', None) != 'DELETED':
+                    self._add(server)
+        for listener in self.listeners:
+            listener(servers, full)
+
+    def _add(self, server):
+        self.by_uuid[server.id] = server
+        self.by_host.setdefault(server_host(server), {})[server.id] = server
+
+    def _remove(self, uuid):
+        server = self.by_uuid.pop(uuid, None)
+        if server is None:
+            return
+        host = server_host(server)
+        servers = self.by_host.get(host, {})
+        servers.pop(uuid, None)
+        if not servers:
+            self.by_host.pop(host, None)
+
+    def get_host_servers(self, hostname):
+        with self._lock:
+            return self.by_host.get(hostname, {}).values()
+
+    def get_server(self, uuid):
+        return self.by_uuid.get(uuid)
+
+
+class InventorySync(threading.Thread):
+    """Background thread refreshing an Inventory every polling interval."""
+    def __init__(self, inventory, client):
+        super(InventorySync, self).__init__(name='inventory-sync')
+        self.daemon = True
+        self.inventory = inventory
+        self.client = client
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                self.inventory.refresh(self.client)
+            except Exception, e:
+                print >>sys.stderr, "Inventory refresh failed: %s" % (e)
+            self._stopping.wait(CONF.inventory_polling_interval)
+
+
+inventory = Inventory()
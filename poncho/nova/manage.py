@@ -7,6 +7,8 @@ from oslo.config import cfg
 
 import subprocess
 
+from poncho.nova.client import Client
+
 OPTIONS = [
     cfg.StrOpt('command_wrapper', default='{placeholder}',
                help="This wrapper is for invoking the nova-manage command"),
@@ -19,6 +21,13 @@ class NovaManageWrapper(object):
     """Wrapper for nova-manage command."""
     def __init__(self):
         self.command_format = CONF.command_wrapper
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = Client()
+        return self._client
 
     def _wrap_command(self, command):
         return self.command_format.format(placeholder=command) 
@@ -47,6 +56,16 @@ class NovaManageWrapper(object):
     def service_disable(self, **kwargs):
         return self._alter_service('disable', **kwargs)
 
+    def service_enable_many(self, hosts, service):
+        """Enable service on many hosts without a nova-manage process per
+        host. Returns a HostResults; failed hosts are in .failures."""
+        return self.client.set_services_enabled(hosts, service, True)
+
+    def service_disable_many(self, hosts, service):
+        """Disable service on many hosts without a nova-manage process per
+        host. Returns a HostResults; failed hosts are in .failures."""
+        return self.client.set_services_enabled(hosts, service, False)
+
     def service_status(self, host=None, service=None):
         pass
 
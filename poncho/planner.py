@@ -0,0 +1,129 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+"""
+Drain planning: the order in which instances on an event's hosts are
+acted on.
+
+Instances are taken lowest priority first and packed into waves of at
+most drain_wave_size. An HA group, identified by tenant and ha_group_id,
+never loses more members than it can spare, that is its size less its
+ha_group_min. Members acted on stay down until the event is drained, so
+the spare count covers the whole drain rather than each wave: members
+already acted on stay in the first wave and use it up, and members past
+it are held back until the group grows enough to spare them. Planning
+is a single pass over the instances after the priority sort.
+"""
+
+from oslo.config import cfg
+
+from poncho.db import api as db
+
+opts = [
+    cfg.IntOpt('drain_wave_size', default=50,
+        help='Maximum number of instances acted on at once while '
+             'draining a service event.'),
+]
+CONF = cfg.CONF
+CONF.register_opts(opts)
+
+PLAN_KEYS = ('priority', 'ha_group_id', 'ha_group_min')
+
+
+class DrainPlan(object):
+    """Ordered action schedule. waves is a list of lists of uuids and
+    wave_of maps each planned uuid to its wave. Members of HA groups
+    that cannot spare them are in no wave; they are listed in held and
+    their (tenant_id, ha_group_id) groups in constrained."""
+    def __init__(self):
+        self.waves = []
+        self.wave_of = {}
+        self.held = []
+        self.constrained = set()
+
+    def first_wave(self):
+        return self.waves[0] if self.waves else []
+
+    def __len__(self):
+        return len(self.waves)
+
+
+def _int(value, default=0):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def plan_drain(uuids, annotations, group_sizes=None, wave_size=None,
+               acted=(), tenants=None):
+    """Plan the drain of uuids. annotations maps uuid to its annotation
+    dict and tenants maps uuid to its tenant_id. group_sizes maps
+    (tenant_id, ha_group_id) to the number of instances in the group
+    across the whole cloud; groups not in it are sized from uuids alone.
+    acted lists those of uuids already acted on; they still count
+    towards their group's size and are put in the first wave."""
+    wave_size = wave_size or CONF.drain_wave_size
+    group_sizes = dict(group_sizes or {})
+    tenants = tenants or {}
+    acted = set(acted)
+    plan = DrainPlan()
+
+    def group_of(uuid):
+        group = annotations.get(uuid, {}).get('ha_group_id')
+        if group:
+            return (tenants.get(uuid), group)
+        return None
+    groups = {}
+    for uuid in uuids:
+        group = group_of(uuid)
+        if group:
+            groups[group] = groups.get(group, 0) + 1
+    sizes = {}
+    for (group, members) in groups.iteritems():
+        sizes[group] = max(group_sizes.get(group, 0), members)
+    budgets = dict(sizes)
+    # The largest ha_group_min any member asks for wins
+    for uuid in uuids:
+        annotated = annotations.get(uuid, {})
+        group = group_of(uuid)
+        if group and 'ha_group_min' in annotated:
+            spare = sizes[group] - _int(annotated['ha_group_min'])
+            budgets[group] = min(budgets[group], spare)
+
+    ordered = sorted(uuids, key=lambda uuid: (uuid not in acted, _int(
+        annotations.get(uuid, {}).get('priority'))))
+    fill = []
+    first_open = 0
+    group_counts = {}
+    for uuid in ordered:
+        group = group_of(uuid)
+        if group:
+            if uuid not in acted and group_counts.get(group, 0) >= \
+                    budgets[group]:
+                plan.held.append(uuid)
+                plan.constrained.add(group)
+                continue
+            group_counts[group] = group_counts.get(group, 0) + 1
+        wave = 0 if uuid in acted else first_open
+        if wave == len(fill):
+            fill.append(0)
+            plan.waves.append([])
+        fill[wave] += 1
+        plan.waves[wave].append(uuid)
+        plan.wave_of[uuid] = wave
+        while first_open < len(fill) and fill[first_open] >= wave_size:
+            first_open += 1
+    return plan
+
+
+def plan_servers(servers, wave_size=None, session=None, acted=()):
+    """Plan the drain of nova servers from their synced annotations."""
+    uuids = [server.id for server in servers]
+    tenants = dict((server.id, getattr(server, 'tenant_id', None))
+                   for server in servers)
+    annotations = db.get_annotations_for_instances(uuids, PLAN_KEYS,
+                                                   session=session)
+    groups = set((tenants[uuid], annotated['ha_group_id']) for
+                 (uuid, annotated) in annotations.iteritems()
+                 if 'ha_group_id' in annotated)
+    sizes = db.get_ha_group_sizes(groups, session=session)
+    return plan_drain(uuids, annotations, sizes, wave_size, acted, tenants)
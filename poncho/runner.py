@@ -0,0 +1,98 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+"""
+Concurrent execution of workflow ticks for independent service events.
+"""
+
+from oslo.config import cfg
+
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+import sys
+import threading
+import traceback
+
+opts = [
+    cfg.IntOpt('worker_concurrency', default=8,
+        help='Number of service events the worker runs at once.'),
+    cfg.IntOpt('worker_tick_timeout', default=300,
+        help='Seconds after which a running workflow tick is reported as '
+             'stuck. The event is not run again until the tick returns.'),
+]
+CONF = cfg.CONF
+CONF.register_opts(opts)
+CONF.import_opt('polling_interval', 'poncho.workflows')
+
+
+class EventRunner(object):
+    """Runs run_fn(event_id) on a thread pool, at most once at a time per
+    event. done_fn(event_id, wake_at) is called with the result; a tick
+    that raises is retried after retry_delay.
+
+    An event submitted while its tick is still running is run again as
+    soon as that tick finishes, so triggers are never lost.
+    """
+    def __init__(self, run_fn, done_fn, concurrency=None, tick_timeout=None,
+                 retry_delay=None, clock=datetime.now):
+        self.run_fn = run_fn
+        self.done_fn = done_fn
+        self.concurrency = concurrency or CONF.worker_concurrency
+        self.tick_timeout = timedelta(
+            seconds=tick_timeout or CONF.worker_tick_timeout)
+        self.retry_delay = timedelta(
+            seconds=retry_delay or CONF.polling_interval)
+        self._clock = clock
+        self._pool = ThreadPool(self.concurrency)
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._rerun = set()
+        self._reported = set()
+
+    def submit(self, event_id):
+        """Start a tick for event_id. Returns False if one is running."""
+        with self._lock:
+            if event_id in self._in_flight:
+                self._rerun.add(event_id)
+                return False
+            self._in_flight[event_id] = self._clock()
+        self._pool.apply_async(self._run, (event_id,))
+        return True
+
+    def _run(self, event_id):
+        try:
+            wake_at = self.run_fn(event_id)
+        except Exception, e:
+            print >>sys.stderr, "Event %s, exception: %s" % (event_id, e)
+            traceback.print_exc()
+            wake_at = self._clock() + self.retry_delay
+        with self._lock:
+            del self._in_flight[event_id]
+            self._reported.discard(event_id)
+            if event_id in self._rerun:
+                self._rerun.discard(event_id)
+                wake_at = self._clock()
+        self.done_fn(event_id, wake_at)
+
+    def in_flight(self):
+        with self._lock:
+            return set(self._in_flight)
+
+    def check_timeouts(self):
+        """Report ticks running longer than tick_timeout, once each.
+        Returns the ids of stuck events."""
+        now = self._clock()
+        with self._lock:
+            stuck = [event_id for (event_id, started)
+                     in self._in_flight.iteritems()
+                     if now - started > self.tick_timeout]
+            new = [event_id for event_id in stuck
+                   if event_id not in self._reported]
+            self._reported.update(new)
+        for event_id in new:
+            print >>sys.stderr, (
+                "Event %s: tick running for more than %s" %
+                (event_id, self.tick_timeout))
+        return stuck
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
@@ -0,0 +1,194 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+"""
+Wake-up scheduling for the service worker.
+
+Instead of ticking every event on a fixed interval, the worker keeps a
+min-heap of the next time each event needs attention and sleeps until the
+earliest one. Explicit triggers (a new event from poncho-service, a nova
+change on an event's hosts) wake it early.
+"""
+
+from oslo.config import cfg
+
+from datetime import datetime
+import heapq
+import socket
+import sys
+import threading
+
+opts = [
+    cfg.IntOpt('scheduler_max_sleep', default=300,
+        help='Maximum seconds the worker sleeps before rescanning the '
+             'database for events it was not told about.'),
+    cfg.StrOpt('trigger_host', default='127.0.0.1',
+        help='Address the worker listens on for wake-up triggers.'),
+    cfg.IntOpt('trigger_port', default=7557,
+        help='UDP port the worker listens on for wake-up triggers.'),
+]
+CONF = cfg.CONF
+CONF.register_opts(opts)
+
+
+def _seconds(timedelta):
+    return timedelta.days * 86400 + timedelta.seconds + \
+        timedelta.microseconds / 1e6
+
+
+class Scheduler(object):
+    """Min-heap of (wake_at, event_id). Rescheduling an event leaves its
+    old heap entry behind; stale entries are skipped when popped."""
+    def __init__(self, clock=datetime.utcnow):
+        self._clock = clock
+        self._heap = []
+        self._wake_at = {}
+        self._hosts = {}
+        self._rescan = False
+        self._cond = threading.Condition()
+
+    def schedule(self, event_id, wake_at):
+        with self._cond:
+            current = self._wake_at.get(event_id)
+            if current is not None and current <= wake_at:
+                return
+            self._wake_at[event_id] = wake_at
+            heapq.heappush(self._heap, (wake_at, event_id))
+            self._cond.notify()
+
+    def unschedule(self, event_id):
+        with self._cond:
+            self._wake_at.pop(event_id, None)
+            self.unwatch(event_id)
+
+    def reschedule(self, event_id, wake_at):
+        """Replace the wake time of an event; None unschedules it."""
+        with self._cond:
+            self._wake_at.pop(event_id, None)
+            if wake_at is None:
+                self.unwatch(event_id)
+            else:
+                self.schedule(event_id, wake_at)
+
+    def trigger(self, event_id=None):
+        """Wake an event now, or rescan every event if event_id is None."""
+        if event_id is not None:
+            self.schedule(event_id, self._clock())
+            return
+        with self._cond:
+            self._rescan = True
+            self._cond.notify()
+
+    def watch(self, event_id, hostnames):
+        """Trigger event_id on nova changes to any of hostnames."""
+        with self._cond:
+            for host in hostnames:
+                self._hosts.setdefault(host, set()).add(event_id)
+
+    def unwatch(self, event_id):
+        with self._cond:
+            for (host, events) in self._hosts.items():
+                events.discard(event_id)
+                if not events:
+                    del self._hosts[host]
+
+    def trigger_hosts(self, hostnames):
+        with self._cond:
+            event_ids = set()
+            for host in hostnames:
+                event_ids |= self._hosts.get(host, set())
+        for event_id in event_ids:
+            self.trigger(event_id)
+
+    def next_wake(self):
+        with self._cond:
+            self._discard_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def _discard_stale(self):
+        while self._heap:
+            (wake_at, event_id) = self._heap[0]
+            if self._wake_at.get(event_id) == wake_at:
+                return
+            heapq.heappop(self._heap)
+
+    def _pop_due(self, now):
+        due = []
+        self._discard_stale()
+        while self._heap and self._heap[0][0] <= now:
+            (wake_at, event_id) = heapq.heappop(self._heap)
+            del self._wake_at[event_id]
+            due.append(event_id)
+            self._discard_stale()
+        return due
+
+    def wait(self, max_sleep=None):
+        """Block until events are due or a rescan is triggered. Returns
+        (due event ids, rescan). A rescan is also requested when nothing
+        happens for max_sleep seconds."""
+        if max_sleep is None:
+            max_sleep = CONF.scheduler_max_sleep
+        with self._cond:
+            waited = 0.0
+            while True:
+                now = self._clock()
+                due = self._pop_due(now)
+                if due or self._rescan:
+                    rescan = self._rescan
+                    self._rescan = False
+                    return (due, rescan)
+                if waited >= max_sleep:
+                    return ([], True)
+                timeout = max_sleep - waited
+                if self._heap:
+                    timeout = min(timeout,
+                                  max(_seconds(self._heap[0][0] - now), 0))
+                started = self._clock()
+                self._cond.wait(timeout)
+                waited += _seconds(self._clock() - started)
+
+
+class TriggerListener(threading.Thread):
+    """Receives wake-up datagrams sent by send_trigger(). The payload is
+    an event id, or empty to rescan every event.
+
+    Only one worker per node can hold the trigger port; any other worker
+    there does without triggers and relies on its periodic rescan."""
+    def __init__(self, scheduler, host=None, port=None):
+        super(TriggerListener, self).__init__(name='trigger-listener')
+        self.daemon = True
+        self.scheduler = scheduler
+        address = (host or CONF.trigger_host,
+                   port if port is not None else CONF.trigger_port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.sock.bind(address)
+        except socket.error, e:
+            print >>sys.stderr, (
+                "Cannot listen for triggers on %s:%d (%s); falling back to "
+                "rescanning every %d seconds" % (
+                    address[0], address[1], e, CONF.scheduler_max_sleep))
+            self.sock.close()
+            self.sock = None
+
+    def run(self):
+        if self.sock is None:
+            return
+        while True:
+            (data, addr) = self.sock.recvfrom(64)
+            data = data.strip()
+            if data.isdigit():
+                self.scheduler.trigger(int(data))
+            else:
+                self.scheduler.trigger()
+
+
+def send_trigger(event_id=None):
+    """Best-effort wake-up of a local worker; errors are ignored since the
+    worker rescans the database every scheduler_max_sleep anyway."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(str(event_id or ''), (CONF.trigger_host,
+                                          CONF.trigger_port))
+    except socket.error, e:
+        print >>sys.stderr, "Could not wake poncho-daemon: %s" % (e)
+    finally:
+        sock.close()
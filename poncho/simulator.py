@@ -0,0 +1,234 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+"""
+Virtual-time simulation of a service event, for poncho-service create
+--dry.
+
+The simulation plays a workflow forward against a snapshot of the
+instances on the event's hosts without stepping a clock: every instance
+is notified when the passive drain starts, the drain planner splits them
+into waves, and each wave is issued at the per-host and per-cell action
+rates once the previous wave has finished. Each instance's own
+constraints (terminate_when or reboot_when) are solved for the earliest
+time they allow the action, one vectorised pass per distinct constraint
+program, so operators can see when --notify is too short.
+"""
+
+from oslo.config import cfg
+
+from datetime import datetime, timedelta
+import collections
+
+import numpy
+
+from poncho import actions
+from poncho import annotations
+from poncho import evaluator
+from poncho import planner
+from poncho.nova.inventory import server_host
+
+opts = [
+    cfg.IntOpt('simulate_action_seconds', default=30,
+        help='Seconds an instance action is assumed to take when '
+             'simulating a service event.'),
+]
+CONF = cfg.CONF
+CONF.register_opts(opts)
+CONF.import_opt('polling_interval', 'poncho.workflows')
+
+LAUNCHED_AT_ATTR = 'OS-SRV-USG:launched_at'
+
+# Workflow name -> (instance action, annotation holding its constraints)
+WORKFLOW_ACTIONS = {
+    'delete-instances': ('delete', 'terminate_when'),
+    'restart-instances': ('stop', 'reboot_when'),
+}
+
+_SECONDS_PER_DAY = 86400
+
+
+class SimulatedInstance(collections.namedtuple('SimulatedInstance', [
+        'uuid', 'name', 'host', 'wave', 'notified_at', 'drain_at',
+        'action_at', 'done_at', 'allowed_at'])):
+    """Expected timeline of one instance, as naive UTC datetimes.
+    allowed_at is the earliest time its own constraints allow the action,
+    or None if they never do. Instances held back to keep their HA group
+    at its ha_group_min have no wave and no drain or action times."""
+    __slots__ = ()
+
+    @property
+    def early(self):
+        """True if the action is expected before the constraints allow."""
+        if self.action_at is None:
+            return False
+        return self.allowed_at is None or self.action_at < self.allowed_at
+
+
+class Simulation(object):
+    def __init__(self, action, started_at, instances):
+        self.action = action
+        self.started_at = started_at
+        self.instances = instances
+
+    @property
+    def finished_at(self):
+        done = [instance.done_at for instance in self.instances
+                if instance.done_at is not None]
+        return max(done) if done else self.started_at
+
+    @property
+    def duration(self):
+        return self.finished_at - self.started_at
+
+    def early(self):
+        return [instance for instance in self.instances if instance.early]
+
+    def held(self):
+        return [instance for instance in self.instances
+                if instance.wave is None]
+
+
+def parse_launched_at(server):
+    value = getattr(server, LAUNCHED_AT_ATTR, None)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value.split('.')[0], '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        return None
+
+
+def _inside(window, t):
+    (start, stop, tz) = window
+    local = (t + tz) % _SECONDS_PER_DAY
+    if start > stop:
+        return (start < local) | (local < stop)
+    return (start < local) & (local < stop)
+
+
+def _next_inside(window, t):
+    """Earliest times at or after t inside window, to the second."""
+    (start, stop, tz) = window
+    local = (t + tz) % _SECONDS_PER_DAY
+    wait = (start + 1 - local) % _SECONDS_PER_DAY
+    return numpy.where(_inside(window, t), t, t + wait)
+
+
+def earliest_allowed(program, launched, notified, earliest):
+    """Solve a ConstraintProgram for arrays of epoch seconds: the first
+    time at or after earliest it holds for each instance, NaN if never."""
+    terms = evaluator.program_terms(program)
+    t = earliest.copy()
+    if terms.min_runtime is not None:
+        t = numpy.maximum(t, launched + terms.min_runtime)
+    if terms.notified is not None:
+        t = numpy.maximum(t, notified + terms.notified)
+    if terms.windows:
+        # Moving into one window can leave another; a day of passes is
+        # enough for any combination that overlaps at all.
+        for attempt in range(2 * len(terms.windows) + 1):
+            ok = numpy.ones(len(t), dtype=bool)
+            for window in terms.windows:
+                t = _next_inside(window, t)
+            for window in terms.windows:
+                ok &= _inside(window, t)
+            if ok.all():
+                break
+        t = numpy.where(ok, t, numpy.nan)
+    return t
+
+
+def _datetime(epoch):
+    if numpy.isnan(epoch):
+        return None
+    return datetime.utcfromtimestamp(epoch)
+
+
+def simulate(workflow, servers, passive_drain_at, active_drain_at,
+             grammar=annotations.default, wave_size=None, host_rate=None,
+             cell_rate=None, action_seconds=None):
+    """Simulate workflow on servers, with the drain times in naive UTC.
+    Annotations are read from the servers' metadata."""
+    (action, constraint_key) = WORKFLOW_ACTIONS[workflow]
+    host_rate = host_rate if host_rate is not None \
+        else CONF.action_host_rate
+    cell_rate = cell_rate if cell_rate is not None \
+        else CONF.action_cell_rate
+    action_seconds = action_seconds if action_seconds is not None \
+        else CONF.simulate_action_seconds
+    errors = grammar.validate_many(servers)
+    by_uuid = dict((server.id, server) for server in servers)
+    annotated = {}
+    for server in servers:
+        invalid = errors.get(server.id, {})
+        annotated[server.id] = dict(
+            (key, value) for (key, value) in server.metadata.iteritems()
+            if key in grammar.tags and key not in invalid)
+    tenants = dict((server.id, getattr(server, 'tenant_id', None))
+                   for server in servers)
+    plan = planner.plan_drain([server.id for server in servers], annotated,
+                              wave_size=wave_size, tenants=tenants)
+
+    notified = evaluator.to_epoch(passive_drain_at)
+    drain_start = max(evaluator.to_epoch(active_drain_at), notified)
+    # Each wave is issued at the action rates once the previous one has
+    # finished and the worker has noticed.
+    action_at = {}
+    done_at = {}
+    drain_at = {}
+    host_next = {}
+    cell_next = {}
+    wave_start = drain_start
+    for wave in plan.waves:
+        finished = wave_start
+        for uuid in wave:
+            host = server_host(by_uuid[uuid])
+            cell = actions.host_cell(host)
+            t = max(wave_start, host_next.get(host, wave_start),
+                    cell_next.get(cell, wave_start))
+            if host_rate > 0:
+                host_next[host] = t + 1.0 / host_rate
+            if cell_rate > 0:
+                cell_next[cell] = t + 1.0 / cell_rate
+            drain_at[uuid] = wave_start
+            action_at[uuid] = t
+            done_at[uuid] = t + action_seconds
+            finished = max(finished, done_at[uuid])
+        wave_start = finished + CONF.polling_interval
+
+    # Constraints, solved once per distinct program
+    constraint_set = grammar.tags[constraint_key]
+    programs = {}
+    for server in servers:
+        source = annotated[server.id].get(constraint_key, '')
+        programs.setdefault(constraint_set.compile(source), []).append(
+            server.id)
+    allowed_at = {}
+    for (program, uuids) in programs.iteritems():
+        launched = evaluator.epoch_array(
+            [parse_launched_at(by_uuid[uuid]) for uuid in uuids])
+        allowed = earliest_allowed(
+            program, launched, numpy.repeat(notified, len(uuids)),
+            numpy.repeat(drain_start, len(uuids)))
+        allowed_at.update(zip(uuids, allowed))
+
+    instances = []
+    for server in servers:
+        uuid = server.id
+        if uuid not in plan.wave_of:
+            instances.append(SimulatedInstance(
+                uuid, server.name, server_host(server), None,
+                _datetime(notified), None, None, None,
+                _datetime(allowed_at[uuid])))
+            continue
+        instances.append(SimulatedInstance(
+            uuid, server.name, server_host(server), plan.wave_of[uuid],
+            _datetime(notified), _datetime(drain_at[uuid]),
+            _datetime(action_at[uuid]), _datetime(done_at[uuid]),
+            _datetime(allowed_at[uuid])))
+    return Simulation(action, passive_drain_at, instances)
+
+
+def utc_offset():
+    """Offset to add to local datetimes to get UTC, to the second."""
+    offset = datetime.utcnow() - datetime.now()
+    return timedelta(seconds=int(round(offset.total_seconds())))
@@ -0,0 +1,20 @@
+"""
+Shared test fixtures.
+"""
+
+from oslo.config import cfg
+
+import poncho.db.api as db
+import poncho.db.models as models
+
+
+def memory_db(create=True):
+    """Point poncho at a fresh in-memory sqlite database. With create,
+    the tables are made from the models; without, the database is left
+    empty for the migrations."""
+    cfg.CONF.set_override('sql_connection', 'sqlite://')
+    db._ENGINE = None
+    engine = db.get_engine()
+    if create:
+        models.BASE.metadata.create_all(engine)
+    return engine
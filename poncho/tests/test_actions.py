@@ -0,0 +1,65 @@
+from nose.tools import *
+
+from poncho import actions
+
+
+class FakeServer(object):
+    def __init__(self, id, host, status='ACTIVE', fail=False):
+        self.id = id
+        self.name = id
+        self.status = status
+        self.fail = fail
+        self.deleted = False
+        setattr(self, 'OS-EXT-SRV-ATTR:host', host)
+
+    def delete(self):
+        if self.fail:
+            raise ValueError("nope")
+        self.deleted = True
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+def test_run_issues_and_reports_failures():
+    executor = actions.BulkExecutor(concurrency=4, host_rate=0, cell_rate=0)
+    servers = [FakeServer('a', 'h1'), FakeServer('b', 'h2'),
+               FakeServer('c', 'h2', fail=True)]
+    results = executor.run('delete', servers)
+    assert_equal(['a', 'b'], sorted(results))
+    assert_equal(['c'], results.failures.keys())
+    assert_equal([], results.deferred)
+    assert_true(servers[0].deleted and servers[1].deleted)
+
+
+def test_run_is_throttled_per_host():
+    clock = FakeClock()
+    executor = actions.BulkExecutor(concurrency=1, host_rate=1, cell_rate=0,
+                                    clock=clock, sleep=clock.sleep)
+    servers = [FakeServer(str(i), 'h1') for i in range(3)] + \
+        [FakeServer('other', 'h2')]
+    results = executor.run('delete', servers)
+    assert_equal(4, len(results))
+    # One per second on h1; h2 has its own bucket
+    assert_equal(2.0, clock.now)
+
+
+def test_run_defers_past_max_wait():
+    clock = FakeClock()
+    executor = actions.BulkExecutor(concurrency=1, host_rate=0, cell_rate=1,
+                                    clock=clock, sleep=clock.sleep)
+    servers = [FakeServer(str(i), 'h%d' % i) for i in range(5)]
+    results = executor.run('delete', servers, max_wait=2)
+    assert_equal(3, len(results))
+    assert_equal(2, len(results.deferred))
+    assert_false(any(s.deleted for s in servers if s.id in results.deferred))
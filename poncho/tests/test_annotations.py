@@ -27,6 +27,7 @@ def test_bad_annotations():
     assert_raises(pa.ConstraintSyntaxError, grammar.validate, "reboot_when", "Notified(foo)")
     assert_raises(pa.ConstraintSyntaxError, grammar.validate, "terminate_when", "Notified(foo)")
     assert_raises(pa.ConstraintSyntaxError, grammar.validate, "reboot_when", "Runtime;Notified")
+    assert_raises(pa.ConstraintSyntaxError, grammar.validate, "reboot_when", "Notified(24h)&TimeOfDay(01:00, 03:00)")
     assert_raises(pa.AnnotationSyntaxError, grammar.validate, "priority", "foo")
     assert_raises(pa.AnnotationSyntaxError, grammar.validate, "ha_group_min", "bar")
     assert_raises(pa.AnnotationSyntaxError, grammar.validate, "notify_url", "notanumber")
@@ -88,3 +89,62 @@ def test_time_of_day_parser():
         print expected
         assert pa._parse_time_of_day(case) == expected
         
+
+def test_constraint_program_cache():
+    constraints = pa.ConstraintSet(cache_size=2)
+    constraints.add_constraint('MinRuntime', pa.MinRuntimeConstraint)
+    constraints.add_constraint('Notified', pa.NotifiedConstraint)
+    p1 = constraints.compile("Notified(3m);MinRuntime(4h)")
+    p2 = constraints.compile("Notified(3m);MinRuntime(4h)")
+    assert p1 is p2
+    assert_equal(1, constraints.cache_hits)
+    assert_equal(1, constraints.cache_misses)
+    assert_equal(2, len(p1))
+    # Equivalent programs hash the same regardless of source spelling
+    p3 = constraints.compile("Notified(180s); MinRuntime(240m)")
+    assert_equal(p1, p3)
+    assert_equal(hash(p1), hash(p3))
+    assert_equal({p1: 1}[p3], 1)
+    # Least recently used entry is evicted
+    constraints.compile("MinRuntime(1h)")
+    assert_equal(2, constraints.cache_info()['size'])
+    constraints.compile("Notified(3m);MinRuntime(4h)")
+    assert_equal(4, constraints.cache_misses)
+    assert_raises(pa.ConstraintSyntaxError, constraints.compile, "Foo(1h)")
+    assert_equal(0, len(constraints.compile("")))
+
+def test_validate_many():
+    import collections
+    Server = collections.namedtuple('Server', ['id', 'metadata'])
+    servers = [
+        Server('a', {'priority': '3', 'reboot_when': 'MinRuntime(2h)'}),
+        Server('b', {'priority': 'high', 'reboot_when': 'Runner()',
+                     'unrelated': 'x'}),
+        Server('c', {'priority': 'high'}),
+        Server('d', {}),
+    ]
+    grammar = pa.default
+    assert grammar.validate_server(servers[0])
+    assert_raises(pa.AnnotationSyntaxError, grammar.validate_server,
+                  servers[1])
+    report = grammar.validate_many(servers)
+    assert_equal(['b', 'c'], sorted(report.keys()))
+    assert_equal(set(['priority', 'reboot_when']), set(report['b'].keys()))
+    assert isinstance(report['b']['reboot_when'], pa.ConstraintSyntaxError)
+    # Identical pairs share one validation result
+    assert report['b']['priority'] is report['c']['priority']
+
+
+def test_validate_many_unicode():
+    import collections
+    import json
+    Server = collections.namedtuple('Server', ['id', 'metadata'])
+    servers = [
+        Server('a', json.loads('{"priority": "3", "ha_group_min": "2", '
+                              '"snapshot_on_terminate": "True"}')),
+        Server('b', json.loads('{"priority": "high"}')),
+        Server('c', {'ha_group_min': 2}),
+    ]
+    report = pa.default.validate_many(servers)
+    assert_equal(['b', 'c'], sorted(report.keys()))
+    assert isinstance(report['c']['ha_group_min'], pa.AnnotationSyntaxError)
@@ -0,0 +1,60 @@
+from nose.tools import *
+
+from datetime import datetime, timedelta
+import os
+import shutil
+import tempfile
+
+import poncho.db.api as db
+import poncho.db.models as models
+from poncho import archive
+from poncho.tests import fixtures
+
+
+def setup():
+    fixtures.memory_db()
+
+
+def _make_event(session, hosts, completed_at=None):
+    event = models.ServiceEvent(
+        description='disk swap', notes='', workflow='delete-instances',
+        begin_passive_drain_at=datetime(2013, 1, 1),
+        begin_active_drain_at=datetime(2013, 1, 3), state='completed',
+        completed=completed_at is not None, completed_at=completed_at,
+        hosts=hosts)
+    session.add(event)
+    session.flush()
+    session.add(models.Instance(uuid='uuid-%d' % event.id,
+                                service_event_id=event.id, state='done',
+                                host_id=hosts[0].id))
+    session.commit()
+    return event.id
+
+
+def test_archive_events():
+    session = db.get_session()
+    hosts = db.ensure_hosts(['a1', 'a2'], session=session)
+    old = datetime.now() - timedelta(days=400)
+    archived_ids = [_make_event(session, hosts, old) for i in range(5)]
+    recent = _make_event(session, hosts, datetime.now())
+    active = _make_event(session, hosts)
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'events.jsonl.gz')
+        assert_equal(5, archive.archive_events(path, dry_run=True))
+        assert_false(os.path.exists(path))
+        assert_equal(5, archive.archive_events(path, batch_size=2))
+        records = list(archive.read_archive(path))
+        assert_equal(archived_ids, [record['id'] for record in records])
+        assert_equal(['a1', 'a2'], records[0]['hosts'])
+        assert_equal(['uuid-%d' % archived_ids[0]],
+                     [i['uuid'] for i in records[0]['instances']])
+        assert_equal(0, archive.archive_events(path))
+    finally:
+        shutil.rmtree(directory)
+    session = db.get_session()
+    remaining = [event.id for event in
+                 db.get_events(session=session, include_completed=True)]
+    assert_equal([recent, active], remaining)
+    assert_equal(2, session.query(models.Instance).count())
+    assert_equal(4, session.query(models.host_association_table).count())
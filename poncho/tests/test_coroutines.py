@@ -0,0 +1,59 @@
+from nose.tools import *
+
+import threading
+
+from poncho import coroutines
+
+
+def test_run_overlaps_calls():
+    barrier = []
+    lock = threading.Lock()
+    both = threading.Event()
+
+    def io(n):
+        # Only returns once both calls are running at the same time
+        with lock:
+            barrier.append(n)
+            if len(barrier) == 2:
+                both.set()
+        assert both.wait(5)
+        return n * 2
+
+    def coroutine():
+        (a, b) = yield [coroutines.call(io, 1), coroutines.call(io, 2)]
+        c = yield coroutines.call(lambda: a + b)
+        raise coroutines.Return(c)
+    assert_equal(6, coroutines.run(coroutine()))
+
+
+def test_run_throws_errors_into_coroutine():
+    def fail():
+        raise IOError("nova unavailable")
+
+    def coroutine():
+        try:
+            yield [coroutines.call(fail), coroutines.call(lambda: 1)]
+        except IOError:
+            raise coroutines.Return("handled")
+    assert_equal("handled", coroutines.run(coroutine()))
+
+    def unhandled():
+        yield coroutines.call(fail)
+    assert_raises(IOError, coroutines.run, unhandled())
+
+
+def test_async_adapter():
+    class Thing(object):
+        def double(self, n):
+            return n * 2
+
+    def coroutine():
+        result = yield coroutines.Async(Thing()).double(21)
+        raise coroutines.Return(result)
+    assert_equal(42, coroutines.run(coroutine()))
+
+
+def test_plain_generator_returns_none():
+    def coroutine():
+        yield coroutines.call(lambda: 1)
+    assert_equal(None, coroutines.run(coroutine()))
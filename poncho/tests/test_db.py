@@ -0,0 +1,282 @@
+from nose.tools import *
+
+import os
+import shutil
+import tempfile
+import threading
+
+import sqlalchemy.event
+
+import poncho.db.api as db
+import poncho.db.models as models
+from poncho.tests import fixtures
+
+
+def setup():
+    fixtures.memory_db()
+
+
+def test_sync_annotations():
+    session = db.get_session()
+    db.sync_annotations({
+        'uuid-1': ('tenant-a', {'ha_group_id': 'web', 'priority': '3',
+                                'notify_url': 'http://a.example.com/'}),
+        'uuid-2': ('tenant-a', {'ha_group_id': 'web'}),
+        'uuid-3': ('tenant-b', {'ha_group_id': 'db',
+                                'notify_url': 'http://b.example.com/'}),
+    }, session=session)
+    assert_equal(['uuid-1', 'uuid-2'],
+                 sorted(db.get_ha_group_instances('web', session=session)))
+    assert_equal(set(['http://a.example.com/']),
+                 db.get_tenant_notify_urls('tenant-a', session=session))
+    # Incremental update: uuid-2 changes group, uuid-1 loses a key and
+    # uuid-3 is deleted.
+    db.sync_annotations({
+        'uuid-1': ('tenant-a', {'ha_group_id': 'web', 'priority': '3'}),
+        'uuid-2': ('tenant-a', {'ha_group_id': 'db'}),
+        'uuid-3': None,
+    }, session=session)
+    assert_equal(['uuid-1'], db.get_ha_group_instances('web', session=session))
+    assert_equal(['uuid-2'], db.get_ha_group_instances('db', session=session))
+    assert_equal({'ha_group_id': 'web', 'priority': '3'},
+                 db.get_instance_annotations('uuid-1', session=session))
+    assert_equal(set(), db.get_tenant_notify_urls('tenant-b', session=session))
+    assert_equal({'uuid-1': {'ha_group_id': 'web', 'priority': '3'},
+                  'uuid-2': {'ha_group_id': 'db'}},
+                 db.get_annotations_for_instances(
+                     ['uuid-1', 'uuid-2', 'uuid-3'], session=session))
+    assert_equal({'uuid-1': {'priority': '3'}},
+                 db.get_annotations_for_instances(
+                     ['uuid-1', 'uuid-2'], ['priority'], session=session))
+    db.sync_annotations({
+        'uuid-4': ('tenant-b', {'ha_group_id': 'web'}),
+    }, session=session)
+    assert_equal({('tenant-a', 'web'): 1, ('tenant-a', 'db'): 1},
+                 db.get_ha_group_sizes([('tenant-a', 'web'),
+                                        ('tenant-a', 'db'),
+                                        ('tenant-a', 'none')],
+                                       session=session))
+    assert_equal({('tenant-b', 'web'): 1},
+                 db.get_ha_group_sizes([('tenant-b', 'web')],
+                                       session=session))
+
+
+def _make_event(session, **kwargs):
+    from datetime import datetime
+    values = dict(description='', notes='', workflow='delete-instances',
+                  begin_passive_drain_at=datetime.now(),
+                  begin_active_drain_at=datetime.now(), state='initialized')
+    values.update(kwargs)
+    event = models.ServiceEvent(**values)
+    session.add(event)
+    session.commit()
+    return event
+
+
+def test_event_leases():
+    from datetime import timedelta
+    session = db.get_session()
+    event = _make_event(session)
+    lease = timedelta(minutes=2)
+    assert db.claim_event(event.id, 'w1', lease, session=session)
+    assert db.claim_event(event.id, 'w1', lease, session=session)
+    assert not db.claim_event(event.id, 'w2', lease, session=session)
+    # Only the lease holder can move the state, and only from the state
+    # it last saw.
+    assert not db.transition_event(event.id, 'w2', 'initialized',
+                                   'passive_drain', session=session)
+    assert db.transition_event(event.id, 'w1', 'initialized',
+                               'passive_drain', session=session)
+    assert not db.transition_event(event.id, 'w1', 'initialized',
+                                   'passive_drain', session=session)
+    assert_equal(1, db.renew_leases('w1', [event.id], lease,
+                                    session=session))
+    assert_equal(0, db.renew_leases('w2', [event.id], lease,
+                                    session=session))
+    db.release_event(event.id, 'w1', session=session)
+    assert db.claim_event(event.id, 'w2', lease, session=session)
+    # An expired lease is taken over
+    assert db.claim_event(event.id, 'w2', -lease, session=session)
+    assert db.claim_event(event.id, 'w1', lease, session=session)
+    session.expire_all()
+    assert_equal('passive_drain', db.get_event(event.id, session).state)
+
+
+class QueryCounter(object):
+    def __init__(self, engine):
+        self.count = 0
+        sqlalchemy.event.listen(engine, 'before_cursor_execute', self)
+
+    def __call__(self, *args):
+        self.count += 1
+
+
+def test_ensure_hosts():
+    session = db.get_session()
+    db.ensure_hosts(['h0', 'h1'], session=session)
+    session.commit()
+    names = ['h%d' % i for i in range(300)] + ['h1']
+    counter = QueryCounter(db.get_engine())
+    hosts = db.ensure_hosts(names, session=session)
+    session.commit()
+    # Existing hosts, the insert of the rest and reading them back
+    assert_equal(3, counter.count)
+    assert_equal(names[:300], [host.name for host in hosts])
+    assert_equal(300, session.query(models.Host).count())
+    assert_equal(hosts[1].id, db.ensure_host('h1', session=session).id)
+
+
+def test_events_load_hosts_eagerly():
+    session = db.get_session()
+    hosts = db.ensure_hosts(['e%d' % i for i in range(10)], session=session)
+    ids = [_make_event(session, hosts=hosts[i:i + 3]).id for i in range(5)]
+    _make_event(session, completed=True)
+    session = db.get_session()
+    counter = QueryCounter(db.get_engine())
+    events = db.get_events(session=session)
+    names = [[host.name for host in event.hosts] for event in events]
+    assert_equal(1, counter.count)
+    assert_true(['e0', 'e1', 'e2'] in names)
+    assert_equal(len(events) + 1,
+                 len(db.get_events(session=session, include_completed=True)))
+    locked = db.get_events_for_update(ids + [9999], session=session)
+    assert_equal(sorted(ids), sorted(locked))
+    session.rollback()
+
+
+def test_sessions():
+    session = db.get_session(autocommit=True, expire_on_commit=True)
+    assert_true(session.autocommit)
+    assert_true(db.get_session().autocommit is False)
+    assert_true(db.get_session() is not db.get_session())
+    scoped = db.get_scoped_session()
+    assert_true(scoped is db.get_scoped_session())
+    others = []
+    thread = threading.Thread(
+        target=lambda: others.append(db.get_scoped_session()))
+    thread.start()
+    thread.join()
+    assert_true(others[0] is not scoped)
+    with db.session_scope() as session:
+        assert_true(session is scoped)
+    assert_true(db.get_scoped_session() is not scoped)
+
+
+def test_sqlite_file_settings():
+    directory = tempfile.mkdtemp()
+    try:
+        engine = db.create_engine(
+            'sqlite:///' + os.path.join(directory, 'poncho.sqlite'))
+        connection = engine.connect()
+        assert_equal('wal', connection.execute(
+            "PRAGMA journal_mode").scalar())
+        assert_equal(5000, connection.execute(
+            "PRAGMA busy_timeout").scalar())
+        connection.close()
+        engine.dispose()
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_host_writers_serialize_on_sqlite():
+    directory = tempfile.mkdtemp()
+    try:
+        engine = db.create_engine(
+            'sqlite:///' + os.path.join(directory, 'poncho.sqlite'))
+        models.BASE.metadata.create_all(engine)
+        maker = db.make_sessionmaker(engine, False, False)
+        first = maker()
+        hosts = db.ensure_hosts(['r1'], session=first)
+        first.commit()
+        db.lock_hosts(hosts, session=first)
+        db.ensure_hosts(['r2'], session=first)
+        # A second writer inserting the same new name waits for the lock,
+        # then loses the race and reads back the first writer's row
+        result = []
+        second = threading.Thread(target=lambda: result.append(
+            db.ensure_hosts(['r2'], session=maker())[0].id))
+        second.start()
+        second.join(0.2)
+        assert_true(second.is_alive())
+        first.commit()
+        second.join()
+        first_id = first.query(models.Host.id).\
+            filter(models.Host.name == 'r2').scalar()
+        assert_equal([first_id], result)
+        first.close()
+        engine.dispose()
+    finally:
+        shutil.rmtree(directory)
+
+
+class FakeArgs(object):
+    def __init__(self, hosts, delay=0, notify=60, force=False):
+        self.hosts = hosts
+        self.delay = delay
+        self.notify = notify
+        self.force = force
+        self.description = ''
+        self.notes = ''
+        self.workflow = 'delete-instances'
+        self.dry = False
+
+
+def test_host_conflicts():
+    session = db.get_session()
+    first = db.create_event(FakeArgs(['c1', 'c2']), session=session)
+    # Overlapping drain window on c2
+    try:
+        db.create_event(FakeArgs(['c2', 'c3']), session=session)
+        assert False, "expected HostConflict"
+    except db.HostConflict, e:
+        assert_equal(['c2'], e.conflicts.keys())
+        assert_equal([first.id], [event.id for event in e.conflicts['c2']])
+    # Far enough in the future not to overlap
+    later = db.create_event(FakeArgs(['c2'], delay=60 * 24 * 7),
+                            session=session)
+    forced = db.create_event(FakeArgs(['c2', 'c3'], force=True),
+                             session=session)
+    assert_equal([first.id, later.id, forced.id],
+                 [event.id for event in db.get_active_events_for_hosts(
+                     ['c2'], session=session)['c2']])
+    assert_equal(['c1'], db.get_releasable_hosts(first.id, session=session))
+    forced.completed = True
+    later.completed = True
+    session.commit()
+    assert_equal(['c1', 'c2'],
+                 db.get_releasable_hosts(first.id, session=session))
+    assert_equal({}, db.get_active_events_for_hosts(
+        ['c2', 'c3'], exclude_event_id=first.id, session=session))
+
+
+def test_dry_create_writes_nothing():
+    session = db.get_session()
+    db.create_event(FakeArgs(['y1']), session=session)
+    args = FakeArgs(['y1', 'y2', 'y1'], force=True)
+    args.dry = True
+    event = db.create_event(args, session=session)
+    assert_equal(['y1', 'y2'], [host.name for host in event.hosts])
+    assert_equal(None, event.id)
+    assert_false(session.new or session.dirty)
+    assert_equal(0, session.query(models.Host).filter(
+        models.Host.name == 'y2').count())
+    assert_equal(1, len(db.get_active_events_for_hosts(
+        ['y1'], session=session)['y1']))
+    args.force = False
+    assert_raises(db.HostConflict, db.create_event, args, session=session)
+
+
+def test_cancel_only_enables_hosts_poncho_disabled():
+    import poncho.manager
+    session = db.get_session()
+    waiting = db.create_event(FakeArgs(['d1']), session=session)
+    drained = db.create_event(FakeArgs(['d2']), session=session)
+    drained.state = 'drained'
+    session.commit()
+    enabled = []
+    manager = poncho.manager.ServiceEventManager()
+    manager.enable_event_hosts = \
+        lambda event, session=None: enabled.append(event.id)
+    manager.cancel_event(waiting.id)
+    manager.cancel_event(drained.id)
+    assert_equal([drained.id], enabled)
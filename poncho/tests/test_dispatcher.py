@@ -0,0 +1,89 @@
+from nose.tools import *
+
+from datetime import datetime, timedelta
+
+from oslo.config import cfg
+
+import poncho.db.api as db
+import poncho.db.models as models
+from poncho import dispatcher
+from poncho import notifications as pn
+from poncho.tests import fixtures
+
+
+def setup():
+    fixtures.memory_db()
+
+
+class FakeTransport(object):
+    def __init__(self, down=()):
+        self.down = set(down)
+        self.sent = []
+
+    def __call__(self, item):
+        if item.destination in self.down:
+            raise IOError("connection refused")
+        self.sent.append((item.destination, item.payload))
+
+
+def test_dedup_and_dispatch():
+    session = db.get_session()
+    n = pn.notification(
+        timestamp=datetime(2013, 5, 1), description="disk swap",
+        type="terminating", instance_uuid="UUID", instance_name="NAME")
+    key = n.dedup_key('http', 'http://up/')
+    assert db.enqueue_notification('http', 'http://up/', n.as_json(), key,
+                                   session=session)
+    assert_equal(None, db.enqueue_notification(
+        'http', 'http://up/', n.as_json(), key, session=session))
+    for i in range(2):
+        db.enqueue_notification('http', 'http://down/', str(i), 'down%d' % i,
+                                session=session)
+
+    transport = FakeTransport(down=['http://down/'])
+    d = dispatcher.NotificationDispatcher(transports={'http': transport})
+    assert_equal(1, d.dispatch_once())
+    assert_equal([('http://up/', n.as_json())], transport.sent)
+
+    rows = session.query(models.QueuedNotification).\
+        order_by(models.QueuedNotification.id).all()
+    assert_equal(['delivered', 'pending', 'pending'],
+                 [r.status for r in rows])
+    # The failing item counts an attempt, the one behind it is only held
+    assert_equal([0, 1, 0], [r.attempts for r in rows])
+    assert rows[1].next_attempt_at > datetime.utcnow()
+    assert_equal(rows[1].next_attempt_at, rows[2].next_attempt_at)
+    assert_equal(0, d.dispatch_once())
+
+
+def test_backoff():
+    assert_equal(timedelta(seconds=30), dispatcher.backoff(1))
+    assert_equal(timedelta(seconds=120), dispatcher.backoff(3))
+    assert_equal(timedelta(seconds=1920), dispatcher.backoff(7))
+    cfg.CONF.set_override('dispatch_backoff_max', 600, group='notify')
+    assert_equal(timedelta(seconds=600), dispatcher.backoff(7))
+    cfg.CONF.clear_override('dispatch_backoff_max', group='notify')
+    assert_equal(None, dispatcher.backoff(8))
+
+
+def test_batched_endpoint():
+    session = db.get_session()
+    for i in range(3):
+        db.enqueue_notification('http', 'http://batch/', '{"n": %d}' % i,
+                                'batch%d' % i, session=session)
+    batches = []
+    cfg.CONF.set_override('http_batch_urls', ['http://batch/'],
+                          group='notify')
+    try:
+        batcher = pn.batch_delivery('http', 'http://batch/')
+        assert batcher is not None
+        assert_equal(None, pn.batch_delivery('http', 'http://other/'))
+        d = dispatcher.NotificationDispatcher(
+            transports={'http': FakeTransport()},
+            batcher=lambda t, dest: batches.append)
+        assert_equal(3, d.dispatch_once())
+    finally:
+        cfg.CONF.clear_override('http_batch_urls', group='notify')
+    assert_equal(1, len(batches))
+    assert_equal(['{"n": 0}', '{"n": 1}', '{"n": 2}'],
+                 [item.payload for item in batches[0]])
@@ -0,0 +1,58 @@
+from nose.tools import *
+from datetime import datetime, timedelta
+
+from poncho import annotations as pa
+from poncho import evaluator
+
+
+def _compile(string):
+    return pa.default.tags['terminate_when'].compile(string)
+
+
+def _scalar(program, launched_at, notified_at, now):
+    context = {'launched_at': launched_at, 'notified_at': notified_at,
+               'now': now}
+    return all(c.is_valid(context) for c in program)
+
+
+def test_evaluate_matches_scalar():
+    now = datetime(2013, 5, 1, 23, 30)
+    programs = [_compile(s) for s in [
+        "", "MinRuntime(2h)", "Notified(10m)", "Notified(10m);MinRuntime(1d)",
+        "TimeOfDay(22:00, 06:00)", "TimeOfDay(08:00, 17:00)",
+        "TimeOfDay(08:00, 17:00, -08:00)"]]
+    times = [None, now - timedelta(minutes=5), now - timedelta(hours=3),
+             now - timedelta(days=2)]
+    cases = [(p, l, n) for p in programs for l in times for n in times]
+    mask = evaluator.evaluate([c[0] for c in cases], [c[1] for c in cases],
+                              [c[2] for c in cases], now=now)
+    assert_equal(len(cases), len(mask))
+    for (case, result) in zip(cases, mask):
+        assert_equal(_scalar(case[0], case[1], case[2], now), bool(result))
+
+
+def test_evaluate_empty():
+    assert_equal(0, len(evaluator.evaluate([], [], [])))
+
+
+def test_evaluate_length_mismatch():
+    assert_raises(ValueError, evaluator.evaluate, [_compile("")], [], [])
+
+
+def test_program_terms():
+    terms = evaluator.program_terms(
+        _compile("MinRuntime(1h);Runtime(2h);Notified(5m)"))
+    assert_equal(7200, terms.min_runtime)
+    assert_equal(300, terms.notified)
+    assert_equal((), terms.windows)
+
+
+def test_program_terms_cache_is_bounded():
+    real_size = evaluator._TERMS_SIZE
+    evaluator._TERMS_SIZE = 2
+    try:
+        for hours in range(1, 5):
+            evaluator.program_terms(_compile("MinRuntime(%dh)" % hours))
+        assert_equal(2, len(evaluator._TERMS))
+    finally:
+        evaluator._TERMS_SIZE = real_size
@@ -0,0 +1,54 @@
+from nose.tools import *
+
+from poncho import hagroups
+
+
+class FakeServer(object):
+    def __init__(self, id, status='ACTIVE', tenant_id='t', **metadata):
+        self.id = id
+        self.status = status
+        self.tenant_id = tenant_id
+        self.metadata = metadata
+
+
+def web(id, status='ACTIVE'):
+    return FakeServer(id, status, ha_group_id='web', ha_group_min='2')
+
+
+def test_transitions_only_on_threshold_crossing():
+    tracker = hagroups.HaGroupTracker(send=False)
+    # The first sighting is the baseline
+    assert_equal([], tracker.apply([web('a'), web('b'), web('c')],
+                                   full=True))
+    group = tracker.get_group('t', 'web')
+    assert_equal(3, len(group.active))
+    # Still two active: no change
+    assert_equal([], tracker.apply([web('c', 'SHUTOFF')]))
+    transitions = tracker.apply([web('b', 'ERROR')])
+    assert_equal([(group, False)], transitions)
+    assert_equal(set(['a']), group.active)
+    assert_equal([], tracker.apply([web('b', 'ERROR')]))
+    assert_equal([(group, True)], tracker.apply([web('c')]))
+
+
+def test_membership_changes():
+    tracker = hagroups.HaGroupTracker(send=False)
+    tracker.apply([web('a'), web('b'), FakeServer('x')], full=True)
+    group = tracker.get_group('t', 'web')
+    # Moving out of the group, deletion and a full listing without a
+    # member all shrink the group.
+    assert_equal([(group, False)], tracker.apply([FakeServer('a')]))
+    assert_equal(set(['b']), group.members)
+    tracker.apply([web('a')])
+    tracker.apply([web('b', 'DELETED')])
+    assert_equal(set(['a']), group.members)
+    tracker.apply([FakeServer('x')], full=True)
+    assert_equal(None, tracker.get_group('t', 'web'))
+
+
+def test_invalid_min_is_ignored():
+    tracker = hagroups.HaGroupTracker(send=False)
+    tracker.apply([FakeServer('a', ha_group_id='db', ha_group_min='lots')])
+    group = tracker.get_group('t', 'db')
+    assert_equal(None, group.minimum())
+    assert_true(group.is_healthy())
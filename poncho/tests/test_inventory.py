@@ -0,0 +1,43 @@
+from nose.tools import *
+
+from poncho.nova.inventory import Inventory, HOST_ATTR
+
+
+class FakeServer(object):
+    def __init__(self, id, host, status='ACTIVE'):
+        self.id = id
+        self.status = status
+        setattr(self, HOST_ATTR, host)
+
+
+class FakeClient(object):
+    def __init__(self, batches):
+        self.batches = batches
+        self.calls = []
+
+    def get_changed_servers(self, since=None):
+        self.calls.append(since)
+        return self.batches.pop(0)
+
+
+def test_inventory_deltas():
+    client = FakeClient([
+        [FakeServer('a', 'h1'), FakeServer('b', 'h1'), FakeServer('c', 'h2')],
+        [FakeServer('a', 'h2'), FakeServer('b', 'h1', status='DELETED')],
+    ])
+    seen = []
+    inventory = Inventory()
+    inventory.add_listener(lambda servers, full: seen.append(full))
+    assert not inventory.is_fresh()
+    inventory.refresh(client)
+    assert inventory.is_fresh()
+    assert_equal(['a', 'b'],
+                 sorted(s.id for s in inventory.get_host_servers('h1')))
+    inventory.refresh(client)
+    assert_equal(None, client.calls[0])
+    assert client.calls[1] is not None
+    assert_equal([], inventory.get_host_servers('h1'))
+    assert_equal(['a', 'c'],
+                 sorted(s.id for s in inventory.get_host_servers('h2')))
+    assert_equal(None, inventory.get_server('b'))
+    assert_equal([True, False], seen)
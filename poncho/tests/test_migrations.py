@@ -0,0 +1,82 @@
+from nose.tools import *
+
+import poncho.db.api as db
+import poncho.db.models as models
+from poncho.db import migration
+from poncho.tests import fixtures
+
+
+def fresh_db():
+    fixtures.memory_db(create=False)
+
+
+def _index_names(table):
+    rows = db.get_engine().execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' "
+        "AND tbl_name = '%s'" % (table))
+    return set(row[0] for row in rows
+               if not row[0].startswith('sqlite_autoindex'))
+
+
+def _column_names(table):
+    rows = db.get_engine().execute("PRAGMA table_info(%s)" % (table))
+    return set(row[1] for row in rows)
+
+
+def _assert_matches_models():
+    assert_equal(migration.head_version(), migration.db_version())
+    for table in models.BASE.metadata.sorted_tables:
+        assert_equal(set(column.name for column in table.columns),
+                     _column_names(table.name))
+        expected = set(index.name for index in table.indexes)
+        if table.name == 'service_events':
+            expected.add('ix_service_events_active')
+        assert_equal(expected, _index_names(table.name))
+
+
+@with_setup(fresh_db)
+def test_migrations_match_models():
+    _migrate_with_duplicate_hosts()
+    _assert_matches_models()
+
+
+@with_setup(fresh_db)
+def test_unversioned_database_is_upgraded():
+    # A database made by create_all() before migrations existed has the
+    # initial schema and no alembic_version table
+    migration.db_sync(migration.INITIAL_REVISION)
+    db.get_engine().execute("DROP TABLE alembic_version")
+    assert_equal(None, migration.db_version())
+    migration.db_sync()
+    _assert_matches_models()
+
+
+def _migrate_with_duplicate_hosts():
+    migration.db_sync(migration.INITIAL_REVISION)
+    engine = db.get_engine()
+    # Duplicate hosts left behind by the old ensure_host()
+    for (id, name) in [(1, 'h1'), (2, 'h1'), (3, 'h2')]:
+        engine.execute("INSERT INTO hosts (id, name) VALUES (?, ?)", id, name)
+    engine.execute("INSERT INTO service_events (id, description, notes, "
+                   "workflow, begin_passive_drain_at, begin_active_drain_at, "
+                   "completed) VALUES (1, '', '', 'w', '2013-01-01', "
+                   "'2013-01-01', 0)")
+    engine.execute("INSERT INTO service_events_to_hosts VALUES (1, 2)")
+    engine.execute("INSERT INTO service_events_to_hosts VALUES (1, 3)")
+    migration.db_sync()
+    assert_equal([(1, 'h1'), (3, 'h2')], list(engine.execute(
+        "SELECT id, name FROM hosts ORDER BY id")))
+    assert_equal([(1,), (3,)], list(engine.execute(
+        "SELECT host_id FROM service_events_to_hosts ORDER BY host_id")))
+
+
+@with_setup(fresh_db)
+def test_downgrade():
+    from alembic import command
+    migration.db_sync()
+    # sqlite cannot drop the columns added after the initial schema, so
+    # only the index revision is reversed here
+    command.downgrade(migration.get_config(), '9e6c2d4b7a51')
+    assert_equal(set(), _index_names('hosts'))
+    migration.db_sync()
+    assert_equal(set(['uq_hosts_name']), _index_names('hosts'))
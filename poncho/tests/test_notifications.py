@@ -25,3 +25,86 @@ def test_notification_constructor():
         instance_uuid="UUID", instance_name="NAME") 
     isinstance(n, pn.Terminating)
     isinstance(str(n), str)
+
+def test_smtp_sender_reuses_connection():
+    connections = []
+    class FakeSMTP(object):
+        def __init__(self, server):
+            self.sent = []
+            connections.append(self)
+        def sendmail(self, from_addr, to_addrs, message):
+            if len(self.sent) == 2:
+                raise pn.smtplib.SMTPServerDisconnected()
+            self.sent.append(to_addrs)
+    real_smtp = pn.smtplib.SMTP
+    pn.smtplib.SMTP = FakeSMTP
+    try:
+        sender = pn.SmtpSender(rate=0)
+        for i in range(4):
+            sender.send("poncho@example.com", ["user@example.com"], "msg")
+    finally:
+        pn.smtplib.SMTP = real_smtp
+    # Reconnects once after the server drops the connection
+    assert_equal([2, 2], [len(c.sent) for c in connections])
+
+def test_email_digest():
+    class Item(object):
+        def __init__(self, payload):
+            self.subject = "Subject"
+            self.payload = payload
+    sent = []
+    real_deliver = pn.deliver_email
+    pn.deliver_email = lambda *args: sent.append(args)
+    try:
+        batch = pn.batch_delivery('email', 'user@example.com')
+        batch([Item("first"), Item("second")])
+    finally:
+        pn.deliver_email = real_deliver
+    assert_equal(1, len(sent))
+    (address, subject, body) = sent[0]
+    assert_equal('user@example.com', address)
+    assert "2 notifications" in body
+    assert "first" in body and "second" in body
+
+def test_instance_notification_emails_owner():
+    class Fake(object):
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
+    nova = Fake(get_server=lambda uuid: Fake(user_id='user-' + uuid))
+    keystone = Fake(users=Fake(
+        get=lambda user_id: Fake(email='%s@example.com' % user_id)))
+    real_nova, real_keystone = pn._NOVA_CLIENT, pn._KEYSTONE_CLIENT
+    pn._NOVA_CLIENT, pn._KEYSTONE_CLIENT = nova, keystone
+    try:
+        n = pn.notification(
+            timestamp=datetime.now(), description="", type="terminating",
+            instance_uuid="UUID", instance_name="NAME")
+        assert_equal(['user-UUID@example.com'], n.notify_emails())
+
+        # Already deleted: the owner passed by the sender is used, and a
+        # failed lookup skips the email rather than raising
+        def gone(uuid):
+            raise LookupError(uuid)
+        nova.get_server = gone
+        n = pn.notification(
+            timestamp=datetime.now(), description="", type="terminating",
+            instance_uuid="UUID", instance_name="NAME", user_id='owner')
+        assert_equal(['owner@example.com'], n.notify_emails())
+        n.user_id = None
+        assert_equal([], n.notify_emails())
+    finally:
+        pn._NOVA_CLIENT, pn._KEYSTONE_CLIENT = real_nova, real_keystone
+
+def test_dedup_key_ignores_timestamp():
+    def terminating(timestamp, event_id):
+        return pn.notification(
+            timestamp=timestamp, description="", type="terminating",
+            event_id=event_id, instance_uuid="UUID", instance_name="NAME")
+    key = terminating(datetime(2013, 5, 1), 1).dedup_key('http', 'http://a/')
+    # A retry builds the notification again with a new timestamp
+    assert_equal(key, terminating(datetime(2013, 5, 2), 1).dedup_key(
+        'http', 'http://a/'))
+    assert_not_equal(key, terminating(datetime(2013, 5, 1), 2).dedup_key(
+        'http', 'http://a/'))
+    assert_not_equal(key, terminating(datetime(2013, 5, 1), 1).dedup_key(
+        'http', 'http://b/'))
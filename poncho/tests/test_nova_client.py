@@ -0,0 +1,60 @@
+from nose.tools import *
+
+from poncho.nova import client
+
+
+def test_fan_out_partial_failure():
+    nova = client.Client(inventory=None)
+
+    def list_host(host):
+        if host == 'bad':
+            raise IOError("unreachable")
+        return [host + '-vm']
+    results = nova._fan_out(list_host, ['h1', 'h2', 'bad', 'h1'],
+                            concurrency=2)
+    assert_equal({'h1': ['h1-vm'], 'h2': ['h2-vm']}, dict(results))
+    assert_equal(['bad'], results.failures.keys())
+    assert isinstance(results.failures['bad'], IOError)
+    assert_equal({}, dict(nova._fan_out(list_host, [])))
+
+
+def test_set_services_enabled():
+    calls = []
+
+    class FakeServices(object):
+        def disable(self, host, binary):
+            calls.append((host, binary))
+            if host == 'bad':
+                raise IOError("unreachable")
+            return 'disabled'
+
+    nova = client.Client(inventory=None)
+    nova.nova_client.services = FakeServices()
+    results = nova.set_services_enabled(['h1', 'h2', 'bad'], 'nova-compute',
+                                        False)
+    assert_equal({'h1': 'disabled', 'h2': 'disabled'}, dict(results))
+    assert_equal(['bad'], results.failures.keys())
+    assert_equal(3, len(calls))
+
+
+def test_changed_servers_paging():
+    from oslo.config import cfg
+    import collections
+    Server = collections.namedtuple('Server', ['id'])
+    fleet = [Server(str(i)) for i in range(5)]
+    calls = []
+
+    class FakeServers(object):
+        def list(self, search_opts=None, marker=None, limit=None):
+            calls.append(marker)
+            start = 0 if marker is None else int(marker) + 1
+            return fleet[start:start + limit]
+
+    cfg.CONF.set_override('nova_page_size', 2)
+    try:
+        nova = client.Client(inventory=None)
+        nova.nova_client.servers = FakeServers()
+        assert_equal(fleet, nova.get_changed_servers())
+        assert_equal([None, '1', '3'], calls)
+    finally:
+        cfg.CONF.clear_override('nova_page_size')
@@ -0,0 +1,99 @@
+from nose.tools import *
+
+from poncho import planner
+
+
+def test_priority_order_and_waves():
+    annotations = {
+        'a': {'priority': '5'},
+        'b': {'priority': '1'},
+        'c': {},
+    }
+    plan = planner.plan_drain(['a', 'b', 'c'], annotations, wave_size=2)
+    assert_equal([['c', 'b'], ['a']], plan.waves)
+    assert_equal(1, plan.wave_of['a'])
+
+
+def test_ha_group_budget():
+    # Group of five, of which three must stay up: two over the whole drain
+    annotations = dict(('web-%d' % i, {'ha_group_id': 'web',
+                                       'ha_group_min': '3'})
+                       for i in range(5))
+    annotations['other'] = {'priority': '9'}
+    uuids = sorted(annotations)
+    plan = planner.plan_drain(uuids, annotations, wave_size=2)
+    assert_equal([2, 1], [len(wave) for wave in plan.waves])
+    assert_equal(['web-0', 'web-1'], plan.waves[0])
+    assert_equal(['web-2', 'web-3', 'web-4'], sorted(plan.held))
+    assert_equal(set([(None, 'web')]), plan.constrained)
+
+
+def test_later_waves_do_not_deadlock():
+    # Group of three, of which two must stay up: one member is acted on
+    # and the others are held rather than planned into waves that could
+    # never start
+    annotations = dict(('w%d' % i, {'ha_group_id': 'g', 'ha_group_min': '2'})
+                       for i in range(3))
+    plan = planner.plan_drain(['w0', 'w1', 'w2'], annotations, wave_size=1)
+    assert_equal([['w0']], plan.waves)
+    assert_equal(['w1', 'w2'], plan.held)
+    plan = planner.plan_drain(['w0', 'w1', 'w2'], annotations, wave_size=1,
+                              acted=['w2'])
+    assert_equal([['w2']], plan.waves)
+
+
+def test_groups_are_scoped_by_tenant():
+    annotations = {'a': {'ha_group_id': 'db', 'ha_group_min': '1'},
+                   'b': {'ha_group_id': 'db', 'ha_group_min': '1'}}
+    tenants = {'a': 'tenant-a', 'b': 'tenant-b'}
+    sizes = {('tenant-a', 'db'): 2, ('tenant-b', 'db'): 1}
+    plan = planner.plan_drain(['a', 'b'], annotations, sizes,
+                              tenants=tenants)
+    assert_equal([['a']], plan.waves)
+    assert_equal(['b'], plan.held)
+    assert_equal(set([('tenant-b', 'db')]), plan.constrained)
+
+
+def test_group_size_includes_members_elsewhere():
+    annotations = {'a': {'ha_group_id': 'db', 'ha_group_min': '2'},
+                   'b': {'ha_group_id': 'db'}}
+    plan = planner.plan_drain(['a', 'b'], annotations, {(None, 'db'): 4})
+    assert_equal([['a', 'b']], plan.waves)
+    plan = planner.plan_drain(['a', 'b'], annotations, {(None, 'db'): 2})
+    assert_equal([], plan.waves)
+    assert_equal(['a', 'b'], sorted(plan.held))
+    assert_equal(set([(None, 'db')]), plan.constrained)
+
+
+def test_acted_members_use_up_the_budget():
+    # Group of five, of which three must stay up
+    annotations = dict(('web-%d' % i, {'ha_group_id': 'web',
+                                       'ha_group_min': '3'})
+                       for i in range(5))
+    uuids = sorted(annotations)
+    plan = planner.plan_drain(uuids, annotations, acted=['web-3', 'web-4'])
+    assert_equal([['web-3', 'web-4']], [sorted(w) for w in plan.waves])
+    assert_equal(3, len(plan.held))
+    # Once the two are gone the rest are held back, not drained
+    plan = planner.plan_drain(uuids[:3], annotations, {(None, 'web'): 3})
+    assert_equal([], plan.waves)
+    assert_equal(3, len(plan.held))
+
+
+def test_large_plan():
+    uuids = ['i-%d' % i for i in range(20000)]
+    annotations = dict((uuid, {'ha_group_id': 'g-%d' % (i % 1000),
+                               'ha_group_min': '15',
+                               'priority': str(i % 7)})
+                       for (i, uuid) in enumerate(uuids))
+    plan = planner.plan_drain(uuids, annotations, wave_size=500)
+    # Each group of twenty can spare five
+    assert_equal(5000, len(plan.wave_of))
+    assert_equal(15000, len(plan.held))
+    for wave in plan.waves:
+        assert_true(len(wave) <= 500)
+        per_group = {}
+        for uuid in wave:
+            group = annotations[uuid]['ha_group_id']
+            per_group[group] = per_group.get(group, 0) + 1
+        assert_true(max(per_group.values()) <= 5)
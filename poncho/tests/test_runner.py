@@ -0,0 +1,57 @@
+from nose.tools import *
+
+from datetime import datetime, timedelta
+import threading
+
+from poncho.runner import EventRunner
+
+
+def test_runner_guards_and_reruns():
+    release = threading.Event()
+    started = []
+    done = {}
+    finished = threading.Event()
+    now = datetime(2013, 5, 1)
+
+    def run(event_id):
+        started.append(event_id)
+        if event_id == 1:
+            release.wait(5)
+        if event_id == 2:
+            raise ValueError("boom")
+        return now + timedelta(hours=event_id)
+
+    def on_done(event_id, wake_at):
+        done.setdefault(event_id, []).append(wake_at)
+        if len(done) == 2:
+            finished.set()
+
+    runner = EventRunner(run, on_done, concurrency=2, tick_timeout=1,
+                         retry_delay=60, clock=lambda: now)
+    assert runner.submit(1)
+    assert not runner.submit(1)
+    assert runner.submit(2)
+    release.set()
+    finished.wait(5)
+    runner.close()
+    # The second submit of event 1 asks for an immediate wake-up once the
+    # running tick finishes, instead of running concurrently.
+    assert_equal([now], done[1])
+    assert_equal([now + timedelta(seconds=60)], done[2])
+    assert_equal(2, len(started))
+
+
+def test_runner_reports_stuck_ticks():
+    clock = [datetime(2013, 5, 1)]
+    release = threading.Event()
+    runner = EventRunner(lambda event_id: release.wait(5),
+                         lambda event_id, wake_at: None, concurrency=1,
+                         tick_timeout=10, clock=lambda: clock[0])
+    runner.submit(7)
+    assert_equal([], runner.check_timeouts())
+    clock[0] += timedelta(seconds=11)
+    assert_equal([7], runner.check_timeouts())
+    assert_equal(set([7]), runner.in_flight())
+    release.set()
+    runner.close()
+    assert_equal(set(), runner.in_flight())
@@ -0,0 +1,52 @@
+from nose.tools import *
+
+from datetime import datetime, timedelta
+
+from poncho.scheduler import Scheduler, TriggerListener
+
+
+def test_due_order_and_reschedule():
+    now = datetime(2013, 5, 1, 12, 0)
+    scheduler = Scheduler(clock=lambda: now)
+    scheduler.schedule(1, now - timedelta(minutes=1))
+    scheduler.schedule(2, now + timedelta(hours=1))
+    scheduler.schedule(3, now - timedelta(minutes=5))
+    assert_equal(now - timedelta(minutes=5), scheduler.next_wake())
+    # Rescheduling replaces the old wake time
+    scheduler.reschedule(1, now + timedelta(minutes=30))
+    assert_equal(([3], False), scheduler.wait(max_sleep=0))
+    assert_equal(now + timedelta(minutes=30), scheduler.next_wake())
+    scheduler.reschedule(1, None)
+    assert_equal(now + timedelta(hours=1), scheduler.next_wake())
+    # Nothing due within max_sleep asks for a rescan
+    assert_equal(([], True), scheduler.wait(max_sleep=0))
+
+
+def test_triggers():
+    now = datetime(2013, 5, 1, 12, 0)
+    scheduler = Scheduler(clock=lambda: now)
+    scheduler.schedule(1, now + timedelta(days=1))
+    scheduler.watch(1, ['host1', 'host2'])
+    scheduler.watch(2, ['host2'])
+    scheduler.trigger_hosts(['host1'])
+    assert_equal(([1], False), scheduler.wait(max_sleep=0))
+    scheduler.trigger_hosts(['host2', 'host3'])
+    assert_equal([1, 2], sorted(scheduler.wait(max_sleep=0)[0]))
+    scheduler.unwatch(2)
+    scheduler.trigger_hosts(['host2'])
+    assert_equal(([1], False), scheduler.wait(max_sleep=0))
+    scheduler.trigger()
+    assert_equal(([], True), scheduler.wait(max_sleep=10))
+
+
+def test_second_listener_falls_back_to_polling():
+    scheduler = Scheduler()
+    first = TriggerListener(scheduler, '127.0.0.1', 0)
+    try:
+        port = first.sock.getsockname()[1]
+        second = TriggerListener(scheduler, '127.0.0.1', port)
+        assert_equal(None, second.sock)
+        # Returns straight away instead of failing
+        second.run()
+    finally:
+        first.sock.close()
@@ -0,0 +1,118 @@
+from nose.tools import *
+
+from datetime import datetime, timedelta
+import time
+
+import numpy
+
+from poncho import annotations
+from poncho import evaluator
+from poncho import simulator
+
+
+class FakeServer(object):
+    def __init__(self, id, host, launched_at=None, **metadata):
+        self.id = id
+        self.name = id
+        self.metadata = metadata
+        setattr(self, 'OS-EXT-SRV-ATTR:host', host)
+        if launched_at:
+            setattr(self, simulator.LAUNCHED_AT_ATTR,
+                    launched_at.isoformat() + '.000000')
+
+
+START = datetime(2013, 5, 1, 12, 0, 0)
+
+
+def test_timeline():
+    servers = [FakeServer('a', 'h1'), FakeServer('b', 'h1'),
+               FakeServer('c', 'h2', priority='5')]
+    sim = simulator.simulate(
+        'delete-instances', servers, START, START + timedelta(hours=48),
+        wave_size=2, host_rate=1, cell_rate=0, action_seconds=30)
+    by_uuid = dict((i.uuid, i) for i in sim.instances)
+    drain = START + timedelta(hours=48)
+    assert_equal(START, by_uuid['a'].notified_at)
+    assert_equal(drain, by_uuid['a'].action_at)
+    # Second delete on h1 waits for the host's rate limit
+    assert_equal(drain + timedelta(seconds=1), by_uuid['b'].action_at)
+    # The high priority instance goes in the next wave
+    assert_equal(1, by_uuid['c'].wave)
+    assert_equal(drain + timedelta(seconds=31 + 2), by_uuid['c'].drain_at)
+    assert_equal(by_uuid['c'].done_at, sim.finished_at)
+    assert_equal([], sim.early())
+
+
+def test_held_back_instances():
+    # Both members are needed, so neither is acted on
+    servers = [FakeServer('a', 'h1', ha_group_id='db', ha_group_min='2'),
+               FakeServer('b', 'h1', ha_group_id='db')]
+    sim = simulator.simulate(
+        'delete-instances', servers, START, START + timedelta(hours=1))
+    assert_equal(['a', 'b'], sorted(i.uuid for i in sim.held()))
+    assert_equal(None, sim.held()[0].action_at)
+    assert_equal(START, sim.finished_at)
+    assert_equal([], sim.early())
+
+
+def test_members_past_the_budget_are_held():
+    # One of three may go; the other two are reported rather than planned
+    servers = [FakeServer(uuid, 'h1', ha_group_id='web', ha_group_min='2')
+               for uuid in ('a', 'b', 'c')]
+    sim = simulator.simulate(
+        'delete-instances', servers, START, START + timedelta(hours=1),
+        wave_size=1)
+    assert_equal(['b', 'c'], sorted(i.uuid for i in sim.held()))
+    assert_equal(['a'], [i.uuid for i in sim.instances if i.wave == 0])
+
+
+def test_constraints_report_early_actions():
+    servers = [
+        FakeServer('a', 'h1', terminate_when='Notified(72h)'),
+        FakeServer('b', 'h1', launched_at=START,
+                   terminate_when='MinRuntime(1h)'),
+        FakeServer('c', 'h1', terminate_when='TimeOfDay(02:00, 04:00)'),
+        FakeServer('d', 'h1', terminate_when='MinRuntime(1h)'),
+    ]
+    sim = simulator.simulate(
+        'delete-instances', servers, START, START + timedelta(hours=48),
+        host_rate=0, cell_rate=0)
+    by_uuid = dict((i.uuid, i) for i in sim.instances)
+    assert_equal(START + timedelta(hours=72), by_uuid['a'].allowed_at)
+    assert_equal(START + timedelta(hours=48), by_uuid['b'].allowed_at)
+    assert_equal(datetime(2013, 5, 4, 2, 0, 1), by_uuid['c'].allowed_at)
+    # Never launched, so MinRuntime never holds
+    assert_equal(None, by_uuid['d'].allowed_at)
+    assert_equal(['a', 'c', 'd'],
+                 sorted(i.uuid for i in sim.early()))
+
+
+def test_earliest_allowed_matches_evaluator():
+    grammar = annotations.default.tags['terminate_when']
+    program = grammar.compile(
+        'TimeOfDay(22:00, 02:00, -05:00);TimeOfDay(01:00, 05:00)')
+    assert_equal(2, len(program))
+    starts = numpy.arange(0, 2 * 86400, 3600.0) + \
+        evaluator.to_epoch(START)
+    nan = numpy.repeat(numpy.nan, len(starts))
+    allowed = simulator.earliest_allowed(program, nan, nan, starts)
+    for (start, t) in zip(starts, allowed):
+        when = datetime.utcfromtimestamp(t)
+        assert_true(evaluator.evaluate([program], [None], [None], when)[0])
+        assert_true(t >= start)
+
+
+def test_thousands_of_instances_are_fast():
+    programs = ['', 'MinRuntime(2h)', 'Notified(24h);TimeOfDay(01:00, 03:00)']
+    servers = [FakeServer('i-%d' % i, 'h%d' % (i % 50),
+                          launched_at=START - timedelta(minutes=i),
+                          terminate_when=programs[i % 3],
+                          ha_group_id='g%d' % (i % 300), ha_group_min='5',
+                          priority=str(i % 4))
+               for i in range(5000)]
+    started = time.time()
+    sim = simulator.simulate('delete-instances', servers, START,
+                             START + timedelta(hours=48))
+    assert_true(time.time() - started < 1.0)
+    assert_equal(5000, len(sim.instances))
+    assert_true(sim.duration > timedelta(hours=48))
@@ -0,0 +1,20 @@
+from nose.tools import *
+
+from poncho.common.utils import TokenBucket
+
+
+def test_token_bucket():
+    clock = [0.0]
+    slept = []
+    def sleep(seconds):
+        slept.append(seconds)
+        clock[0] += seconds
+    bucket = TokenBucket(2, capacity=2, clock=lambda: clock[0], sleep=sleep)
+    assert_equal(0, bucket.try_consume())
+    assert_equal(0, bucket.try_consume())
+    assert_equal(0.5, bucket.try_consume())
+    bucket.consume()
+    assert_equal([0.5], slept)
+    clock[0] += 10
+    assert_equal(0, bucket.try_consume(2))
+    assert_equal(0, TokenBucket(0).try_consume(100))
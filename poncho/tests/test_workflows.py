@@ -0,0 +1,191 @@
+from nose.tools import *
+
+import poncho.workflows as pw
+from poncho.tests import fixtures
+
+
+class Thing(object):
+    def __init__(self, state):
+        self.state = state
+
+
+class ToyWorkflow(pw.Workflow):
+    name = "toy"
+    transitions = {
+        'start': ['middle'],
+        'middle': ['end'],
+        'end': [],
+    }
+    aliases = {'begin': 'start'}
+
+    def state_start(self, thing, ctx):
+        return 'middle'
+
+    def state_middle(self, thing, ctx):
+        # Generator states are run as coroutines
+        yield pw.coroutines.call(lambda: None)
+        raise pw.coroutines.Return(ctx.get('next'))
+
+    def state_end(self, thing, ctx):
+        pass
+
+
+def test_dispatch_and_validation():
+    ToyWorkflow.compile()
+    workflow = ToyWorkflow()
+    assert_equal(['end', 'middle', 'start'], workflow.states())
+    assert_equal('middle', workflow.run(Thing('start'), {}))
+    assert_equal('middle', workflow.run(Thing('begin'), {}))
+    assert_equal('end', workflow.run(Thing('middle'), {'next': 'end'}))
+    assert_equal(None, workflow.run(Thing('middle'), {}))
+    assert_raises(pw.IllegalTransition, workflow.run, Thing('middle'),
+                  {'next': 'start'})
+    assert_raises(pw.UnknownState, workflow.run, Thing('nowhere'), {})
+    timings = ToyWorkflow.timings.snapshot()
+    assert_equal(2, timings['start']['count'])
+    assert_equal(3, timings['middle']['count'])
+    assert_equal(3, sum(timings['middle']['histogram']))
+    lines = pw.format_timings([ToyWorkflow])
+    assert_equal(2, len(lines))
+    assert lines[0].startswith("toy middle: 3 runs, mean ")
+    assert "<=0.01s:" in lines[0] and ">300s:0" in lines[0]
+
+
+def test_invalid_workflows():
+    class Missing(pw.Workflow):
+        transitions = {'start': []}
+
+    class Dangling(ToyWorkflow):
+        transitions = {'start': ['elsewhere']}
+    assert_raises(pw.InvalidWorkflow, Missing.compile)
+    assert_raises(pw.InvalidWorkflow, Dangling.compile)
+
+
+def test_enabled_workflows():
+    names = [w.name for w in pw.get_workflows()]
+    assert 'delete-instances' in names
+    assert 'restart-instances' in names
+    assert 'completed' in pw.DeleteInstances().states()
+    assert_raises(Exception, pw.get_workflow, 'no-such-workflow')
+
+
+class FakeServer(object):
+    def __init__(self, id, host, status='ACTIVE'):
+        self.id = id
+        self.name = id
+        self.status = status
+        self.deletes = 0
+        setattr(self, 'OS-EXT-SRV-ATTR:host', host)
+
+    def delete(self):
+        self.deletes += 1
+
+    def stop(self):
+        self.status = 'SHUTOFF'
+
+    def start(self):
+        self.starts = getattr(self, 'starts', 0) + 1
+        self.status = 'ACTIVE'
+
+
+def test_active_drain_is_idempotent():
+    from datetime import datetime
+    import poncho.db.api as db
+    import poncho.db.models as models
+    fixtures.memory_db()
+    session = db.get_session()
+    host = models.Host(name='h1')
+    event = models.ServiceEvent(
+        description='', notes='', workflow='delete-instances',
+        begin_passive_drain_at=datetime.now(),
+        begin_active_drain_at=datetime.now(), state='active_drain',
+        hosts=[host])
+    session.add(event)
+    session.commit()
+
+    servers = [FakeServer('a', 'h1'), FakeServer('b', 'h1')]
+    sent = []
+    real_get_servers = pw.get_servers
+    real_notification = pw.notifications.notification
+    pw.get_servers = lambda hostnames: (list(servers), {})
+    pw.notifications.notification = lambda **kw: type(
+        'N', (object,), {'send': lambda self: sent.append(kw)})()
+    try:
+        workflow = pw.DeleteInstances()
+        assert_equal(None, workflow.run(event, {}))
+        assert_equal(None, workflow.run(event, {}))
+        assert_equal([1, 1], [s.deletes for s in servers])
+        assert_equal(2, len(sent))
+        # Rows on a host that cannot be listed are left as they are
+        pw.get_servers = lambda hostnames: ([], {'h1': IOError()})
+        assert_equal(None, workflow.run(event, {}))
+        ledger = db.get_event_instances(event.id, session=session)
+        assert_equal(['acting', 'acting'],
+                     [row.state for row in ledger.values()])
+        pw.get_servers = lambda hostnames: (list(servers), {})
+        # A restarted worker picks the ledger up from the database
+        session.commit()
+        session.expire_all()
+        servers.pop()
+        servers[0].status = 'DELETED'
+        assert_equal('drained', pw.DeleteInstances().run(event, {}))
+        assert_equal(1, servers[0].deletes)
+        ledger = db.get_event_instances(event.id, session=session)
+        assert_equal({'a': 'acting', 'b': 'done'},
+                     dict((k, v.state) for (k, v) in ledger.items()))
+    finally:
+        pw.get_servers = real_get_servers
+        pw.notifications.notification = real_notification
+
+
+def test_restart_instances():
+    from datetime import datetime
+    import poncho.db.api as db
+    import poncho.db.models as models
+    from poncho.nova.client import HostResults
+    fixtures.memory_db()
+    session = db.get_session()
+    event = models.ServiceEvent(
+        description='', notes='', workflow='restart-instances',
+        begin_passive_drain_at=datetime.now(),
+        begin_active_drain_at=datetime.now(), state='notify',
+        hosts=[models.Host(name='h1')])
+    session.add(event)
+    session.commit()
+
+    # b was shut off by its owner and stays that way
+    servers = [FakeServer('a', 'h1'), FakeServer('b', 'h1', 'SHUTOFF')]
+    sent = []
+    services = []
+
+    class FakeManage(object):
+        def service_disable_many(self, hosts, binary):
+            services.append(('disable', sorted(hosts)))
+            return HostResults()
+
+        def service_enable_many(self, hosts, binary):
+            services.append(('enable', sorted(hosts)))
+            return HostResults()
+    real = (pw.get_servers, pw.notifications.notification, pw.nova_manage,
+            pw.actions._EXECUTOR)
+    pw.get_servers = lambda hostnames: (list(servers), {})
+    pw.notifications.notification = lambda **kw: type(
+        'N', (object,), {'send': lambda self: sent.append(kw['type'])})()
+    pw.nova_manage = FakeManage()
+    pw.actions._EXECUTOR = pw.actions.BulkExecutor(host_rate=0, cell_rate=0)
+    try:
+        workflow = pw.RestartInstances()
+        assert_equal('active_drain', workflow.run(event, {}))
+        assert_equal(['reboot_scheduled'] * 2, sent)
+        event.state = 'active_drain'
+        assert_equal(None, workflow.run(event, {}))
+        assert_equal('drained', workflow.run(event, {}))
+        event.state = 'restarting'
+        assert_equal('completed', workflow.run(event, {}))
+        assert_equal(['ACTIVE', 'SHUTOFF'], [s.status for s in servers])
+        assert_equal(1, servers[0].starts)
+        assert_equal('rebooting', sent[-1])
+        assert_equal([('disable', ['h1']), ('enable', ['h1'])], services)
+    finally:
+        (pw.get_servers, pw.notifications.notification, pw.nova_manage,
+         pw.actions._EXECUTOR) = real
@@ -5,13 +5,24 @@ Poncho service workflow definitions
 
 from oslo.config import cfg
 
+from sqlalchemy.orm import object_session
+
+from poncho import actions
+from poncho import coroutines
+from poncho.db import api as db
+from poncho import notifications
+from poncho import planner
 from poncho.nova.manage import nova_manage
 from poncho.nova.client import Client
+from poncho.nova.inventory import server_host
 
-from datetime import datetime
+from datetime import datetime, timedelta
+import bisect
 import importlib
 import inspect
 import sys
+import threading
+import time
 
 DEFAULT_WORKFLOWS = [
     'poncho.workflows.DeleteInstances',
@@ -20,9 +31,19 @@ DEFAULT_WORKFLOWS = [
 opts = [
     cfg.ListOpt('enabled_workflows', default=DEFAULT_WORKFLOWS,
         help="Avaliable workflows for Poncho service event operations"),
+    cfg.IntOpt('polling_interval', default=2,
+        help='Interval in seconds to update workflows for service events '
+             'that are waiting on nova.'),
+    cfg.IntOpt('instance_action_timeout', default=600,
+        help='Seconds after which an action on an instance that has not '
+             'taken effect is issued again.'),
+    cfg.IntOpt('timings_report_interval', default=900,
+        help='Seconds between reports of how long each workflow state '
+             'takes to run; zero to never report.'),
 ]
 CONF = cfg.CONF
 CONF.register_opts(opts)
+CONF.import_opt('action_max_wait', 'poncho.actions')
 
 class UnknownState(Exception):
     def __init__(self, state):
@@ -30,24 +51,228 @@ class UnknownState(Exception):
     def __str__(self):
         return "Unknown state '%s'" % (self.state)
 
+_NOVA_CLIENT = None
+
+def get_nova_client():
+    global _NOVA_CLIENT
+    if _NOVA_CLIENT is None:
+        _NOVA_CLIENT = Client()
+    return _NOVA_CLIENT
+
+def get_event_servers(event):
+    """Returns (servers, failures) for all hosts of a service event, where
+    failures maps hostnames that could not be listed to the error."""
+    return get_servers([host.name for host in event.hosts])
+
+def get_servers(hostnames):
+    results = get_nova_client().get_servers_for_hosts(hostnames)
+    for (host, e) in results.failures.iteritems():
+        print >>sys.stderr, "Listing servers on %s failed: %s" % (host, e)
+    servers = []
+    for host_servers in results.itervalues():
+        servers.extend(host_servers)
+    return (servers, results.failures)
+
+def get_ledger(event, servers):
+    """Returns the {uuid: db.models.Instance} progress rows of an event,
+    adding rows for any of servers seen for the first time."""
+    session = object_session(event)
+    ledger = db.get_event_instances(event.id, session=session)
+    return db.track_event_instances(
+        event, [(server.id, server_host(server)) for server in servers],
+        ledger, session=session)
+
+def notify_instances(event, instances, type):
+    """Send a scheduled-action notification to each of instances not yet
+    notified for event."""
+    ledger = get_ledger(event, instances)
+    now = datetime.utcnow()
+    for instance in instances:
+        row = ledger[instance.id]
+        if row.notified:
+            continue
+        notifications.notification(
+            timestamp=event.begin_active_drain_at,
+            description=event.description,
+            event_id=event.id,
+            type=type,
+            instance_name=instance.name,
+            instance_uuid=instance.id,
+            user_id=getattr(instance, 'user_id', None)).send()
+        row.notified = True
+        row.notified_at = now
+        row.state = 'notified'
+        row.updated_at = now
+
+def next_wave(event, instances, ledger, acted_states):
+    """Returns the uuids of the next drain wave of instances. Instances
+    whose ledger row is in acted_states count as already taken down."""
+    acted = [instance.id for instance in instances
+             if ledger[instance.id].state in acted_states]
+    plan = planner.plan_servers(instances, session=object_session(event),
+                                acted=acted)
+    if plan.constrained:
+        print >>sys.stderr, (
+            "Event %d: holding back %d instances of HA groups that cannot "
+            "spare them until replacements bring the groups above their "
+            "ha_group_min: %s" % (event.id, len(plan.held), ", ".join(
+                "%s/%s" % group for group in sorted(plan.constrained))))
+    return set(plan.first_wave())
+
+def enable_event_hosts(event, session=None):
+    """Re-enable nova-compute on the hosts of a finished event that no
+    other active event still holds. Returns the enabled hosts."""
+    hosts = db.get_releasable_hosts(event.id, session=session)
+    if not hosts:
+        return []
+    results = nova_manage.service_enable_many(hosts, 'nova-compute')
+    for (host, e) in results.failures.iteritems():
+        print >>sys.stderr, "Enabling nova-compute on %s failed: %s" % (
+            host, e)
+    return sorted(results)
+
+class IllegalTransition(Exception):
+    def __init__(self, workflow, state, new_state):
+        self.workflow = workflow
+        self.state = state
+        self.new_state = new_state
+    def __str__(self):
+        return "Workflow '%s' cannot go from '%s' to '%s'" % (
+            self.workflow, self.state, self.new_state)
+
+class InvalidWorkflow(Exception):
+    pass
+
+class StateTimings(object):
+    """Histogram of how long each state function takes, in seconds."""
+    buckets = (0.01, 0.1, 1, 10, 60, 300)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states = {}
+
+    def record(self, state, seconds):
+        with self._lock:
+            entry = self._states.setdefault(state, {
+                'count': 0, 'total': 0.0, 'max': 0.0,
+                'histogram': [0] * (len(self.buckets) + 1)})
+            entry['count'] += 1
+            entry['total'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+            entry['histogram'][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def snapshot(self):
+        """Returns {state: {'count', 'total', 'max', 'histogram'}}, where
+        histogram[i] counts runs of at most buckets[i] seconds and the last
+        entry counts the slower ones."""
+        with self._lock:
+            return dict((state, dict(entry, histogram=list(
+                entry['histogram']))) for (state, entry)
+                in self._states.iteritems())
+
+def format_timings(workflows):
+    """Returns one line per state of workflows that has run, giving its
+    run count, mean and maximum seconds and histogram."""
+    lines = []
+    for workflow in workflows:
+        snapshot = workflow.timings.snapshot()
+        for state in sorted(snapshot):
+            entry = snapshot[state]
+            bounds = ["<=%ss" % (bound) for bound in StateTimings.buckets]
+            bounds.append(">%ss" % (StateTimings.buckets[-1]))
+            histogram = " ".join("%s:%d" % pair for pair
+                                 in zip(bounds, entry['histogram']))
+            lines.append("%s %s: %d runs, mean %.3fs, max %.3fs (%s)" % (
+                workflow.name, state, entry['count'],
+                entry['total'] / entry['count'], entry['max'], histogram))
+    return lines
+
+class TimingsReporter(threading.Thread):
+    """Prints the state timings of the enabled workflows every
+    timings_report_interval seconds."""
+    def __init__(self):
+        super(TimingsReporter, self).__init__(name='timings-reporter')
+        self.daemon = True
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        while not self._stopping.wait(CONF.timings_report_interval):
+            for line in format_timings(get_workflows()):
+                print "Timings: %s" % (line)
+            sys.stdout.flush()
+
 class Workflow(object):
+    # Maps every state to the states its state_<name> function may return.
+    transitions = {}
+    # Old state names still found in the database
+    aliases = {}
+    # States that poncho-service complete moves on to another state
+    # instead of completing the event
+    resume = {}
+    # States in which poncho has disabled the event's hosts
+    hosts_disabled_in = ()
+
     def name(self):
         return self.__class__.name
 
+    @classmethod
+    def compile(cls):
+        """Build the state dispatch table from the transition graph. Done
+        once per class, when the workflow is registered."""
+        dispatch = {}
+        for (state, targets) in cls.transitions.iteritems():
+            state_fn = getattr(cls, "state_" + state, None)
+            if state_fn is None:
+                raise InvalidWorkflow("%s has no function for state '%s'" %
+                                      (cls.__name__, state))
+            for target in targets:
+                if target not in cls.transitions:
+                    raise InvalidWorkflow(
+                        "%s: '%s' leads to unknown state '%s'" %
+                        (cls.__name__, state, target))
+            dispatch[state] = (state_fn.__func__, frozenset(targets))
+        if not dispatch:
+            raise InvalidWorkflow("%s has no states" % (cls.__name__))
+        cls._dispatch = dispatch
+        cls.timings = StateTimings()
+
+    def _compiled(self):
+        cls = self.__class__
+        if '_dispatch' not in cls.__dict__:
+            cls.compile()
+        return cls._dispatch
+
     def states(self):
-        return [ fn_name[6:] for fn_name in dir(self.__class__)
-                if fn_name.startswith('state_')]
+        return sorted(self._compiled())
 
     def _get_state_fn(self, state_name):
-        return getattr(self.__class__, "state_" + state_name)
+        entry = self._compiled().get(self.aliases.get(state_name, state_name))
+        return entry[0] if entry else None
 
     def run(self, thing, context):
-        state_name = thing.state
-        state_fn = self._get_state_fn(state_name)
-        if state_fn:
-            return state_fn(self, thing, context)
-        else:
-            raise UnknownState(state_name)
+        state_name = self.aliases.get(thing.state, thing.state)
+        entry = self._compiled().get(state_name)
+        if entry is None:
+            raise UnknownState(thing.state)
+        (state_fn, targets) = entry
+        started = time.time()
+        try:
+            result = state_fn(self, thing, context)
+            if inspect.isgenerator(result):
+                result = coroutines.run(result)
+        finally:
+            self.timings.record(state_name, time.time() - started)
+        if result is not None and result not in targets:
+            raise IllegalTransition(self.name, state_name, result)
+        return result
+
+    def next_run_at(self, thing, now):
+        """Returns when run() should next be called for thing, or None if
+        nothing will happen until the worker is explicitly triggered."""
+        return now + timedelta(seconds=CONF.polling_interval)
 
 class RestartInstances(Workflow):
     """ Notify, then shutdown instances. Restart after service.
@@ -55,9 +280,123 @@ class RestartInstances(Workflow):
 initalized -> notify -> active_drain -> drained -> restarting -> completed
  * canceled
 
+poncho-service complete on a drained event starts the instances poncho
+stopped; the event completes once they are running again.
 """
     name = "restart-instances"
-    pass
+    transitions = {
+        'initialized': ['notify', 'canceled'],
+        'notify': ['active_drain', 'canceled'],
+        'active_drain': ['drained', 'canceled'],
+        'drained': ['restarting'],
+        'restarting': ['completed'],
+        'completed': [],
+        'canceled': [],
+    }
+    resume = {'drained': 'restarting'}
+    hosts_disabled_in = ('notify', 'active_drain', 'drained', 'restarting')
+
+    def state_initialized(self, event, ctx):
+        if datetime.now() > event.begin_passive_drain_at:
+            return "notify"
+
+    def state_notify(self, event, ctx):
+        hostnames = [host.name for host in event.hosts]
+        (results, (instances, failures)) = yield [
+            coroutines.call(nova_manage.service_disable_many, hostnames,
+                            'nova-compute'),
+            coroutines.call(get_servers, hostnames)]
+        for (host, e) in results.failures.iteritems():
+            print >>sys.stderr, "Disabling nova-compute on %s failed: %s" % (
+                host, e)
+        notify_instances(event, instances, 'reboot_scheduled')
+        if datetime.now() > event.begin_active_drain_at:
+            raise coroutines.Return("active_drain")
+
+    def state_active_drain(self, event, ctx):
+        hostnames = [host.name for host in event.hosts]
+        (instances, failures) = yield coroutines.call(get_servers, hostnames)
+        ledger = get_ledger(event, instances)
+        now = datetime.utcnow()
+        retry = timedelta(seconds=CONF.instance_action_timeout)
+        running = [instance for instance in instances
+                   if instance.status == 'ACTIVE']
+        # Instances poncho stopped stay down for the whole event, so they
+        # keep using up their group's budget.
+        wave = next_wave(event, [instance for instance in instances
+                                 if instance.status == 'ACTIVE'
+                                 or ledger[instance.id].state
+                                 in ('acting', 'done')],
+                         ledger, ('acting', 'done'))
+        to_stop = [instance for instance in running
+                   if instance.id in wave
+                   and (ledger[instance.id].state != 'acting'
+                        or now - ledger[instance.id].updated_at > retry)]
+        results = yield coroutines.call(
+            actions.get_executor().run, 'stop', to_stop,
+            max_wait=CONF.action_max_wait)
+        for (uuid, e) in results.failures.iteritems():
+            print >>sys.stderr, "Stopping %s failed: %s" % (uuid, e)
+        for instance in results.itervalues():
+            ledger[instance.id].state = 'acting'
+            ledger[instance.id].updated_at = now
+        for instance in instances:
+            row = ledger[instance.id]
+            if row.state == 'acting' and instance.status == 'SHUTOFF':
+                row.state = 'done'
+                row.updated_at = now
+        if not running and not failures:
+            raise coroutines.Return("drained")
+
+    def state_drained(self, event, ctx):
+        pass
+
+    def state_restarting(self, event, ctx):
+        hostnames = [host.name for host in event.hosts]
+        (instances, failures) = yield coroutines.call(get_servers, hostnames)
+        ledger = get_ledger(event, instances)
+        now = datetime.utcnow()
+        # Only what poncho stopped is started again
+        to_start = [instance for instance in instances
+                    if ledger[instance.id].state == 'done'
+                    and instance.status == 'SHUTOFF']
+        results = yield coroutines.call(
+            actions.get_executor().run, 'start', to_start,
+            max_wait=CONF.action_max_wait)
+        for (uuid, e) in results.failures.iteritems():
+            print >>sys.stderr, "Starting %s failed: %s" % (uuid, e)
+        for instance in results.itervalues():
+            notifications.notification(
+                timestamp=datetime.now(),
+                description=event.description,
+                event_id=event.id,
+                type='rebooting',
+                instance_name=instance.name,
+                instance_uuid=instance.id,
+                user_id=getattr(instance, 'user_id', None)).send()
+            ledger[instance.id].state = 'restarted'
+            ledger[instance.id].updated_at = now
+        waiting = [instance for instance in instances
+                   if ledger[instance.id].state in ('done', 'restarted')
+                   and instance.status != 'ACTIVE']
+        if not waiting and not failures:
+            enable_event_hosts(event, session=object_session(event))
+            raise coroutines.Return("completed")
+
+    def next_run_at(self, event, now):
+        if event.state == 'initialized':
+            return event.begin_passive_drain_at
+        elif event.state == 'notify':
+            return event.begin_active_drain_at
+        elif event.state in ('active_drain', 'restarting'):
+            return super(RestartInstances, self).next_run_at(event, now)
+        return None
+
+    def state_completed(self, event, ctx):
+        pass
+
+    def state_canceled(self, event, ctx):
+        pass
 
 class DeleteInstances(Workflow):
     """ Workflow for deleting instances on hosts.
@@ -66,9 +405,19 @@ initalized -> passive_drain -> active_drain -+
                      |                       |
                      +-----> drained <-------+
                                 |
-    * canceled              compleded
+    * canceled              completed
 """
     name = "delete-instances"
+    transitions = {
+        'initialized': ['passive_drain'],
+        'passive_drain': ['active_drain', 'drained'],
+        'active_drain': ['drained'],
+        'drained': [],
+        'completed': [],
+        'canceled': [],
+    }
+    aliases = {'complete': 'completed'}
+    hosts_disabled_in = ('passive_drain', 'active_drain', 'drained')
     def __init__(self):
         pass
 
@@ -77,44 +426,86 @@ initalized -> passive_drain -> active_drain -+
             return "passive_drain"
 
     def state_passive_drain(self, event, ctx):
-        instances = []
-        for host in event.hosts:
-            nova_manage.service_disable(host=host, service='nova-compute')
-            instances.append(nova_client.get_host_instances(host))
-        for instance in instances:
-            have_notified = True
-            if not have_notified:
-                notifications.notification(
-                    timestamp=event.begin_active_drain_at,
-                    description=event.description,
-                    type='terminate_scheduled',
-                    instance_name=instance.name,
-                    instance_uuid=instance.uuid).send()
+        hostnames = [host.name for host in event.hosts]
+        # Disable the hosts and list their servers at the same time
+        (results, (instances, failures)) = yield [
+            coroutines.call(nova_manage.service_disable_many, hostnames,
+                            'nova-compute'),
+            coroutines.call(get_servers, hostnames)]
+        for (host, e) in results.failures.iteritems():
+            print >>sys.stderr, "Disabling nova-compute on %s failed: %s" % (
+                host, e)
+        notify_instances(event, instances, 'terminate_scheduled')
         if datetime.now() > event.begin_active_drain_at:
-            return "active_drain"
+            raise coroutines.Return("active_drain")
     
     def state_active_drain(self, event, ctx):
-        instances = []
-        for host in event.hosts:
-            instances.append(nova_client.get_host_instances(host))
-        deleting = 0
-        for instance in instances:
-            if instance.status in ['ACTIVE']:
-                deleting += 1
-            instance.delete()
-            notifications.notification(
-                timestamp=datetime.now(),
-                description=event.description,
-                type='terminating',
-                instance_name=instance.name,
-                instance_uuid=instance.uuid).send()
-        if deleting == 0:
-            return "drained"
+        hostnames = [host.name for host in event.hosts]
+        (instances, failures) = yield coroutines.call(get_servers, hostnames)
+        ledger = get_ledger(event, instances)
+        now = datetime.utcnow()
+        retry = timedelta(seconds=CONF.instance_action_timeout)
+        # Instances still being deleted keep their place in the first
+        # wave, so an HA group only loses more members as earlier ones go.
+        wave = next_wave(event, [instance for instance in instances
+                                 if instance.status != 'DELETED'],
+                         ledger, ('acting',))
+        # Only delete instances not already being deleted, unless the
+        # earlier delete has not taken effect in time.
+        to_delete = [instance for instance in instances
+                     if instance.id in wave
+                     and (ledger[instance.id].state != 'acting'
+                          or now - ledger[instance.id].updated_at > retry)]
+        # Deletes are throttled per host and per cell; whatever the rate
+        # limits hold back is left pending for the next run.
+        results = yield coroutines.call(
+            actions.get_executor().run, 'delete', to_delete,
+            max_wait=CONF.action_max_wait)
+        for (uuid, e) in results.failures.iteritems():
+            print >>sys.stderr, "Deleting %s failed: %s" % (uuid, e)
+        for instance in results.itervalues():
+            row = ledger[instance.id]
+            if row.state != 'acting':
+                notifications.notification(
+                    timestamp=datetime.now(),
+                    description=event.description,
+                    event_id=event.id,
+                    type='terminating',
+                    instance_name=instance.name,
+                    instance_uuid=instance.id,
+                    user_id=getattr(instance, 'user_id', None)).send()
+            row.state = 'acting'
+            row.updated_at = now
+        # Instances that have left the hosts; those on hosts that could
+        # not be listed are left as they are until the next run.
+        listed = set(instance.id for instance in instances)
+        unlisted = set(host.id for host in event.hosts
+                       if host.name in failures)
+        for (uuid, row) in ledger.iteritems():
+            if uuid not in listed and row.host_id not in unlisted \
+                    and row.state not in ('done', 'gone'):
+                row.state = 'done' if row.state == 'acting' else 'gone'
+                row.updated_at = now
+        deleting = len([instance for instance in instances
+                        if instance.status in ['ACTIVE']])
+        if deleting == 0 and not failures:
+            raise coroutines.Return("drained")
+
+    def next_run_at(self, event, now):
+        # Deadlines are known up front; changes on the hosts during the
+        # passive drain arrive as nova triggers.
+        if event.state == 'initialized':
+            return event.begin_passive_drain_at
+        elif event.state == 'passive_drain':
+            return event.begin_active_drain_at
+        elif event.state == 'active_drain':
+            return super(DeleteInstances, self).next_run_at(event, now)
+        return None
 
     def state_drained(self, event, ctx):
         pass
 
-    def state_complete(self, event, ctx):
+    def state_completed(self, event, ctx):
         pass
 
     def state_canceled(self, event, ctx):
@@ -128,7 +519,7 @@ def get_workflow(workflow_name):
         return _ENABLED_WORKFLOWS[workflow_name]
     else:
         raise Exception("Unknown workflow '%s', did you add it to the config?"
-            % (wokflow_name))
+            % (workflow_name))
 
 def _enabled_workflows():
     workflows = {}
@@ -139,12 +530,10 @@ def _enabled_workflows():
         try:
             module = importlib.import_module(module)
             workflow = getattr(module, cls)
+            workflow.compile()
             workflows[workflow.name] = workflow
-        # TODO(scott): want to log failed workflow imports
-        except ImportError, e:
-            pass
-        except KeyError, e:
-            pass
+        except (ImportError, AttributeError, InvalidWorkflow), e:
+            print >>sys.stderr, "Not enabling workflow %s: %s" % (path, e)
     return workflows
 
 _ENABLED_WORKFLOWS = _enabled_workflows()
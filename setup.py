@@ -13,14 +13,22 @@ setup(
     license='LICENSE.txt',
     long_description=open(cwd + '/README.txt').read(),
     install_requires=[
-        "python-novaclient >= 2.0.0",
+        "python-novaclient >= 2.10.0",
+        "python-keystoneclient >= 0.2",
+        "requests >= 2.4.0",
         "anyjson >= 0.3.3",
         "alembic >= 0.5",
         "oslo.config >= 1.1.1",
         "SQLAlchemy>=0.7,<=0.7.99",
         "importlib",
+        "numpy>=1.6",
     ],
     packages=find_packages(),
+    package_data={
+        'poncho.db': ['alembic.ini', 'migrations/README',
+                      'migrations/*.mako', 'migrations/*.py',
+                      'migrations/versions/*.py'],
+    },
     entry_points={
         'console_scripts' : [
               'poncho = poncho.cmd.client:main',